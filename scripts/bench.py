@@ -0,0 +1,157 @@
+"""
+Benchmarks the map builder without a game cache
+
+Run from the repository root:
+
+	python scripts/bench.py world [--scale=small] [--seed=1]
+	python scripts/bench.py run [--scale=small] [--seed=1] [--stages=a,b]
+		[--map-ids=0,1] [--repeats=3] [--out=report.json] [--no-record]
+	python scripts/bench.py compare [base] [head] [--scale=small] [--seed=1]
+		[--map-ids=0,1] [--threshold=0.05] [--confidence=0.95]
+		[--min-seconds=0.05]
+	python scripts/bench.py golden [--scale=small] [--seed=1] [--version=v]
+		[--reference=reference] [--candidate=candidate] [--map-ids=0,1]
+		[--sample=n] [--tile-tolerance=0] [--icon-tolerance=0] [--workers=n]
+	python scripts/bench.py definitions [--scale=small] [--seed=1]
+		[--version=v]
+
+world generates a synthetic world, which run also does when it is missing.
+Scales are tiny, small, medium and large. Squares, instances and icons may be
+overridden with --squares-x, --squares-z, --instances and --icons. The run
+report is written as JSON, by default beside the world, and is recorded
+against the current git commit in the benchmark history unless --no-record
+is given. run and compare both take --history=path to use another history.
+
+compare reads the history for the same world and mapIDs. The head defaults to
+the current commit and the base to the last other commit recorded before it,
+while either may be a git revision. It exits with status 1 if any stage or
+pipeline step is slower beyond the threshold. Stages with too few trials on
+either side are reported as insufficient and never fail the comparison.
+
+golden builds the same mapIDs with two engines and compares their tiles and
+icon placements, exiting with status 1 if they differ. Engines are named
+presets, JSON files of config overrides, directories saved by an earlier
+check, or git revisions, such as --reference=baseline, which are built in a
+worktree. The presets only toggle the options of the current tree. It uses
+the synthetic world unless --version names a real one, and --sample picks
+that many mapIDs at random.
+
+definitions reports the memory held by each kind of loaded definition and
+how long the fastest of several loads takes, on the synthetic world unless
+--version names a real one.
+"""
+from buildWikiMaps import parseArguments
+from benchmarks import synthetic
+from benchmarks import history as benchHistory
+from benchmarks import compare as benchCompare
+
+import json
+import os
+import sys
+
+WORLD_OPTIONS = ("squaresX", "squaresZ", "instances", "icons")
+COMMAND_OPTIONS = {
+	"world": ("scale", "seed"),
+	"run": ("scale", "seed", "stages", "mapIds", "repeats", "out", "noRecord",
+			"history"),
+	"compare": ("scale", "seed", "mapIds", "threshold", "confidence",
+				"minSeconds", "history"),
+	"golden": ("scale", "seed", "version", "reference", "candidate", "mapIds",
+			   "sample", "tileTolerance", "iconTolerance", "workers"),
+	"definitions": ("scale", "seed", "version")
+}
+
+
+def parseMapIDs(mapIds):
+	if not mapIds:
+		return None
+	return [int(mapID) for mapID in str(mapIds).split(",")]
+
+
+def world(scale="small", seed=1, **overrides):
+	return synthetic.generateWorld(scale, int(seed), **overrides)
+
+
+def run(scale="small", seed=1, stages=None, mapIds=None,
+		repeats=benchCompare.MIN_TRIALS, out=None, noRecord=False,
+		history=benchHistory.HISTORY_PATH, **overrides):
+	from benchmarks import stages as benchStages
+	worldPath = world(scale, seed, **overrides)
+	if stages:
+		stages = stages.split(",")
+	report = benchStages.runBenchmarks(worldPath, stages, parseMapIDs(mapIds),
+									   int(repeats))
+	out = out or os.path.join(worldPath, "bench-report.json")
+	with open(out, 'w') as f:
+		json.dump(report, f, indent=2)
+	print(f"Benchmark report saved to {out}")
+	if not noRecord:
+		benchHistory.recordReport(report, history)
+	return report
+
+
+def compare(base=None, head=None, scale="small", seed=1, mapIds=None,
+			threshold=0.05, confidence=0.95, minSeconds=0.05,
+			history=benchHistory.HISTORY_PATH, **overrides):
+	manifest = synthetic.getManifest(scale, int(seed), **overrides)
+	results = benchHistory.loadHistory(manifest, parseMapIDs(mapIds), history)
+
+	head = benchHistory.resolveCommit(head) if head else benchHistory.getCommit()
+	if head not in results:
+		raise SystemExit(f"No results for {head} on this world, "
+						 f"benchmark it with: python scripts/bench.py run")
+	if base:
+		base = benchHistory.resolveCommit(base)
+	else:
+		# The last commit recorded before the head was first recorded
+		commits = list(results)
+		earlier = commits[:commits.index(head)]
+		base = earlier[-1] if earlier else None
+	if base not in results:
+		raise SystemExit(f"No results for base {base} on this world")
+
+	comparison = benchCompare.compareRuns(results[base], results[head],
+										  float(threshold), float(confidence),
+										  float(minSeconds))
+	benchCompare.printComparison(comparison, base, head, float(confidence))
+	slower = [name for name, result in comparison.items()
+			  if result["verdict"] == "SLOWER"]
+	if slower:
+		print(f"Regressions in {', '.join(slower)}")
+		sys.exit(1)
+	return comparison
+
+
+def golden(scale="small", seed=1, version=None, reference="reference",
+		   candidate="candidate", mapIds=None, sample=None, tileTolerance=0,
+		   iconTolerance=0, workers=None, **overrides):
+	from benchmarks import golden as benchGolden
+	if version:
+		worldPath = os.path.join(synthetic.BASE_DIRECTORY, version)
+	else:
+		worldPath = world(scale, seed, **overrides)
+	matched = benchGolden.checkEngines(worldPath, reference, candidate,
+									   parseMapIDs(mapIds), sample,
+									   tileTolerance, iconTolerance, workers,
+									   int(seed))
+	if not matched:
+		sys.exit(1)
+
+
+def definitions(scale="small", seed=1, version=None, **overrides):
+	from benchmarks import definitions as benchDefinitions
+	if version:
+		worldPath = os.path.join(synthetic.BASE_DIRECTORY, version)
+	else:
+		worldPath = world(scale, seed, **overrides)
+	benchDefinitions.benchmarkDefinitions(worldPath)
+
+
+if __name__ == "__main__":
+	command = sys.argv[1]
+	positionalArgs, options = parseArguments(sys.argv[2:])
+	unknown = [name for name in options if name not in WORLD_OPTIONS
+			   and name not in COMMAND_OPTIONS[command]]
+	if unknown:
+		raise SystemExit(f"Unknown options {unknown}")
+	globals()[command](*positionalArgs, **options)
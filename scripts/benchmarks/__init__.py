@@ -0,0 +1,7 @@
+"""
+Offline benchmarks of the map builder on synthetic worlds
+
+synthetic generates a deterministic world in the layout of a cache dump, and
+stages times each stage of the builder on it, and definitions measures the
+memory and load time of the definitions. Run them through bench.py.
+"""
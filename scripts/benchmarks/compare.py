@@ -0,0 +1,97 @@
+"""
+Compares the recorded benchmark trials of two commits stage by stage
+
+Stages, and the pipeline's steps, are compared on the ratio of their mean
+times. A bootstrap confidence interval of that ratio is taken from the trials
+of each commit, so a stage is only called a regression when the whole
+interval lies beyond the threshold, and the difference is more than a minimum
+number of seconds. Noisy stages with few trials therefore widen their own
+interval instead of raising false alarms, and stages with fewer than
+MIN_TRIALS trials on either side are reported as insufficient rather than
+judged at all.
+"""
+import numpy as np
+
+# Resamples of the trials, seeded so a comparison always gives the same result
+RESAMPLES = 4000
+RESAMPLE_SEED = 0
+# Fewer trials than this per commit cannot say much about noise
+MIN_TRIALS = 3
+
+
+def getSamples(stages):
+	# Seconds of each stage, and of each step of stages which report them
+	samples = dict()
+	for stage, trials in stages.items():
+		samples[stage] = [trial["seconds"] for trial in trials]
+		for trial in trials:
+			for step, seconds in trial.get("steps", dict()).items():
+				samples.setdefault(f"{stage}/{step}", list()).append(seconds)
+	return samples
+
+
+def bootstrapRatio(baseSamples, headSamples, confidence):
+	# Confidence interval of mean(head) / mean(base)
+	rng = np.random.default_rng(RESAMPLE_SEED)
+	baseSamples = np.asarray(baseSamples)
+	headSamples = np.asarray(headSamples)
+	baseMeans = rng.choice(baseSamples, (RESAMPLES, len(baseSamples))).mean(1)
+	headMeans = rng.choice(headSamples, (RESAMPLES, len(headSamples))).mean(1)
+	ratios = headMeans / np.maximum(baseMeans, 1e-9)
+	tail = (1 - confidence) / 2
+	low, high = np.quantile(ratios, [tail, 1 - tail])
+	return float(low), float(high)
+
+
+def compareStage(baseSamples, headSamples, threshold, confidence, minSeconds):
+	baseMean = float(np.mean(baseSamples))
+	headMean = float(np.mean(headSamples))
+	low, high = bootstrapRatio(baseSamples, headSamples, confidence)
+	verdict = "same"
+	if min(len(baseSamples), len(headSamples)) < MIN_TRIALS:
+		# A single trial resamples to a zero-width interval
+		verdict = "insufficient"
+	elif low > 1 + threshold and headMean - baseMean > minSeconds:
+		verdict = "SLOWER"
+	elif high < 1 - threshold and baseMean - headMean > minSeconds:
+		verdict = "faster"
+	return {
+		"base": baseMean,
+		"head": headMean,
+		"ratio": headMean / baseMean if baseMean else float("inf"),
+		"interval": (low, high),
+		"trials": (len(baseSamples), len(headSamples)),
+		"verdict": verdict
+	}
+
+
+def compareRuns(baseStages, headStages, threshold=0.05, confidence=0.95,
+				minSeconds=0.05):
+	# Returns the comparison of every stage and step both runs measured
+	baseSamples = getSamples(baseStages)
+	headSamples = getSamples(headStages)
+	# Steps which neither run took any time in, such as restructuring when
+	# empty tiles are culled, did not run at all
+	return {name: compareStage(baseSamples[name], headSamples[name], threshold,
+							   confidence, minSeconds)
+			for name in baseSamples if name in headSamples
+			and max(baseSamples[name] + headSamples[name]) > 0}
+
+
+def printComparison(comparison, baseCommit, headCommit, confidence):
+	interval = f"{confidence:.0%} CI"
+	print(f"{'Stage':<28}{baseCommit[:12]:>14}{headCommit[:12]:>14}"
+		  f"{'Change':>9}{interval:>18}  Verdict")
+	for name, result in comparison.items():
+		# Steps are listed beneath their stage
+		label = f"  {name.split('/')[1]}" if "/" in name else name
+		low, high = result["interval"]
+		print(f"{label:<28}{result['base']:>13.3f}s{result['head']:>13.3f}s"
+			  f"{result['ratio'] - 1:>+9.1%}"
+			  f"{f'[{low - 1:+.1%}, {high - 1:+.1%}]':>18}  {result['verdict']}")
+
+	insufficient = [name for name, result in comparison.items()
+					if result["verdict"] == "insufficient"]
+	if insufficient:
+		print(f"Fewer than {MIN_TRIALS} trials of {', '.join(insufficient)}, "
+			  f"so they were not judged. Use --repeats={MIN_TRIALS} or more")
@@ -0,0 +1,82 @@
+"""
+Measures the memory footprint and load time of the definition classes
+
+Run through bench.py, on a synthetic world or a real version:
+
+	python scripts/bench.py definitions [--scale=small] [--version=v]
+
+The debug mapID's spoofed square definitions, every mapID's square and zone
+definitions and the icon definitions are each loaded several times. The
+fastest load and the memory held by the resulting objects are reported.
+"""
+from config import MapBuilderConfig, GlobalCoordinateDefinition
+
+import tracemalloc
+import json
+import os
+import time
+
+BASE_CONFIG_PATH = "./scripts/mapBuilderConfig.json"
+REPEATS = 5
+MEGABYTE = 1024 ** 2
+
+
+def measureLoad(loadDefinitions):
+	# Returns the object count, the bytes they hold and the fastest load
+	loadTimes = list()
+	for _ in range(REPEATS):
+		startTime = time.perf_counter()
+		definitions = loadDefinitions()
+		loadTimes.append(time.perf_counter() - startTime)
+		del definitions
+
+	tracemalloc.start()
+	definitions = loadDefinitions()
+	heldBytes, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return len(definitions), heldBytes, min(loadTimes)
+
+
+def benchmarkDefinitions(basePath):
+	# The world's benchmark config is used where there is one
+	benchConfigPath = os.path.join(basePath, "benchConfig.json")
+	GlobalCoordinateDefinition.fromJSON(
+		os.path.join(basePath, "coordinateData.json"))
+	MapBuilderConfig.fromJSON(benchConfigPath
+		if os.path.exists(benchConfigPath) else BASE_CONFIG_PATH)
+	CONFIG = MapBuilderConfig()
+	from definitions import SquareDefinition, ZoneDefinition, IconDefinition
+
+	with open(os.path.join(basePath, CONFIG.mapid.mapDefsPath)) as mapDefsFile:
+		mapDefsJSON = json.load(mapDefsFile)
+	iconDefsPath = os.path.join(basePath, CONFIG.icon.iconDefs)
+
+	def loadAllSquares():
+		definitions = list()
+		for mapDefs in mapDefsJSON:
+			definitions.extend(SquareDefinition.squareDefsFromJSON(
+				mapDefs.get("mapSquareDefinitions"), basePath))
+		return definitions
+
+	def loadAllZones():
+		definitions = list()
+		for mapDefs in mapDefsJSON:
+			definitions.extend(ZoneDefinition.zoneDefsFromJSON(
+				mapDefs.get("zoneDefinitions"), basePath))
+		return definitions
+
+	cases = {
+		"spoofed squares": lambda: SquareDefinition.spoofAllSquareDefs(
+			basePath),
+		"map squares": loadAllSquares,
+		"map zones": loadAllZones,
+		"icons": lambda: IconDefinition.iconDefsFromJSON(iconDefsPath)
+	}
+	print(f"{'Definitions':<16}{'Objects':>10}{'Bytes/obj':>11}"
+		  f"{'Objects/MB':>12}{'Load (ms)':>11}")
+	for name, loadDefinitions in cases.items():
+		count, heldBytes, loadTime = measureLoad(loadDefinitions)
+		perObject = heldBytes / count if count else 0
+		perMB = MEGABYTE / perObject if perObject else 0
+		print(f"{name:<16}{count:>10}{perObject:>11.1f}{perMB:>12.0f}"
+			  f"{loadTime*1000:>11.2f}")
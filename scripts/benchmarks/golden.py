@@ -0,0 +1,390 @@
+"""
+Checks that two builder engines produce the same tiles
+
+An engine is a set of configuration overrides, which is how the builder's
+alternative paths are chosen, a directory of outputs saved by an earlier
+check, or a git revision. Overrides only switch the paths which can still be
+toggled in the current tree, so they cannot catch a change made to every path
+at once; comparing against a baseline revision can. Each engine builds the
+same mapIDs of a world in its own spawned process. The tiles are saved both
+before and after icons are drawn, along with where every icon was placed.
+
+A revision is checked out into a temporary git worktree, where its own
+createBaseTiles slices the world's plane images and its own buildAllMapIDs
+builds the whole world from them, as that revision may not have this
+harness or read the base tiles the same way. Only its final tiles are kept,
+so the tiles before icons and the icon placements are not compared.
+
+The two engines' outputs are then compared in parallel: the set of tile
+names, the pixels of each tile, with a tolerance per stage, and the icon
+placements. A heatmap is written for every tile which differs beyond its
+tolerance.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+import subprocess
+import tempfile
+import shutil
+import random
+import json
+import sys
+import os
+
+GOLDEN_DIRECTORY = "golden"
+BASE_CONFIG_PATH = "./scripts/mapBuilderConfig.json"
+# Tiles straight from createMapTiles, then with the icons drawn on them
+STAGES = ("tiles", "icons")
+PLACEMENTS_FILE = "placements.json"
+# Differences listed for each stage before they are summarised
+REPORT_LINES = 10
+# What a revision's build reads from the world, linked into its worktree
+REVISION_INPUTS = ("coordinateData.json", "minimapIcons.json",
+				   "wikiWorldMapDefinitions.json", "user_world_defs.json",
+				   "basemaps.json", "icons", "worldMapCompositeDefinitions",
+				   "fullplanes/base")
+
+# The original paths kept in the builder, against the configured ones
+ENGINES = {
+	"reference": {
+		"COMPOSITE_OPTS": {"fusedStyling": False},
+		"ZOOM_OPTS": {"cullEmptyTiles": False}
+	},
+	"candidate": {},
+	# Fused styling, whatever the configuration chooses
+	"fused": {"COMPOSITE_OPTS": {"fusedStyling": True}}
+}
+
+
+def mergeConfig(configData, overrides):
+	for section, options in overrides.items():
+		configData.setdefault(section, dict()).update(options)
+	return configData
+
+
+def getCommit(revision):
+	# Returns the full hash of a git revision, or None if it is not one
+	result = subprocess.run(["git", "rev-parse", "--verify", "--quiet",
+							 f"{revision}^{{commit}}"],
+							capture_output=True, text=True)
+	return result.stdout.strip() if result.returncode == 0 else None
+
+
+def resolveEngine(spec):
+	# Returns the engine's name, and its overrides, saved directory or commit
+	if spec in ENGINES:
+		return spec, ENGINES[spec], None, None
+	if os.path.isdir(spec):
+		return os.path.basename(os.path.normpath(spec)), None, spec, None
+	if os.path.isfile(spec):
+		with open(spec) as overridesFile:
+			name = os.path.splitext(os.path.basename(spec))[0]
+			return name, json.load(overridesFile), None, None
+	commit = getCommit(spec)
+	if commit is not None:
+		return f"rev-{commit[:12]}", None, None, commit
+	raise ValueError(f"Engine {spec} is not one of {list(ENGINES)}, a file of "
+					 f"config overrides, a saved directory or a git revision")
+
+
+def writeEngineConfig(worldPath, engineDir, overrides):
+	# The world's benchmark config is used where there is one, so synthetic
+	# worlds never pick up the repository's user mapIDs
+	benchConfigPath = os.path.join(worldPath, "benchConfig.json")
+	basePath = benchConfigPath if os.path.exists(benchConfigPath) \
+		else BASE_CONFIG_PATH
+	with open(basePath) as configFile:
+		configData = mergeConfig(json.load(configFile), overrides)
+	# Engines build in-process, from scratch, into their own directory
+	tilesPath = os.path.relpath(os.path.join(engineDir, "icons"), worldPath)
+	mergeConfig(configData, {
+		"DIR_OPTS": {"outPath": tilesPath},
+		"ICON_OPTS": {"mapIDDirectory": tilesPath},
+		"MAPID_OPTS": {"stageCacheEnabled": False},
+		"SCHEDULER_OPTS": {"schedulerEnabled": False}
+	})
+	configPath = os.path.join(engineDir, "config.json")
+	with open(configPath, 'w') as configFile:
+		json.dump(configData, configFile, indent=4)
+	return configPath
+
+
+def getPlacements(mapBuilder, mapID, iconList):
+	# Every tile an icon is drawn on and where, as renderIcons draws them
+	from config import MapBuilderConfig
+	CONFIG = MapBuilderConfig()
+	placements = list()
+	for zoomLevel, hasIcons in CONFIG.icon.zoomLevelHasIcons.items():
+		if not hasIcons:
+			continue
+		for plane, icons in iconList.items():
+			for icon in icons:
+				tiles = [icon.tilePosition[zoomLevel],
+						 *icon.overflowsInto[zoomLevel]]
+				for x, z in tiles:
+					left, top = mapBuilder.getIconPosition(x, z, icon,
+															zoomLevel)
+					placements.append([mapID, zoomLevel, plane, x, z, left, top,
+									   icon.definition.spriteID])
+	return sorted(placements)
+
+
+def buildEngine(worldPath, configPath, engineDir, mapIDs):
+	# Executed inside a spawned process, as the config is a singleton
+	from config import MapBuilderConfig, GlobalCoordinateDefinition
+	GlobalCoordinateDefinition.fromJSON(os.path.join(worldPath,
+													 "coordinateData.json"))
+	MapBuilderConfig.fromJSON(configPath)
+	from buildMapIDs import createIconManager
+	from benchmarks.stages import createMapBuilders
+	iconManager = createIconManager(worldPath)
+
+	placements = list()
+	for mapID, mapBuilder in createMapBuilders(worldPath, mapIDs).items():
+		tilesPath = os.path.join(engineDir, "icons", str(mapID))
+		mapBuilder.createMapTiles(worldPath)
+		if os.path.exists(tilesPath):
+			shutil.copytree(tilesPath, os.path.join(engineDir, "tiles",
+													str(mapID)))
+		iconList = iconManager.getIconsInID(mapBuilder)
+		placements.extend(getPlacements(mapBuilder, mapID, iconList))
+		mapBuilder.renderIcons(tilesPath, iconList)
+	with open(os.path.join(engineDir, PLACEMENTS_FILE), 'w') as f:
+		json.dump(placements, f)
+
+
+def writeRevisionConfig(worldPath, worktreePath):
+	# The revision's own config, with the world's options it also has, as it
+	# rejects options it does not know
+	configPath = os.path.join(worktreePath, BASE_CONFIG_PATH)
+	with open(configPath) as configFile:
+		configData = json.load(configFile)
+	benchConfigPath = os.path.join(worldPath, "benchConfig.json")
+	overrides = dict()
+	if os.path.exists(benchConfigPath):
+		with open(benchConfigPath) as configFile:
+			overrides = json.load(configFile)
+	mergeConfig(overrides, {
+		"MAPID_OPTS": {"stageCacheEnabled": False},
+		"SCHEDULER_OPTS": {"schedulerEnabled": False}
+	})
+	for section, options in overrides.items():
+		if section in configData:
+			configData[section].update({option: value for option, value
+										in options.items()
+										if option in configData[section]})
+	with open(configPath, 'w') as configFile:
+		json.dump(configData, configFile, indent=4)
+	return configData
+
+
+def buildRevision(commit, worldPath, engineDir, mapIDs):
+	# Builds the whole world with the revision's own builder in a worktree
+	worktreePath = tempfile.mkdtemp(prefix="golden-")
+	subprocess.run(["git", "worktree", "add", "--detach", worktreePath,
+					commit], check=True)
+	try:
+		version = os.path.basename(os.path.normpath(worldPath))
+		versionPath = os.path.join(worktreePath, "osrs-wiki-maps", "out",
+								   "mapgen", "versions", version)
+		for inputName in REVISION_INPUTS:
+			inputPath = os.path.join(worldPath, inputName)
+			if os.path.exists(inputPath):
+				linkPath = os.path.join(versionPath, inputName)
+				os.makedirs(os.path.dirname(linkPath), exist_ok=True)
+				os.symlink(os.path.abspath(inputPath), linkPath)
+		configData = writeRevisionConfig(worldPath, worktreePath)
+		for step in ("createBaseTiles", "buildAllMapIDs"):
+			subprocess.run([sys.executable, "scripts/buildWikiMaps.py", step,
+							version], cwd=worktreePath, check=True)
+		tilesPath = os.path.join(versionPath, configData["DIR_OPTS"]["outPath"])
+		for mapID in mapIDs:
+			mapIDPath = os.path.join(tilesPath, str(mapID))
+			if os.path.exists(mapIDPath):
+				shutil.copytree(mapIDPath, os.path.join(engineDir, "icons",
+														str(mapID)))
+	finally:
+		subprocess.run(["git", "worktree", "remove", "--force",
+						worktreePath])
+		shutil.rmtree(worktreePath, ignore_errors=True)
+
+
+def prepareEngine(spec, worldPath, mapIDs):
+	# Returns the directory holding the engine's outputs
+	name, overrides, savedDir, commit = resolveEngine(spec)
+	if savedDir is not None:
+		return name, savedDir
+	engineDir = os.path.join(worldPath, GOLDEN_DIRECTORY, name)
+	shutil.rmtree(engineDir, ignore_errors=True)
+	os.makedirs(engineDir)
+	if commit is not None:
+		print(f"Building every mapID at {commit[:12]} to compare "
+			  f"{len(mapIDs)} of them")
+		buildRevision(commit, worldPath, engineDir, mapIDs)
+		return name, engineDir
+	configPath = writeEngineConfig(worldPath, engineDir, overrides)
+	print(f"Building {len(mapIDs)} mapIDs with the {name} engine")
+	from pyvips_import import getSpawnContext
+	with ProcessPoolExecutor(1, mp_context=getSpawnContext()) as pool:
+		pool.submit(buildEngine, worldPath, configPath, engineDir,
+					mapIDs).result()
+	return name, engineDir
+
+
+def listTiles(stageDir):
+	tiles = set()
+	for directory, _, fileNames in os.walk(stageDir):
+		for fileName in fileNames:
+			if fileName.endswith(".png"):
+				path = os.path.join(directory, fileName)
+				tiles.add(os.path.relpath(path, stageDir))
+	return tiles
+
+
+def compareTile(referencePath, candidatePath, tolerance, heatmapPath):
+	# Returns the largest channel difference and the pixels beyond tolerance
+	from pyvips_import import pyvips as pv
+	import numpy as np
+	reference = pv.Image.new_from_file(referencePath).numpy()
+	candidate = pv.Image.new_from_file(candidatePath).numpy()
+	if reference.shape != candidate.shape:
+		return None, None
+	difference = np.abs(reference.astype(np.int16) - candidate)
+	if difference.ndim == 3:
+		difference = difference.max(axis=2)
+	maxDifference = int(difference.max())
+	differingPixels = int((difference > tolerance).sum())
+	if differingPixels:
+		# Brighter and redder is further apart, scaled to this tile's worst
+		heat = (difference.astype(np.uint16) * 255 // maxDifference)
+		os.makedirs(os.path.dirname(heatmapPath), exist_ok=True)
+		pv.Image.new_from_array(heat.astype(np.uint8)).falsecolour() \
+			.write_to_file(heatmapPath)
+	return maxDifference, differingPixels
+
+
+def compareTileJob(job):
+	return job[0], compareTile(*job[1:])
+
+
+def compareStage(stage, referenceDir, candidateDir, tolerance, reportDir,
+				 workers):
+	referenceTiles = listTiles(os.path.join(referenceDir, stage))
+	candidateTiles = listTiles(os.path.join(candidateDir, stage))
+	jobs = [(tile, os.path.join(referenceDir, stage, tile),
+			 os.path.join(candidateDir, stage, tile), tolerance,
+			 os.path.join(reportDir, stage, tile))
+			for tile in sorted(referenceTiles & candidateTiles)]
+	from pyvips_import import getSpawnContext
+	with getSpawnContext().Pool(workers) as pool:
+		results = dict(pool.imap_unordered(compareTileJob, jobs, chunksize=16))
+	return {
+		"compared": len(jobs),
+		"missing": sorted(referenceTiles - candidateTiles),
+		"extra": sorted(candidateTiles - referenceTiles),
+		"results": results
+	}
+
+
+def comparePlacements(referenceDir, candidateDir):
+	placements = list()
+	for engineDir in (referenceDir, candidateDir):
+		with open(os.path.join(engineDir, PLACEMENTS_FILE)) as f:
+			placements.append({tuple(placement) for placement in json.load(f)})
+	reference, candidate = placements
+	return {
+		"compared": len(reference),
+		"missing": sorted(reference - candidate),
+		"extra": sorted(candidate - reference)
+	}
+
+
+def printNames(label, names):
+	if names:
+		shown = ", ".join(str(name) for name in names[:REPORT_LINES])
+		more = f" and {len(names) - REPORT_LINES} more" \
+			if len(names) > REPORT_LINES else ""
+		print(f"  {label} ({len(names)}): {shown}{more}")
+
+
+def printStage(stage, comparison, tolerance, reportDir) -> bool:
+	# Returns whether the stage matched
+	results = comparison["results"]
+	mismatched = [tile for tile, (maxDifference, _) in results.items()
+				  if maxDifference is None]
+	differing = {tile: result for tile, result in results.items()
+				 if result[1]}
+	worst = max((maxDifference for maxDifference, _ in results.values()
+				 if maxDifference is not None), default=0)
+	print(f"{stage}: {comparison['compared']} tiles, "
+		  f"{len(comparison['missing'])} missing, "
+		  f"{len(comparison['extra'])} extra, {len(differing)} differ beyond "
+		  f"{tolerance} (largest difference {worst})")
+	printNames("missing", comparison["missing"])
+	printNames("extra", comparison["extra"])
+	printNames("different size", sorted(mismatched))
+
+	# Differing tiles are grouped by mapID and zoom level, worst first
+	groups = defaultdict(list)
+	for tile, result in differing.items():
+		mapID, zoomLevel, _ = tile.split(os.sep)
+		groups[(mapID, zoomLevel)].append((result[1], result[0], tile))
+	for (mapID, zoomLevel), tiles in sorted(
+			groups.items(), key=lambda item: -len(item[1]))[:REPORT_LINES]:
+		pixels, maxDifference, tile = max(tiles)
+		print(f"  mapID {mapID} zoom {zoomLevel}: {len(tiles)} tiles, worst "
+			  f"{os.path.basename(tile)} with {pixels}px up to {maxDifference}")
+	if differing:
+		print(f"  heatmaps in {os.path.join(reportDir, stage)}")
+	return not (comparison["missing"] or comparison["extra"] or mismatched
+				or differing)
+
+
+def selectMapIDs(worldPath, configPath, mapIDs, sample, seed):
+	# Every mapID of the world, those given, or a seeded sample of them
+	if mapIDs is not None:
+		return mapIDs
+	from config import MapBuilderConfig
+	MapBuilderConfig.fromJSON(configPath)
+	from buildMapIDs import loadRenderPlanFromJSON
+	allMapIDs = sorted(loadRenderPlanFromJSON(worldPath))
+	if sample and int(sample) < len(allMapIDs):
+		return sorted(random.Random(seed).sample(allMapIDs, int(sample)))
+	return allMapIDs
+
+
+def checkEngines(worldPath, reference="reference", candidate="candidate",
+				 mapIDs=None, sample=None, tileTolerance=0, iconTolerance=0,
+				 workers=None, seed=1) -> bool:
+	# Returns whether the candidate engine matched the reference
+	benchConfigPath = os.path.join(worldPath, "benchConfig.json")
+	configPath = benchConfigPath if os.path.exists(benchConfigPath) \
+		else BASE_CONFIG_PATH
+	mapIDs = selectMapIDs(worldPath, configPath, mapIDs, sample, seed)
+	_, referenceDir = prepareEngine(reference, worldPath, mapIDs)
+	_, candidateDir = prepareEngine(candidate, worldPath, mapIDs)
+
+	reportDir = os.path.join(worldPath, GOLDEN_DIRECTORY, "report")
+	shutil.rmtree(reportDir, ignore_errors=True)
+	workers = int(workers or os.cpu_count() or 1)
+	tolerances = {"tiles": int(tileTolerance), "icons": int(iconTolerance)}
+	matched = True
+	# Revision builds only keep their final tiles
+	complete = all(os.path.exists(os.path.join(engineDir, PLACEMENTS_FILE))
+				   for engineDir in (referenceDir, candidateDir))
+	for stage in STAGES if complete else STAGES[-1:]:
+		comparison = compareStage(stage, referenceDir, candidateDir,
+								  tolerances[stage], reportDir, workers)
+		matched &= printStage(stage, comparison, tolerances[stage], reportDir)
+
+	if not complete:
+		print("placements: not saved by a revision build, skipped")
+	else:
+		placements = comparePlacements(referenceDir, candidateDir)
+		print(f"placements: {placements['compared']} icon placements, "
+			  f"{len(placements['missing'])} missing, "
+			  f"{len(placements['extra'])} extra")
+		printNames("missing", placements["missing"])
+		printNames("extra", placements["extra"])
+		matched &= not (placements["missing"] or placements["extra"])
+	print("Engines match" if matched else "Engines differ")
+	return matched
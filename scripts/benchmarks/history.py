@@ -0,0 +1,71 @@
+"""
+Keeps benchmark reports by the git commit they were measured on
+
+Every run is appended to a local JSON lines file, keyed by the short hash of
+HEAD, with "+dirty" added when tracked files have uncommitted changes. Runs of
+the same commit on the same world accumulate, so repeating a run adds trials
+to the comparison rather than replacing them.
+"""
+import subprocess
+import json
+import os
+
+HISTORY_PATH = "osrs-wiki-maps/out/mapgen/bench-history.jsonl"
+
+
+def runGit(*args):
+	return subprocess.run(["git", *args], capture_output=True, text=True,
+						  check=True).stdout.strip()
+
+
+def getCommit():
+	# Returns None outside of a git repository
+	try:
+		commit = runGit("rev-parse", "--short=12", "HEAD")
+		dirty = runGit("status", "--porcelain", "--untracked-files=no")
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	return f"{commit}+dirty" if dirty else commit
+
+
+def resolveCommit(revision):
+	# Accepts anything git does, such as HEAD~1 or a branch, as well as a
+	# recorded key. Keys which git does not know are returned as they are
+	if revision.endswith("+dirty"):
+		return revision
+	try:
+		return runGit("rev-parse", "--short=12", revision)
+	except (OSError, subprocess.CalledProcessError):
+		return revision
+
+
+def recordReport(report, historyPath=HISTORY_PATH):
+	commit = getCommit()
+	if commit is None:
+		print("Not in a git repository, the report was not recorded")
+		return None
+	os.makedirs(os.path.dirname(historyPath) or ".", exist_ok=True)
+	with open(historyPath, 'a') as historyFile:
+		historyFile.write(json.dumps({"commit": commit, "report": report}) + "\n")
+	print(f"Recorded results for {commit} in {historyPath}")
+	return commit
+
+
+def loadHistory(world, mapIDs=None, historyPath=HISTORY_PATH):
+	# Returns the trials of each stage by commit, in the order commits were
+	# first recorded, for runs on the same world and mapIDs
+	history = dict()
+	if not os.path.exists(historyPath):
+		return history
+	with open(historyPath) as historyFile:
+		for line in historyFile:
+			if not line.strip():
+				continue
+			entry = json.loads(line)
+			report = entry["report"]
+			if report["world"] != world or report["mapIDs"] != mapIDs:
+				continue
+			stages = history.setdefault(entry["commit"], dict())
+			for stage, trials in report["stages"].items():
+				stages.setdefault(stage, list()).extend(trials)
+	return history
@@ -0,0 +1,285 @@
+"""
+Times each stage of the map builder on a synthetic world
+
+Every stage runs in its own spawned process, which loads the world's
+benchmark configuration, prepares whatever the stage consumes without timing
+it, then times the stage alone. The process's peak resident memory and the
+files the stage wrote are reported with the time, so that stages can be
+compared across commits without one stage's memory hiding another's.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import platform
+import shutil
+import json
+import time
+import sys
+import os
+
+MEGABYTE = 1024 ** 2
+
+# The work directory builders use for their intermediate files
+WORK_DIRECTORY = "bench-work"
+
+# MapBuilder methods timed by the pipeline stage, and the step they belong to
+PIPELINE_STEPS = {
+	"renderPlane": "plane assembly",
+	"compositePlane": "composite",
+	"rescaleImages": "rescale",
+	"saveOccupiedTiles": "tile",
+	"tileImage": "tile",
+	"renderIcons": "icon insertion",
+	"restructureDirectory": "restructure"
+}
+
+
+def getPeakRSS():
+	# Peak resident memory of this process and any processes it waited on,
+	# in bytes. Returns None where the platform does not report it
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	# Linux reports kilobytes, while macOS reports bytes
+	return peak if sys.platform == "darwin" else peak * 1024
+
+
+def listFiles(worldPath):
+	files = dict()
+	for directory, _, fileNames in os.walk(worldPath):
+		for fileName in fileNames:
+			path = os.path.join(directory, fileName)
+			try:
+				stat = os.stat(path)
+			except FileNotFoundError:
+				continue
+			files[path] = (stat.st_size, stat.st_mtime_ns)
+	return files
+
+
+def countWrittenFiles(before, after):
+	# Files which are new or changed, and their total size
+	written = [path for path, fileState in after.items()
+			   if before.get(path) != fileState]
+	return len(written), sum(after[path][0] for path in written)
+
+
+### Stages
+# Each prepares its inputs and returns the function to be timed
+
+def prepareCreateBaseTiles(worldPath, mapIDs):
+	import buildWikiMaps
+	version = os.path.basename(worldPath)
+	return lambda: buildWikiMaps.createBaseTiles(version)
+
+
+def prepareMapDefsManager(worldPath, mapIDs):
+	from buildMapIDs import loadMapIDDefinitions, loadRenderPlan
+	from managers import MapDefsManager
+	renderPlan = selectMapIDs(loadRenderPlan(worldPath), mapIDs)
+
+	def run():
+		for mapID, mapDefs in renderPlan.items():
+			squareDefs, zoneDefs = loadMapIDDefinitions(mapID, mapDefs,
+														worldPath)
+			MapDefsManager(squareDefs, zoneDefs)
+	return run
+
+
+def prepareCreateMapTiles(worldPath, mapIDs):
+	builders = createMapBuilders(worldPath, mapIDs)
+
+	def run():
+		for mapBuilder in builders.values():
+			mapBuilder.createMapTiles(worldPath)
+	return run
+
+
+def prepareGetIconsInID(worldPath, mapIDs):
+	from buildMapIDs import createIconManager
+	iconManager = createIconManager(worldPath)
+	builders = createMapBuilders(worldPath, mapIDs)
+
+	def run():
+		for mapBuilder in builders.values():
+			iconManager.getIconsInID(mapBuilder)
+	return run
+
+
+def prepareRenderIcons(worldPath, mapIDs):
+	from buildMapIDs import createIconManager
+	from config import MapBuilderConfig
+	CONFIG = MapBuilderConfig()
+	iconManager = createIconManager(worldPath)
+	builders = createMapBuilders(worldPath, mapIDs)
+	iconLists = dict()
+	for mapID, mapBuilder in builders.items():
+		mapBuilder.createMapTiles(worldPath)
+		iconLists[mapID] = iconManager.getIconsInID(mapBuilder)
+
+	def run():
+		for mapID, mapBuilder in builders.items():
+			mapIDPath = os.path.join(worldPath, CONFIG.icon.mapIDDirectory,
+									 str(mapID))
+			mapBuilder.renderIcons(mapIDPath, iconLists[mapID])
+	return run
+
+
+def prepareBuildMapID(worldPath, mapIDs):
+	import buildMapIDs
+	renderPlan = selectMapIDs(buildMapIDs.loadRenderPlan(worldPath), mapIDs)
+	iconManager = buildMapIDs.createIconManager(worldPath)
+	tempPath = os.path.join(worldPath, WORK_DIRECTORY)
+
+	def run():
+		for mapID, mapDefs in renderPlan.items():
+			buildMapIDs.buildMapID(mapID, worldPath, mapDefs, iconManager,
+								   tempPath=os.path.join(tempPath, str(mapID)))
+	return run
+
+
+def timePipelineSteps(MapBuilder, stepTimes):
+	# Wraps the builder's methods to add the time spent in each to its step.
+	# The trial's process is discarded afterwards, so they are never restored
+	def wrap(method, step):
+		def timedMethod(*args, **kwargs):
+			startTime = time.perf_counter()
+			result = method(*args, **kwargs)
+			# Rescaling is lazy, so the image is computed here rather than
+			# being counted as part of slicing it
+			if step == "rescale" and result is not args[1]:
+				result = result.copy_memory()
+			stepTimes[step] += time.perf_counter() - startTime
+			return result
+		return timedMethod
+
+	for methodName, step in PIPELINE_STEPS.items():
+		stepTimes.setdefault(step, 0.0)
+		setattr(MapBuilder, methodName,
+				wrap(getattr(MapBuilder, methodName), step))
+
+
+def preparePipeline(worldPath, mapIDs):
+	# buildMapID, broken down into the steps of the builder's pipeline
+	import buildMapIDs
+	stepTimes = dict()
+	timePipelineSteps(buildMapIDs.MapBuilder, stepTimes)
+	run = prepareBuildMapID(worldPath, mapIDs)
+
+	def runPipeline():
+		run()
+		return stepTimes
+	return runPipeline
+
+
+STAGES = {
+	"createBaseTiles": prepareCreateBaseTiles,
+	"MapDefsManager": prepareMapDefsManager,
+	"createMapTiles": prepareCreateMapTiles,
+	"getIconsInID": prepareGetIconsInID,
+	"renderIcons": prepareRenderIcons,
+	"buildMapID": prepareBuildMapID,
+	"pipeline": preparePipeline
+}
+
+
+def selectMapIDs(renderPlan, mapIDs):
+	if mapIDs is None:
+		return renderPlan
+	return {mapID: renderPlan[mapID] for mapID in mapIDs}
+
+
+def createMapBuilders(worldPath, mapIDs):
+	from buildMapIDs import MapBuilder, loadMapIDDefinitions, loadRenderPlan
+	from managers import MapDefsManager
+	renderPlan = selectMapIDs(loadRenderPlan(worldPath), mapIDs)
+	builders = dict()
+	for mapID, mapDefs in renderPlan.items():
+		squareDefs, zoneDefs = loadMapIDDefinitions(mapID, mapDefs, worldPath)
+		tempPath = os.path.join(worldPath, WORK_DIRECTORY, str(mapID))
+		builders[mapID] = MapBuilder(MapDefsManager(squareDefs, zoneDefs),
+									 mapID, tempPath)
+	return builders
+
+
+def clearOutputs(worldPath):
+	# Each stage starts from the generated inputs alone
+	from config import MapBuilderConfig
+	CONFIG = MapBuilderConfig()
+	for outPath in (CONFIG.mapid.mapIDoutPath, WORK_DIRECTORY):
+		shutil.rmtree(os.path.join(worldPath, outPath), ignore_errors=True)
+
+
+def runStage(stage, worldPath, mapIDs):
+	# Executed inside a spawned process for each stage and trial
+	from config import MapBuilderConfig, GlobalCoordinateDefinition
+	GlobalCoordinateDefinition.fromJSON(os.path.join(worldPath,
+													 "coordinateData.json"))
+	MapBuilderConfig.fromJSON(os.path.join(worldPath, "benchConfig.json"))
+	clearOutputs(worldPath)
+	run = STAGES[stage](worldPath, mapIDs)
+
+	filesBefore = listFiles(worldPath)
+	startTime = time.perf_counter()
+	steps = run()
+	seconds = time.perf_counter() - startTime
+	filesWritten, bytesWritten = countWrittenFiles(filesBefore,
+												   listFiles(worldPath))
+	clearOutputs(worldPath)
+	trial = {
+		"seconds": seconds,
+		"peakRSS": getPeakRSS(),
+		"filesWritten": filesWritten,
+		"bytesWritten": bytesWritten
+	}
+	# Stages which break their time down return the seconds of each step
+	if steps:
+		trial["steps"] = steps
+	return trial
+
+
+def getEnvironment():
+	from pyvips_import import pyvips as pv
+	return {
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"cpuCount": os.cpu_count(),
+		"libvips": ".".join(str(pv.version(i)) for i in range(3))
+	}
+
+
+def runBenchmarks(worldPath, stages=None, mapIDs=None, repeats=1):
+	# Returns the report of every trial of every stage
+	stages = stages or list(STAGES)
+	unknown = [stage for stage in stages if stage not in STAGES]
+	if unknown:
+		raise ValueError(f"Unknown stages {unknown}, expected some of "
+						 f"{list(STAGES)}")
+
+	with open(os.path.join(worldPath, "synthetic.json")) as manifestFile:
+		world = json.load(manifestFile)
+	report = {
+		"world": world,
+		"mapIDs": mapIDs,
+		"environment": getEnvironment(),
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"stages": dict()
+	}
+	from pyvips_import import getSpawnContext
+	context = getSpawnContext()
+	for stage in stages:
+		trials = list()
+		for _ in range(repeats):
+			# A fresh process per trial, whose peak memory is the stage's own
+			with ProcessPoolExecutor(1, mp_context=context) as pool:
+				trials.append(pool.submit(runStage, stage, worldPath,
+										  mapIDs).result())
+		report["stages"][stage] = trials
+		fastest = min(trials, key=lambda trial: trial["seconds"])
+		peakRSS = fastest["peakRSS"]
+		peakRSS = f"{peakRSS / MEGABYTE:.0f}MB" if peakRSS else "n/a"
+		print(f"{stage:<16}{fastest['seconds']:>9.2f}s{peakRSS:>10}"
+			  f"{fastest['filesWritten']:>8} files"
+			  f"{fastest['bytesWritten'] / MEGABYTE:>9.1f}MB")
+	return report
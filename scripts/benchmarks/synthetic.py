@@ -0,0 +1,292 @@
+"""
+Generates a deterministic synthetic world in the layout of a cache dump
+
+Everything the map builder reads from a real dump is written: the coordinate
+data, the full plane images and the base tiles sliced from them, the map
+definitions with square, zone and rectangle (region) definitions, the
+minimap icon definitions and the icon sprites. The same scale and seed
+always produce byte-identical inputs, so benchmark runs on different commits
+or machines are comparable.
+"""
+from pyvips_import import pyvips as pv
+
+import numpy as np
+import json
+import os
+
+BASE_DIRECTORY = "osrs-wiki-maps/out/mapgen/versions"
+
+# Squares across and up, mapIDs made of zones and regions, and icons
+SCALES = {
+	"tiny": {"squaresX": 6, "squaresZ": 6, "instances": 4, "icons": 200},
+	"small": {"squaresX": 16, "squaresZ": 16, "instances": 12, "icons": 2000},
+	"medium": {"squaresX": 40, "squaresZ": 40, "instances": 30, "icons": 12000},
+	"large": {"squaresX": 96, "squaresZ": 96, "instances": 80, "icons": 60000}
+}
+SPRITE_COUNT = 24
+SPRITE_SIZE = 15
+LOWER_SQUARE_X = 16
+LOWER_SQUARE_Z = 0
+SQUARE_PX = 256
+ZONE_PX = 32
+ZONES = 8
+PLANES = 4
+
+# Squares above plane 0 hold buildings only some of the time
+UPPER_PLANE_FILL = 0.4
+# Instances are displayed apart from the world, as they are in the game
+INSTANCE_OFFSET_X = 40
+# Raised whenever the files written change, so older worlds are regenerated.
+# Format 2 base tiles carry a coverage band
+WORLD_FORMAT = 2
+
+
+def getWorldVersion(scale, seed=1):
+	return f"synthetic-{scale}-{seed}"
+
+
+def getWorldPath(scale, seed=1):
+	return os.path.join(BASE_DIRECTORY, getWorldVersion(scale, seed))
+
+
+def getCoordinateData(squaresX, squaresZ):
+	upperX = LOWER_SQUARE_X + squaresX - 1
+	upperZ = LOWER_SQUARE_Z + squaresZ - 1
+	return {
+		"minSquareX": LOWER_SQUARE_X,
+		"maxSquareX": upperX,
+		"minSquareY": LOWER_SQUARE_Z,
+		"maxSquareY": upperZ,
+		"minTileX": LOWER_SQUARE_X * 64,
+		"maxTileX": (upperX + 1) * 64,
+		"minTileY": LOWER_SQUARE_Z * 64,
+		"maxTileY": (upperZ + 1) * 64,
+		"squareTileLength": 64,
+		"squarePixelLength": SQUARE_PX,
+		"squareZoneLength": ZONES,
+		"zoneTileLength": 8,
+		"zonePixelLength": ZONE_PX,
+		"tilePixelLength": 4
+	}
+
+
+def renderSquare(rng, planeNum):
+	# Terrain is a colour per zone with per-pixel noise, so it compresses
+	# roughly like real tiles. Upper planes are rectangles of building on
+	# the transparent (black) background, which the coverage band leaves out
+	zoneColours = rng.integers(40, 220, (ZONES, ZONES, 3))
+	square = zoneColours.repeat(ZONE_PX, 0).repeat(ZONE_PX, 1)
+	square = square + rng.integers(-12, 13, (SQUARE_PX, SQUARE_PX, 3))
+	square = np.clip(square, 1, 255).astype(np.uint8)
+	mask = np.ones((SQUARE_PX, SQUARE_PX), dtype=bool)
+	if planeNum > 0:
+		mask[...] = False
+		for _ in range(rng.integers(1, 5)):
+			x, z = rng.integers(0, SQUARE_PX - 32, 2)
+			width, height = rng.integers(16, 128, 2)
+			mask[z:z+height, x:x+width] = True
+		square[~mask] = 0
+	return np.dstack((square, mask.astype(np.uint8) * 255))
+
+
+def writeImage(array, path):
+	pv.Image.new_from_array(array, interpretation="srgb").write_to_file(path)
+
+
+def writePlanes(rng, worldPath, squaresX, squaresZ):
+	# Base tiles are written square by square with their coverage band, as
+	# createBaseTiles slices them, and the full plane images are joined from
+	# their colour without holding a whole plane in memory
+	tilePath = os.path.join(worldPath, "tiles/base/2")
+	planePath = os.path.join(worldPath, "fullplanes/base")
+	os.makedirs(tilePath, exist_ok=True)
+	os.makedirs(planePath, exist_ok=True)
+	blank = pv.Image.black(SQUARE_PX, SQUARE_PX, bands=3)
+	blank = blank.copy(interpretation="srgb")
+	upperZ = LOWER_SQUARE_Z + squaresZ - 1
+	for planeNum in range(PLANES):
+		squareImages = dict()
+		for x in range(LOWER_SQUARE_X, LOWER_SQUARE_X + squaresX):
+			for z in range(LOWER_SQUARE_Z, upperZ + 1):
+				if planeNum > 0 and rng.random() > UPPER_PLANE_FILL:
+					continue
+				squarePath = os.path.join(tilePath, f"{planeNum}_{x}_{z}.png")
+				writeImage(renderSquare(rng, planeNum), squarePath)
+				squareImages[(x, z)] = squarePath
+
+		# Plane images span every square from 0 up, like the cache dump
+		rows = list()
+		for z in range(upperZ, -1, -1):
+			for x in range(LOWER_SQUARE_X, LOWER_SQUARE_X + squaresX):
+				if (x, z) in squareImages:
+					square = pv.Image.new_from_file(squareImages[(x, z)])
+					rows.append(square.extract_band(0, n=3))
+				else:
+					rows.append(blank)
+		planeImage = pv.Image.arrayjoin(rows, across=squaresX)
+		planeImage.write_to_file(os.path.join(planePath, f"plane_{planeNum}.png"))
+
+
+def squareDefinition(groupId, source, display, minLevel, levels):
+	return {
+		"groupId": groupId,
+		"fileId": 0,
+		"minLevel": int(minLevel),
+		"levels": int(levels),
+		"sourceSquareX": int(source[0]),
+		"sourceSquareZ": int(source[1]),
+		"displaySquareX": int(display[0]),
+		"displaySquareZ": int(display[1])
+	}
+
+
+def zoneDefinition(groupId, source, display, sourceZone, displayZone,
+				   minLevel, levels):
+	zoneDef = squareDefinition(groupId, source, display, minLevel, levels)
+	zoneDef.update({
+		"sourceZoneX": int(sourceZone[0]),
+		"sourceZoneZ": int(sourceZone[1]),
+		"displayZoneX": int(displayZone[0]),
+		"displayZoneZ": int(displayZone[1])
+	})
+	return zoneDef
+
+
+def createMapDefinitions(rng, squaresX, squaresZ, instances):
+	# The surface (0) shows every square in place. Instances copy zones,
+	# or rectangles of zones, of random squares to a display area apart
+	# from the world, and a few mapIDs move whole squares
+	worldSquares = [(x, z) for x in range(LOWER_SQUARE_X, LOWER_SQUARE_X + squaresX)
+					for z in range(LOWER_SQUARE_Z, LOWER_SQUARE_Z + squaresZ)]
+	surface = {
+		"fileId": 0,
+		"name": "Surface",
+		"mapSquareDefinitions": [squareDefinition(0, square, square, 0, PLANES)
+								 for square in worldSquares],
+		"zoneDefinitions": []
+	}
+	mapDefs = [surface]
+	displayX = LOWER_SQUARE_X + squaresX + INSTANCE_OFFSET_X
+	for instance in range(instances):
+		mapID = instance + 1
+		mapDef = {"fileId": mapID, "name": f"Instance {mapID} (synthetic)",
+				  "mapSquareDefinitions": [], "zoneDefinitions": [],
+				  "regionDefinitions": []}
+		displayZ = LOWER_SQUARE_Z + 2 * instance
+		for displaySquareX in range(displayX, displayX + rng.integers(1, 4)):
+			display = (displaySquareX, displayZ)
+			source = worldSquares[rng.integers(len(worldSquares))]
+			levels = rng.integers(1, PLANES + 1)
+			style = instance % 3
+			if style == 0:
+				# Individual zones, as dungeon instances are made
+				for i in range(ZONES):
+					for j in range(ZONES):
+						if rng.random() < 0.3:
+							continue
+						sourceZone = rng.integers(0, ZONES, 2)
+						mapDef["zoneDefinitions"].append(zoneDefinition(
+							instance, source, display, sourceZone, (i, j),
+							0, levels))
+			elif style == 1:
+				# Rectangles of zones
+				zoneWidth, zoneHeight = rng.integers(2, ZONES + 1, 2)
+				regionDef = zoneDefinition(instance, source, display,
+										   (0, 0), (0, 0), 0, levels)
+				regionDef.update({"squareWidth": 1, "squareHeight": 1,
+								  "zoneWidth": int(zoneWidth),
+								  "zoneHeight": int(zoneHeight)})
+				mapDef["regionDefinitions"].append(regionDef)
+			else:
+				mapDef["mapSquareDefinitions"].append(squareDefinition(
+					instance, source, display, 0, levels))
+		mapDefs.append(mapDef)
+	return mapDefs
+
+
+def createIcons(rng, worldPath, squaresX, squaresZ, iconCount):
+	iconPath = os.path.join(worldPath, "icons")
+	os.makedirs(iconPath, exist_ok=True)
+	# Sprites are discs, fully opaque or fully transparent like the game's
+	radius = SPRITE_SIZE / 2
+	z, x = np.mgrid[0:SPRITE_SIZE, 0:SPRITE_SIZE] + 0.5
+	disc = (x - radius) ** 2 + (z - radius) ** 2 <= radius ** 2
+	for spriteID in range(SPRITE_COUNT):
+		sprite = np.zeros((SPRITE_SIZE, SPRITE_SIZE, 4), dtype=np.uint8)
+		sprite[disc, :3] = rng.integers(0, 256, 3)
+		sprite[disc, 3] = 255
+		writeImage(sprite, os.path.join(iconPath, f"{spriteID}.png"))
+
+	icons = list()
+	for _ in range(iconCount):
+		icons.append({
+			"position": {
+				"x": int(rng.integers(LOWER_SQUARE_X * 64,
+									  (LOWER_SQUARE_X + squaresX) * 64)),
+				"y": int(rng.integers(LOWER_SQUARE_Z * 64,
+									  (LOWER_SQUARE_Z + squaresZ) * 64)),
+				"z": int(rng.integers(0, PLANES))
+			},
+			"spriteId": int(rng.integers(0, SPRITE_COUNT))
+		})
+	return icons
+
+
+def writeJSON(data, path):
+	with open(path, 'w') as f:
+		json.dump(data, f)
+
+
+def writeBenchmarkConfig(worldPath, configPath="./scripts/mapBuilderConfig.json"):
+	# Benchmarks build in-process, from scratch every time, and never pick
+	# up the repository's own user mapIDs
+	with open(configPath) as configFile:
+		configData = json.load(configFile)
+	userMapDefsPath = os.path.join(worldPath, "user_world_defs.json")
+	writeJSON([], userMapDefsPath)
+	configData["MAPID_OPTS"]["userMapDefsPath"] = userMapDefsPath
+	configData["MAPID_OPTS"]["stageCacheEnabled"] = False
+	configData["SCHEDULER_OPTS"]["schedulerEnabled"] = False
+	benchConfigPath = os.path.join(worldPath, "benchConfig.json")
+	writeJSON(configData, benchConfigPath)
+	return benchConfigPath
+
+
+def getManifest(scale="small", seed=1, **overrides):
+	# Everything which decides the contents of a world
+	options = dict(SCALES[scale])
+	options.update({name: int(value) for name, value in overrides.items()})
+	return {"format": WORLD_FORMAT, "scale": scale, "seed": int(seed),
+			**options}
+
+
+def generateWorld(scale="small", seed=1, **overrides):
+	# Returns the path of the world, which is only generated once
+	manifest = getManifest(scale, seed, **overrides)
+	options = {name: manifest[name] for name in SCALES[scale]}
+	worldPath = getWorldPath(scale, seed)
+	manifestPath = os.path.join(worldPath, "synthetic.json")
+	if os.path.exists(manifestPath):
+		with open(manifestPath) as manifestFile:
+			if json.load(manifestFile) == manifest:
+				# The builder's options may have changed since
+				writeBenchmarkConfig(worldPath)
+				return worldPath
+
+	rng = np.random.default_rng(int(seed))
+	squaresX, squaresZ = options["squaresX"], options["squaresZ"]
+	os.makedirs(worldPath, exist_ok=True)
+	writeJSON(getCoordinateData(squaresX, squaresZ),
+			  os.path.join(worldPath, "coordinateData.json"))
+	writePlanes(rng, worldPath, squaresX, squaresZ)
+	writeJSON(createMapDefinitions(rng, squaresX, squaresZ,
+								   options["instances"]),
+			  os.path.join(worldPath, "wikiWorldMapDefinitions.json"))
+	writeJSON(createIcons(rng, worldPath, squaresX, squaresZ,
+						  options["icons"]),
+			  os.path.join(worldPath, "minimapIcons.json"))
+	writeBenchmarkConfig(worldPath)
+	# Written last, so an interrupted generation is started again
+	writeJSON(manifest, manifestPath)
+	print(f"Generated {scale} synthetic world at {worldPath}")
+	return worldPath
@@ -5,15 +5,25 @@ global VERSION, WORKING_DIR, GCS, CONFIG
 GCS = GlobalCoordinateDefinition()
 CONFIG = MapBuilderConfig()
 
-from definitions import (SquareDefinition, ZoneDefinition, IconDefinition,
-						 loadMapDefinitions)
-from images import MapImage, PlaneImage, SquareImage, ZoneImage, IconImage
+from definitions import (SquareDefinition, ZoneDefinition, RegionDefinition,
+						 IconDefinition, loadMapDefinitions)
+from images import MapImage, PlaneImage, SquareImage, IconImage
 from mapelements import (MapPlane, MapSquare, MapZone, MapIcon, MapMosaic,
-						 MapSquareOfZones)
+						 MapSquareOfZones, MapZoneBlock)
 from managers import MapDefsManager, MapIconManager
+import stagecache
+import tracing
+import metrics
+import profiling
+import memorybudget
+import iconlayer
+import taskgraph
 
 # Utility imports
 from collections import defaultdict
+import functools
+import numpy as np
+import shutil
 import math
 import os
 import time
@@ -29,9 +39,15 @@ from pyvips_import import pyvips as pv
 
 
 class MapBuilder():
-	def __init__(self, defsStore: MapDefsManager, ID) -> None:
+	def __init__(self, defsStore: MapDefsManager, ID, tempPath=".") -> None:
 		self.mapID = ID
 
+		# Intermediate files are kept apart so builders can run concurrently
+		self.planeTempPath = os.path.join(tempPath, "temp-planes")
+		self.dzTempPath = os.path.join(tempPath, "temp")
+		# Stage cache keys, which are only worked out when needed
+		self.stageKeys = dict()
+
 		# Save a reference to the store
 		self.defsStore = defsStore
 
@@ -76,7 +92,10 @@ class MapBuilder():
 			# Zones get defined for each source plane in the level range
 			lowerPlane, upperPlane = zd.getPlaneRange()
 			for planeNum in range(lowerPlane, upperPlane+1):
-				self.loadZoneDefinition(zd, planeNum)
+				if isinstance(zd, RegionDefinition):
+					self.loadRegionDefinition(zd, planeNum)
+				else:
+					self.loadZoneDefinition(zd, planeNum)
 
 	def loadSquareDefinition(self, sqDef: SquareDefinition, sourcePlane):
 		newSquare = MapSquare(sqDef, sourcePlane)
@@ -122,60 +141,352 @@ class MapBuilder():
 			# raise IndexError("Cell is occupied on all allowed planes")
 			pass
 
+	def loadRegionDefinition(self, rDef: RegionDefinition, sourcePlane):
+		# Each square of the region is placed as one block of zones, as long
+		# as every zone in it would land on the same plane. Zones are placed
+		# independently of each other, so this matches placing them one by one
+		for squareRegion in rDef.splitSquares():
+			x, y = squareRegion.getDisplaySquare()
+			displayZones = squareRegion.getDisplayZones()
+			targetPlanes = {self.findFreeZonePlane(x, y, i, j)
+							for i, j in displayZones}
+			if len(targetPlanes) != 1:
+				# Zones split across planes are placed like plain zones
+				for zDef in squareRegion.expandToZones():
+					self.loadZoneDefinition(zDef, sourcePlane)
+				continue
+
+			planeNum = targetPlanes.pop()
+			if planeNum is None:
+				# Every allowed plane is occupied, see loadZoneDefinition
+				continue
+			targetPlane = self.planes[planeNum] # type: MapPlane
+			if targetPlane.checkIfCellEmpty(x, y):
+				msoz = MapSquareOfZones(planeNum)
+				targetPlane.insertToCell(x, y, msoz)
+			target = targetPlane.getCellContents(x, y) # type: MapSquareOfZones
+			newBlock = MapZoneBlock(squareRegion, sourcePlane)
+			for i, j in displayZones:
+				target.insertToCell(i, j, newBlock)
+			self.updateDisplayPlanes(planeNum)
+
+	def findFreeZonePlane(self, x, y, i, j):
+		# The plane a zone drawn at this position would be placed on
+		for planeNum in range(self.lowerPlane, self.upperPlane+1):
+			targetPlane = self.planes[planeNum] # type: MapPlane
+			if targetPlane.checkIfCellEmpty(x, y):
+				return planeNum
+			target = targetPlane.getCellContents(x, y) # type: MapSquareOfZones
+			if target.checkIfCellEmpty(i, j):
+				return planeNum
+		return None
+
 	def updateDisplayPlanes(self, planeNum):
 		self.upperDisplayPlane = max(self.upperDisplayPlane, planeNum)
 		self.lowerDisplayPlane = min(self.lowerDisplayPlane, planeNum)
 
 	def createMapTiles(self, basePath):
 		# Pipeline for generating the map tiles specific to this mapID
-		TEMP_DIR = "./temp-planes"
-		os.mkdir(TEMP_DIR)
-		for planeNum in range(self.lowerDisplayPlane, self.upperDisplayPlane+1):
-			# Render the plane image from its components
-			targetPlane = self.planes[planeNum]	# type: MapMosaic
-			if self.mapID == -1:
-				# The debug plane images already exist from the cache dump
-				planePath = os.path.join(basePath, f"fullplanes/base/plane_{planeNum}.png")
-				planeImage = pv.Image.new_from_file(planePath)
-			else:
-				planeImage = self.renderImages(targetPlane) # type: pv.Image
-				planePath = os.path.join(TEMP_DIR, f"plane_{planeNum}.png")
-				planeImage.write_to_file(planePath)
-				planeImage = pv.Image.new_from_file(planePath)
-			# Becuase of how process pipelines are handled, the preceding steps
-			# will be repeated quite a lot (i.e. plane 3 will generate a new 
-			# assembly of plane 0). It is better to use a single pipeline to 
-			# generate the base images, followed by new pipelines which start
-			# from this point.
-
-			# There is no need to composte the lowest plane
-			if planeNum == self.lowerPlane:
-				baseImage = planeImage
-				compositeImage = planeImage
-			elif planeNum > self.lowerPlane:
-				baseImage, compositeImage = self.compositeImages(planeImage, baseImage)
-			compositePath = os.path.join(TEMP_DIR, f"plane_{planeNum}_comp.png")
-			compositeImage.write_to_file(compositePath)
-			
-			# Restart the pipeline from this point to save time
-			compositeImage = pv.Image.new_from_file(compositePath)
-			minZoom = CONFIG.zoom.minZoom
-			maxZoom = CONFIG.zoom.maxZoom
-			for zoomLevel in range(minZoom, maxZoom+1):
-				lowerX = targetPlane.bbox["lowerX"]
-				lowerZ = targetPlane.bbox["lowerZ"]
-				zoomedImage = self.rescaleImages(compositeImage, zoomLevel,
-									 			 lowerX, lowerZ)
-
-				# The image can now be sliced
-				self.tileImage(zoomedImage, planeNum, zoomLevel)
-				
-				# The output directory of the slicer needs restructuring
-				self.restructureDirectory(planeNum, zoomLevel, basePath)
+		taskgraph.runTasks(self.planMapTiles(basePath), self.getThreadCount())
 
 		# Clean up temporary files
-		self.removeSubdirectories(TEMP_DIR)
-		os.rmdir(TEMP_DIR)
+		self.removeTempDirectories()
+
+	def planMapTiles(self, basePath):
+		# The graph of this mapID's work. Planes render concurrently, each
+		# composite follows as soon as its plane and the composite beneath it
+		# are done, and each zoom level is tiled as soon as its composite
+		# exists. Free threads take the renders, then the chain of
+		# composites, ahead of any tiling
+		displayPlanes = range(self.lowerDisplayPlane, self.upperDisplayPlane+1)
+		# The largest zoom levels take longest, so they are tiled first
+		zoomLevels = range(CONFIG.zoom.maxZoom, CONFIG.zoom.minZoom-1, -1)
+		renderTasks = dict()
+		compositeTasks = dict()
+		tileTasks = dict()
+		for planeNum in displayPlanes:
+			renderTasks[("render", planeNum)] = taskgraph.Task(
+				functools.partial(self.renderPlane, planeNum, basePath))
+			compositeDeps = (("render", planeNum),)
+			if planeNum > self.lowerDisplayPlane:
+				compositeDeps += (("composite", planeNum-1),)
+			compositeTasks[("composite", planeNum)] = taskgraph.Task(
+				functools.partial(self.compositePlane, planeNum, basePath),
+				compositeDeps)
+			for zoomLevel in zoomLevels:
+				tileTasks[("tile", planeNum, zoomLevel)] = taskgraph.Task(
+					functools.partial(self.createZoomTiles,
+									  self.getCompositePath(planeNum),
+									  planeNum, zoomLevel, basePath),
+					(("composite", planeNum),))
+		return {**renderTasks, **compositeTasks, **tileTasks}
+
+	def getThreadCount(self):
+		# With the low-memory strategy the work runs one step at a time, and
+		# a profiler only sees the thread it was started on
+		if memorybudget.isLowMemory() or profiling.isActive():
+			return 1
+		return CONFIG.scheduler.mapIDThreads or os.cpu_count() or 1
+
+	def renderPlane(self, planeNum, basePath):
+		# Render the plane image from its components
+		# Planes do not depend on each other, so they may be rendered in any
+		# order or at the same time
+		os.makedirs(self.planeTempPath, exist_ok=True)
+		planePath = self.getPlanePath(planeNum, basePath)
+		planeKey = self.getPlaneKey(planeNum, basePath)
+		if self.fetchStage(planeKey, planePath, basePath):
+			return planePath
+		targetPlane = self.planes[planeNum]	# type: MapMosaic
+		with tracing.span("mosaic render", mapID=self.mapID,
+						  plane=planeNum) as span:
+			planeImage = self.renderImages(targetPlane) # type: pv.Image
+			if self.mapID == -1:
+				planeImage = self.joinDebugPlane(planeImage, planeNum,
+												 basePath)
+			span.update(width=planeImage.width, height=planeImage.height)
+		memorybudget.checkBudget()
+		with tracing.span("plane write", mapID=self.mapID, plane=planeNum):
+			self.saveStage(planeImage, planePath, planeKey, basePath)
+		return planePath
+
+	def compositePlane(self, planeNum, basePath):
+		with tracing.span("composite", mapID=self.mapID, plane=planeNum):
+			return self.createCompositePlane(planeNum, basePath)
+
+	def createCompositePlane(self, planeNum, basePath):
+		# Stacks a rendered plane over the saved base of the planes beneath it
+		# Becuase of how process pipelines are handled, the preceding steps
+		# will be repeated quite a lot (i.e. plane 3 will generate a new 
+		# assembly of plane 0). It is better to use a single pipeline to 
+		# generate the base images, followed by new pipelines which start
+		# from this point.
+		compositePath = self.getCompositePath(planeNum)
+		compositeKey = self.getCompositeKey(planeNum, basePath)
+		# The stacked planes are the base of the next plane's composite
+		basePlanePath = self.getBasePlanePath(planeNum, basePath)
+		needsBase = self.lowerPlane < planeNum < self.upperDisplayPlane
+		if self.fetchStage(compositeKey, compositePath, basePath):
+			if not needsBase or self.fetchStage(
+					self.getBaseKey(planeNum, basePath), basePlanePath, basePath):
+				return compositePath
+
+		planeImage = pv.Image.new_from_file(self.getPlanePath(planeNum, basePath))
+		metrics.countRead(self.getPlanePath(planeNum, basePath))
+
+		# There is no need to composte the lowest plane
+		if planeNum == self.lowerPlane:
+			compositeImage = planeImage
+		elif planeNum > self.lowerPlane:
+			lowerBasePath = self.getBasePlanePath(planeNum-1, basePath)
+			baseImage = pv.Image.new_from_file(lowerBasePath)
+			metrics.countRead(lowerBasePath)
+			baseImage, compositeImage = self.compositeImages(planeImage, baseImage)
+			if needsBase:
+				self.saveStage(baseImage, basePlanePath,
+							   self.getBaseKey(planeNum, basePath), basePath)
+				memorybudget.checkBudget()
+		self.saveStage(compositeImage, compositePath, compositeKey, basePath)
+		return compositePath
+
+	def getPlaneKey(self, planeNum, basePath):
+		# Rendered planes depend on their layout and the contents of the
+		# source tiles, which hold their coverage band, and the debug planes
+		# on the cache dump's plane images too
+		if ("plane", planeNum) not in self.stageKeys:
+			targetPlane = self.planes[planeNum] # type: MapMosaic
+			layout = (sorted(targetPlane.bbox.items()),
+					  targetPlane.getRenderKey())
+			sourcePaths = self.getPlaneSources(planeNum, basePath)
+			sources = [(os.path.relpath(sourcePath, basePath),
+						stagecache.fileDigest(sourcePath))
+					   for sourcePath in sourcePaths]
+			self.stageKeys[("plane", planeNum)] = stagecache.makeKey(
+				"plane", layout, sources)
+		return self.stageKeys[("plane", planeNum)]
+
+	def getPlaneSources(self, planeNum, basePath):
+		sourcePaths = sorted(self.planes[planeNum].getSourcePaths())
+		if self.mapID == -1:
+			sourcePaths.append(self.getDebugPlanePath(planeNum, basePath))
+		return sourcePaths
+
+	def getBaseKey(self, planeNum, basePath):
+		# Stacked planes depend on every plane beneath them, but no styling
+		if planeNum == self.lowerPlane:
+			return self.getPlaneKey(planeNum, basePath)
+		return stagecache.makeKey("base", self.getBaseKey(planeNum-1, basePath),
+								  self.getPlaneKey(planeNum, basePath))
+
+	def getCompositeKey(self, planeNum, basePath):
+		# Only the planes beneath the lowest plane's are styled
+		planeKey = self.getPlaneKey(planeNum, basePath)
+		if planeNum == self.lowerPlane:
+			return stagecache.makeKey("composite", planeKey)
+		opts = CONFIG.composite
+		return stagecache.makeKey("composite",
+								  self.getBaseKey(planeNum-1, basePath),
+								  planeKey, opts.brightnessFraction,
+								  opts.contrastFraction, opts.grayscaleFraction,
+								  opts.blurRadius, opts.fusedStyling)
+
+	def fetchStage(self, key, path, basePath):
+		return (CONFIG.mapid.stageCacheEnabled
+				and stagecache.fetch(basePath, key, path))
+
+	def saveStage(self, image: pv.Image, path, key, basePath):
+		# Files linked from the stage cache must not be written through
+		if os.path.exists(path):
+			os.remove(path)
+		image.write_to_file(path)
+		metrics.countWrite(path)
+		if CONFIG.mapid.stageCacheEnabled:
+			stagecache.store(basePath, key, path)
+
+	def getPlanePath(self, planeNum, basePath):
+		return os.path.join(self.planeTempPath, f"plane_{planeNum}.png")
+
+	def getDebugPlanePath(self, planeNum, basePath):
+		return os.path.join(basePath, f"fullplanes/base/plane_{planeNum}.png")
+
+	def joinDebugPlane(self, mosaicImage: pv.Image, planeNum, basePath):
+		# The debug planes are the cache dump's plane images, which span
+		# every square from 0 up. The base tiles were sliced from them, so
+		# the spoofed mosaic's coverage band lines up with their top left
+		debugPlanePath = self.getDebugPlanePath(planeNum, basePath)
+		debugPlane = pv.Image.new_from_file(debugPlanePath)
+		metrics.countRead(debugPlanePath)
+		coverage = MapImage.getCoverage(mosaicImage).embed(
+			0, 0, debugPlane.width, debugPlane.height)
+		return debugPlane.bandjoin(coverage)
+
+	def getBasePlanePath(self, planeNum, basePath):
+		# The lowest plane is its own base
+		if planeNum == self.lowerPlane:
+			return self.getPlanePath(planeNum, basePath)
+		return os.path.join(self.planeTempPath, f"plane_{planeNum}_base.png")
+
+	def getCompositePath(self, planeNum):
+		return os.path.join(self.planeTempPath, f"plane_{planeNum}_comp.png")
+
+	def createZoomTiles(self, compositePath, planeNum, zoomLevel, basePath):
+		# Restart the pipeline from the saved composite to save time
+		# With little memory it is streamed top to bottom, rather than
+		# decoded whole, and sliced as it streams
+		lowMemory = memorybudget.isLowMemory()
+		compositeImage = pv.Image.new_from_file(
+			compositePath, access="sequential" if lowMemory else "random")
+		metrics.countRead(compositePath)
+		targetPlane = self.planes[planeNum]	# type: MapMosaic
+		lowerX = targetPlane.bbox["lowerX"]
+		lowerZ = targetPlane.bbox["lowerZ"]
+		# Rescaling only builds the pipeline, which runs as it is sliced
+		with tracing.span("rescale", mapID=self.mapID, plane=planeNum,
+						  zoom=zoomLevel) as span:
+			zoomedImage = self.rescaleImages(compositeImage, zoomLevel,
+											 lowerX, lowerZ)
+			span.update(width=zoomedImage.width, height=zoomedImage.height)
+
+		# The image can now be sliced
+		memorybudget.checkBudget()
+		with tracing.span("tile", mapID=self.mapID, plane=planeNum,
+						  zoom=zoomLevel) as span:
+			if CONFIG.zoom.cullEmptyTiles and not lowMemory:
+				tilesWritten, tilesBlank = self.saveOccupiedTiles(
+					zoomedImage, planeNum, zoomLevel, basePath)
+				span.update(tiles=tilesWritten, blankTiles=tilesBlank)
+				return
+			self.tileImage(MapImage.getColour(zoomedImage), planeNum, zoomLevel)
+
+		# The output directory of the slicer needs restructuring
+		with tracing.span("restructure", mapID=self.mapID, plane=planeNum,
+						  zoom=zoomLevel) as span:
+			span["tiles"] = self.restructureDirectory(planeNum, zoomLevel,
+													  basePath)
+
+	def getOccupiedSquares(self, planeNum):
+		# Display squares which can show anything in this plane's composite,
+		# which includes every plane beneath it
+		occupied = set()
+		for lowerPlaneNum in range(self.lowerPlane, planeNum+1):
+			targetPlane = self.planes[lowerPlaneNum] # type: MapPlane
+			occupied.update(targetPlane.getOccupiedCells())
+		# Blurring and resampling reach a few pixels past a square's edge
+		return {(x+dx, z+dz) for x, z in occupied
+				for dx in (-1, 0, 1) for dz in (-1, 0, 1)}
+
+	def getOccupiedTiles(self, planeNum, zoomLevel):
+		# The tiles at this zoom level which overlap an occupied square
+		scaleFactor = 2.0 ** zoomLevel / 2.0 ** CONFIG.zoom.baselineZoomLevel
+		occupiedTiles = set()
+		for x, z in self.getOccupiedSquares(planeNum):
+			tileRangeX = range(math.floor(x * scaleFactor),
+							   math.ceil((x+1) * scaleFactor))
+			tileRangeZ = range(math.floor(z * scaleFactor),
+							   math.ceil((z+1) * scaleFactor))
+			occupiedTiles.update((tileX, tileZ) for tileX in tileRangeX
+								 for tileZ in tileRangeZ)
+		return occupiedTiles
+
+	def saveOccupiedTiles(self, image: pv.Image, planeNum, zoomLevel,
+						  basePath):
+		# Slices only the tiles over occupied squares, straight to their
+		# Jagex coordinates. Empty tiles are never rendered, while occupied
+		# ones are still skipped if they turn out blank, like skip_blanks
+		# Returns the number of tiles written and skipped as blank
+		outPath = CONFIG.directory.outPath
+		outPath = os.path.join(basePath, outPath, str(self.mapID), f"{zoomLevel}")
+		# Other plane or zoom jobs for this mapID may be creating it too
+		metrics.makeDirectories(outPath)
+
+		tilesWritten, tilesBlank = 0, 0
+		for tileX, tileZ in sorted(self.getOccupiedTiles(planeNum, zoomLevel)):
+			memorybudget.checkBudget()
+			tile = self.cropTile(image, zoomLevel, tileX, tileZ)
+			if tile is None:
+				continue
+			if self.isBlankTile(tile):
+				tilesBlank += 1
+				continue
+			tilePath = os.path.join(outPath, f"{planeNum}_{tileX}_{tileZ}.png")
+			tileImage = pv.Image.new_from_array(
+				np.ascontiguousarray(tile[..., :3]), interpretation="srgb")
+			tileImage.write_to_file(tilePath)
+			metrics.countWrite(tilePath)
+			tilesWritten += 1
+		metrics.count("tilesEmitted", tilesWritten)
+		metrics.count("tilesBlank", tilesBlank)
+		return tilesWritten, tilesBlank
+
+	def cropTile(self, image: pv.Image, zoomLevel, tileX, tileZ):
+		# Cuts the tile at Jagex coordinates out of a rescaled composite, as an
+		# array, or returns None if it is outside of the image
+		tileSize = GCS.squarePixelLength
+		scaleFactor = 2.0 ** zoomLevel / 2.0 ** CONFIG.zoom.baselineZoomLevel
+
+		# The Jagex coordinates of the image's top left tile, see renameFile
+		dimensions = self.defsStore.getDefsBBox()
+		leftTileX = dimensions["lowerX"] // (scaleFactor ** -1)
+		topTileZ = math.ceil((dimensions["upperZ"] + 1) / (scaleFactor ** -1)) - 1
+		column = int(tileX - leftTileX)
+		row = int(topTileZ - tileZ)
+		if not (0 <= column < image.width // tileSize
+				and 0 <= row < image.height // tileSize):
+			return None
+		return image.crop(column * tileSize, row * tileSize,
+						  tileSize, tileSize).numpy()
+
+	@staticmethod
+	def isBlankTile(tile: np.ndarray):
+		# Tiles the coverage band leaves empty are skipped, like skip_blanks
+		return not tile[..., 3].any()
+
+	def removeTempDirectories(self):
+		with tracing.span("cleanup", mapID=self.mapID):
+			for tempPath in (self.planeTempPath, self.dzTempPath):
+				if os.path.exists(tempPath):
+					self.removeSubdirectories(tempPath)
+					os.rmdir(tempPath)
 
 	def renderImages(self, targetPlane: MapMosaic | str):
 		# For each plane, render all relevant images into a complete plane
@@ -194,12 +505,14 @@ class MapBuilder():
 		# The lowest plane is the base image for stacking operations
 		# For planes above 0, the finalized plane image will be a composite
 		# Create the stacked underlay by masking the top level and pasting
-		color = CONFIG.composite.transparencyColor
-		tolerance = CONFIG.composite.transparencyTolerance
-		mask = (abs(image - color) > tolerance).bandor()
+		# The mask is the plane's coverage band, which the base and composite
+		# carry on, covering everything stacked so far
+		mask = MapImage.getCoverage(image)
 		baseImage = mask.ifthenelse(image, baseImage)
-		styledPlane = self.stylePlane(baseImage)
-		compositeImage = mask.ifthenelse(image, styledPlane)
+		styledPlane = self.stylePlane(MapImage.getColour(baseImage))
+		styledCoverage = MapImage.blurCoverage(MapImage.getCoverage(baseImage))
+		compositeImage = mask.ifthenelse(image,
+										 styledPlane.bandjoin(styledCoverage))
 		return baseImage, compositeImage
 
 	def rescaleImages(self, image: pv.Image, zoomLevel, lowerX, lowerZ):
@@ -235,12 +548,10 @@ class MapBuilder():
 		return zoomedImage
 
 	def tileImage(self, image: pv.Image, planeNum, zoomLevel):
-		dzPath = "./temp"
-		outPath = os.path.join(dzPath, f"plane_{planeNum}/{zoomLevel}")
+		outPath = os.path.join(self.dzTempPath, f"plane_{planeNum}/{zoomLevel}")
 		backgroundColor = CONFIG.composite.transparencyColor
 		backgroundTolerance = CONFIG.composite.transparencyTolerance
-		if not os.path.exists(outPath):
-			os.makedirs(outPath)
+		metrics.makeDirectories(outPath)
 		image.dzsave(outPath,
 					 tile_size = GCS.squarePixelLength,
 					 suffix='.png[Q=100]',
@@ -250,16 +561,20 @@ class MapBuilder():
 					 region_shrink='nearest',
 					 background=backgroundColor,
 					 skip_blanks=backgroundTolerance)
-		
+		metrics.countSlices(outPath, image.width, image.height,
+							GCS.squarePixelLength)
+
 	def restructureDirectory(self, planeNum, zoomLevel, basePath):
 		# File names should match Jagex/Leaflet coordinates
 		# Generate an iterable of all the files in the directory
-		dirSpec = f"plane_{planeNum}/{zoomLevel}/0"
-		planeDirectory = os.path.join("./temp", dirSpec)
+		# Returns the number of tiles moved into place
+		zoomDirectory = os.path.join(self.dzTempPath, f"plane_{planeNum}/{zoomLevel}")
+		planeDirectory = os.path.join(zoomDirectory, "0")
 		pyramidSearchPath = os.path.join(planeDirectory, "**/*.png")
 		pyramidFiles = glob.iglob(pyramidSearchPath, recursive=True)
 
 		# Iterate
+		tileCount = 0
 		for imagePath in pyramidFiles:
 			# Google structure inserts images representing blank tiles
 			# Ignore them
@@ -267,10 +582,12 @@ class MapBuilder():
 				continue
 			dimensions = self.defsStore.getDefsBBox()
 			self.renameFile(imagePath, zoomLevel, dimensions, basePath)
+			tileCount += 1
 
 		# Clean up temporary files
-		self.removeSubdirectories("./temp")
-		os.rmdir("./temp")
+		self.removeSubdirectories(zoomDirectory)
+		os.rmdir(zoomDirectory)
+		return tileCount
 		
 	def padLeft(self, image, lowerX, scaleFactor):
 		inverseScale = scaleFactor ** -1
@@ -320,6 +637,18 @@ class MapBuilder():
 
 	def stylePlane(self, image):
 		# Plane styling pipeline
+		if not CONFIG.composite.fusedStyling:
+			return self.referenceStylePlane(image)
+		styledImage = MapImage.styleImage(image)
+		if CONFIG.composite.styleCheck:
+			# The fused pipeline is checked against the step-by-step one, cast
+			# to 8 bits as it is when saved
+			referenceImage = self.referenceStylePlane(image).cast("uchar")
+			MapImage.compareImages(styledImage, referenceImage,
+								   CONFIG.composite.styleTolerance)
+		return styledImage
+
+	def referenceStylePlane(self, image):
 		image = MapImage.brightnessAndContrast(image)
 		image = MapImage.grayscale(image)
 		image = MapImage.blur(image)
@@ -357,14 +686,15 @@ class MapBuilder():
 		newFileName = f"{planeNum}_{int(relX)}_{int(relY)}.png"
 		outPath = CONFIG.directory.outPath
 		outPath = os.path.join(basePath, outPath, str(self.mapID), f"{zoom}")
-		if not os.path.exists(outPath):
-			os.makedirs(outPath)
+		# Other plane or zoom jobs for this mapID may be creating it too
+		metrics.makeDirectories(outPath)
 
 		# If there is an old file in the way it should be replaced
 		newPath = os.path.join(outPath, newFileName)
 		if os.path.exists(newPath):
 			os.remove(newPath)
 		os.rename(filePath, newPath)
+		metrics.count("renames")
 
 	def removeSubdirectories(self, topLevelDir):
 		# Depth first search to find all directories and files
@@ -381,23 +711,24 @@ class MapBuilder():
 			os.remove(file)
 
 	def renderIcons(self, tileImagePath, iconList: dict[int, list[MapIcon]]):
+		with tracing.span("icon insertion", mapID=self.mapID) as span:
+			if CONFIG.icon.iconOutputMode == "vector":
+				span["icons"] = iconlayer.writeIconLayer(tileImagePath,
+														 self.mapID, iconList)
+			else:
+				span["tiles"] = self.drawIcons(tileImagePath, iconList)
+
+	def drawIcons(self, tileImagePath, iconList: dict[int, list[MapIcon]]):
 		# Draws icons onto the rendered tiles from slicing
 		# Requires calculating the scaing factor to place the icons
 		# Reliant on the directory renaming scheme to choose the right tiles
+		# Returns the number of tiles drawn on
+		tileCount = 0
 		zoomLevelsWithIcons = [z for z,i in CONFIG.icon.zoomLevelHasIcons.items() if i]
 		for zoomLevel in zoomLevelsWithIcons:
 			# Get a list of all the tiles to update and the icons in them
-			tilesWithIcons = defaultdict(lambda: defaultdict(list))
-			for plane, icons in iconList.items():
-				for icon in icons:
-					# Ownership
-					x, z = icon.tilePosition[zoomLevel]
-					tilesWithIcons[plane][(x, z)].append(icon)
-					# Overflow
-					for overflowTile in icon.overflowsInto[zoomLevel]:
-						ox, oz = overflowTile
-						tilesWithIcons[plane][(ox, oz)].append(icon)
-			
+			tilesWithIcons = self.getTilesWithIcons(iconList, zoomLevel)
+
 			# Iterate the list of tiles to modify or create images as necessary
 			for plane, tiles in tilesWithIcons.items():
 				for tile, icons in tiles.items():
@@ -408,14 +739,32 @@ class MapBuilder():
 					imageName = f"{plane}_{tile[0]}_{tile[1]}.png"
 					p = os.path.join(tileImagePath, str(zoomLevel), imageName)
 					# Insert icons to the tile's image and save
-					self.insertIcons(p, tile[0], tile[1], icons, zoomLevel)				
+					if CONFIG.icon.iconOutputMode == "overlay":
+						self.writeIconOverlay(p, tile[0], tile[1], icons,
+											  zoomLevel)
+					else:
+						self.insertIcons(p, tile[0], tile[1], icons, zoomLevel)
+					tileCount += 1
+		return tileCount
+
+	@staticmethod
+	def getTilesWithIcons(iconList: dict[int, list[MapIcon]], zoomLevel):
+		# Maps each plane's tiles at this zoom level onto the icons drawn on
+		# them, in the order they are listed
+		tilesWithIcons = defaultdict(lambda: defaultdict(list))
+		for plane, icons in iconList.items():
+			for icon in icons:
+				# Ownership
+				x, z = icon.tilePosition[zoomLevel]
+				tilesWithIcons[plane][(x, z)].append(icon)
+				# Overflow
+				for overflowTile in icon.overflowsInto[zoomLevel]:
+					ox, oz = overflowTile
+					tilesWithIcons[plane][(ox, oz)].append(icon)
+		return tilesWithIcons
 
 	def insertIcons(self, path, x, z, iconList: list[MapIcon], zoomLevel):
 		# Draw icons onto the tile image
-		# This is done by compositing the icons into one image, then using
-		# a mask to paste the resulting image overtop the existing image
-		iconLayer = self.createIconLayer(x, z, iconList, zoomLevel)
-		
 		# To replace the base image with the icon-implanted image, the old file
 		# must be renamed, loaded, then deleted. The new image will be written
 		# to the same namespace the old file. This is necessary because pyvips
@@ -423,92 +772,168 @@ class MapBuilder():
 		basePath = os.path.dirname(path)
 		swapperPath = os.path.basename(path).split(".")[0] + "-icon.png"
 		randPath = os.path.join(basePath, swapperPath)
-		# Mask the icon layer overtop the tile image
-		layerMask = (iconLayer[3] == 255)
 		if os.path.exists(path):
-			# If the image exists already, load it after changing its name
 			os.rename(path, randPath)
+		# A renamed image without its replacement was left by a killed
+		# worker, and is drawn on again
+		if os.path.exists(randPath):
+			# If the image exists already, load it after changing its name
 			tileImage = pv.Image.new_from_file(randPath)
+			metrics.countRead(randPath)
 		else:
 			# If the image does not exist, create a new blank image
-			tileImage = pv.Image.black(256, 256, bands=3)
-			tileImage = tileImage.copy(interpretation="srgb")
-		outImage = layerMask.ifthenelse(iconLayer[0:3], tileImage) # drop alpha
+			tileImage = self.createBlankTile()
+		outImage = self.overlayIcons(tileImage, x, z, iconList, zoomLevel)
 		# Save the resulting image to the directory
 		outImage.write_to_file(path)
+		metrics.countWrite(path)
+		metrics.count("iconsDrawn", len(iconList))
 		# Remove the temporary file
 		if os.path.exists(randPath):
 			os.remove(randPath)
 
-	def createIconLayer(self, x, z, iconList: list[MapIcon], zoomLevel):
-		# Creates an overlay image. All icons in the list are drawn onto it
-		iconLayer = pv.Image.black(256, 256, bands=4).copy(interpretation="srgb")
-		for icon in iconList:
-			# Fetch image, icon owner tile, and location in owner tile
-			iconImage = icon.imageContainer.image
-			iconX_tile, iconZ_tile = icon.tilePosition[zoomLevel]
-			x_px, z_px = icon.positionInTile[zoomLevel]
-
-			# Temporary layer for this icon only
-			temp = pv.Image.black(256, 256, bands=4).copy(interpretation="srgb")
-
-			# Find the draw location for the icon in this tile
-			if iconX_tile==x and iconZ_tile==z:
-				# If the tile being drawn is the same as the icons owner tile
-				# The in tile location can just be used, adjusting to top left
-				iconX_px = x_px - math.ceil(iconImage.width/2)
-				iconZ_px = z_px - math.ceil(iconImage.height/2)
-			else:
-				# If the tile overflows into this tile, the offset which 
-				# places the icon in the correct position outside this tile 
-				# needs to be found
-				offsetX = x - iconX_tile
-				offsetZ = z - iconZ_tile
-				# From the offset, calculate the correct pixel position
-				iconX_px = x_px - (offsetX*256) - math.ceil(iconImage.width/2)
-				# Recall that +ve z coordinates values indicate the top left
-				# while +ve z pixels indicate the bottom left
-				iconZ_px = z_px + (offsetZ*256) - math.ceil(iconImage.height/2)
-			# Insert the icon image
-			temp = temp.insert(iconImage, iconX_px-1, iconZ_px, expand=False)
-			# Mask the temporary image overtop the base image
-			mask = (temp[3] == 255)
-			iconLayer = mask.ifthenelse(temp, iconLayer)
-		return iconLayer
+	def writeIconOverlay(self, path, x, z, iconList: list[MapIcon], zoomLevel):
+		# Draw icons onto a transparent tile of their own, leaving the
+		# rendered tile without icons
+		metrics.makeDirectories(os.path.dirname(path))
+		outImage = self.createIconOverlay(x, z, iconList, zoomLevel)
+		outImage.write_to_file(path)
+		metrics.countWrite(path)
+		metrics.count("iconsDrawn", len(iconList))
+
+	@staticmethod
+	def createBlankTile():
+		tileImage = pv.Image.black(256, 256, bands=3)
+		return tileImage.copy(interpretation="srgb")
+
+	def overlayIcons(self, tileImage: pv.Image, x, z, iconList: list[MapIcon],
+					 zoomLevel):
+		outImage = self.compositeIcons(tileImage.bandjoin(255), x, z, iconList,
+									   zoomLevel)
+		return outImage.extract_band(0, n=3) # drop alpha
+
+	def createIconOverlay(self, x, z, iconList: list[MapIcon], zoomLevel):
+		# Icons are fully opaque where drawn, so the overlay over the rendered
+		# tile matches the tile they would be burned into
+		tileImage = self.createBlankTile().bandjoin(0)
+		return self.compositeIcons(tileImage, x, z, iconList, zoomLevel)
+
+	def compositeIcons(self, tileImage: pv.Image, x, z, iconList: list[MapIcon],
+					   zoomLevel):
+		# Every icon is composited over the tile in a single operation, where
+		# each icon's coverage band masks what it draws
+		overlays = [icon.imageContainer.image for icon in iconList]
+		positions = [self.getIconPosition(x, z, icon, zoomLevel)
+					 for icon in iconList]
+		# Later icons are drawn over earlier ones, as they are listed
+		return tileImage.composite(overlays, ["over"] * len(overlays),
+								   x=[left for left, _ in positions],
+								   y=[top for _, top in positions])
+
+	def getIconPosition(self, x, z, icon: MapIcon, zoomLevel):
+		# Find the top left pixel of the icon, relative to the tile (x, z)
+		iconImage = icon.imageContainer.image
+		iconX_tile, iconZ_tile = icon.tilePosition[zoomLevel]
+		x_px, z_px = icon.positionInTile[zoomLevel]
+
+		# Find the draw location for the icon in this tile
+		if iconX_tile==x and iconZ_tile==z:
+			# If the tile being drawn is the same as the icons owner tile
+			# The in tile location can just be used, adjusting to top left
+			iconX_px = x_px - math.ceil(iconImage.width/2)
+			iconZ_px = z_px - math.ceil(iconImage.height/2)
+		else:
+			# If the tile overflows into this tile, the offset which 
+			# places the icon in the correct position outside this tile 
+			# needs to be found
+			offsetX = x - iconX_tile
+			offsetZ = z - iconZ_tile
+			# From the offset, calculate the correct pixel position
+			iconX_px = x_px - (offsetX*256) - math.ceil(iconImage.width/2)
+			# Recall that +ve z coordinates values indicate the top left
+			# while +ve z pixels indicate the bottom left
+			iconZ_px = z_px + (offsetZ*256) - math.ceil(iconImage.height/2)
+		# Positions are truncated to whole pixels, as pyvips' insert did
+		return int(iconX_px-1), int(iconZ_px)
 		
 
 def buildMapID(mapID, basePath, mapDefs, iconManager: MapIconManager,
-			   squareDefs=None, zoneDefs=None):
-	print(f"BUILDING {mapID}")
-	mapIDtime = time.time()
-	# Load definitions that create the mapID
-	if mapID == -1:
-		# For mapID -1 the input will be spoofed squares that are already made
-		pass
-	else:
-		squareDefs, zoneDefs = loadMapDefinitions(mapID, mapDefs, basePath)
-		
-	defsManager = MapDefsManager(squareDefs, zoneDefs)
-
-	# Build the mapID
-	renderTime = time.time()
-	mapBuilder = MapBuilder(defsManager, mapID)
-	mapBuilder.createMapTiles(basePath)
-	print(f"\tRendering Tiles took {time.time()-renderTime:.3f}")
-
-	# Load icon definitions relevant to this mapID
-	iconTime = time.time()
-	iconList = iconManager.getIconsInID(mapBuilder)
-	mapIDPath = os.path.join(basePath, CONFIG.icon.mapIDDirectory, str(mapID))
-	mapBuilder.renderIcons(mapIDPath, iconList)
-	print(f"\tInserting Icons took {time.time()-iconTime:.2f}")
-
-	# Extract data for basemaps generation
-	bounds = mapBuilder.defsStore.getBounds()
+			   squareDefs=None, zoneDefs=None, tempPath="."):
+	with tracing.span("mapID", mapID=mapID), metrics.scope(mapID), \
+			profiling.profile(mapID):
+		print(f"BUILDING {mapID}")
+		mapIDtime = time.time()
+		# Load definitions that create the mapID, unless they were supplied
+		if squareDefs is None and zoneDefs is None:
+			squareDefs, zoneDefs = loadMapIDDefinitions(mapID, mapDefs, basePath)
+
+		defsManager = MapDefsManager(squareDefs, zoneDefs)
+
+		# Build the mapID
+		renderTime = time.time()
+		mapBuilder = MapBuilder(defsManager, mapID, tempPath)
+		mapBuilder.createMapTiles(basePath)
+		print(f"\tRendering Tiles took {time.time()-renderTime:.3f}")
+
+		# Load icon definitions relevant to this mapID
+		iconTime = time.time()
+		iconList = iconManager.getIconsInID(mapBuilder)
+		mapBuilder.renderIcons(prepareIconTilesPath(basePath, mapID), iconList)
+		print(f"\tInserting Icons took {time.time()-iconTime:.2f}")
+
+		# Extract data for basemaps generation
+		basemapsEntry = getBaseMapsEntry(mapID, mapDefs, mapBuilder.defsStore)
+
+		print(f"GENERATING {mapID} TOOK {time.time()-mapIDtime:.2f}")
+		return basemapsEntry
+
+
+def buildMapIDIcons(mapID, basePath, mapDefs, iconManager: MapIconManager):
+	# Rewrites only the icon overlays or icon layer of a mapID, as its
+	# rendered tiles do not depend on the icons. Nothing is rendered, so no
+	# plane is needed
+	with tracing.span("mapID", mapID=mapID), metrics.scope(mapID):
+		iconTime = time.time()
+		squareDefs, zoneDefs = loadMapIDDefinitions(mapID, mapDefs, basePath)
+		mapBuilder = MapBuilder(MapDefsManager(squareDefs, zoneDefs), mapID)
+		iconList = iconManager.getIconsInID(mapBuilder)
+		mapBuilder.renderIcons(prepareIconTilesPath(basePath, mapID), iconList)
+		print(f"ICONS OF {mapID} TOOK {time.time()-iconTime:.2f}")
+
+
+def prepareIconTilesPath(basePath, mapID):
+	# Icons are drawn onto the mapID's rendered tiles, or into overlay tiles
+	# or a vector icon layer of their own, which replace those of the last
+	# build
+	iconPaths = {"overlay": CONFIG.icon.overlayPath,
+				 "vector": CONFIG.icon.vectorPath}
+	if CONFIG.icon.iconOutputMode in iconPaths:
+		iconPath = os.path.join(basePath, iconPaths[CONFIG.icon.iconOutputMode],
+								str(mapID))
+		# Overlays of icons which have since moved must not remain
+		shutil.rmtree(iconPath, ignore_errors=True)
+		return iconPath
+	return os.path.join(basePath, CONFIG.icon.mapIDDirectory, str(mapID))
+
+
+def loadMapIDDefinitions(mapID, mapDefs, basePath):
+	# The debug mapID (-1) is created using spoofed definitions that render
+	# in-place, made by iterating the square ranges
+	with tracing.span("definitions", mapID=mapID) as span:
+		if mapID == -1:
+			squareDefs = SquareDefinition.spoofAllSquareDefs(basePath)
+			zoneDefs = list() # There are no zone definitions for this
+		else:
+			squareDefs, zoneDefs = loadMapDefinitions(mapID, mapDefs, basePath)
+		span.update(squares=len(squareDefs), zones=len(zoneDefs))
+	return squareDefs, zoneDefs
+
+
+def getBaseMapsEntry(mapID, mapDefs, defsStore: MapDefsManager):
+	bounds = defsStore.getBounds()
 	if mapID == -1:
 		name = "Debug"
-		center = mapBuilder.defsStore.getCenter()
-		basemapsEntry = createBaseMapsEntry(mapID, name, bounds, center)
+		center = defsStore.getCenter()
 	else:
 		name = mapDefs.get("name")
 		name = name.split(" (")[0] # Remove parenthetical overwrites
@@ -516,11 +941,8 @@ def buildMapID(mapID, basePath, mapDefs, iconManager: MapIconManager,
 		try:
 			center = mapDefs["position"]
 		except KeyError:
-			center = mapBuilder.defsStore.getCenter()
-		basemapsEntry = createBaseMapsEntry(mapID, name, bounds, center)
-
-	print(f"GENERATING {mapID} TOOK {time.time()-mapIDtime:.2f}")
-	return basemapsEntry
+			center = defsStore.getCenter()
+	return createBaseMapsEntry(mapID, name, bounds, center)
 
 
 def createBaseMapsEntry(mapID, name, bounds, center):
@@ -533,29 +955,22 @@ def createBaseMapsEntry(mapID, name, bounds, center):
 	return entry
 
 
-def actionRoutine(basePath):
-	"""
-	Generates all tiles for all mapIDs using the worldMapCompositeDefinitions 
-	
-	Loads definition files dumped from RuneLite, passing the information to
-	classes to store the data. Using that information, the tile images are
-	generated. Each generated image is then rescaled, styled, composited, 
-	and sliced per config file settings. The resulting image directory from a
-	dzsave operation is then restructured to match Jagex/Leaflet coordinates,
-	Finally, icon locations are calculated and their sprites are inserted to 
-	the correct image files.
-	"""
-	# Data paths
+def loadRenderPlan(basePath):
+	# Maps each mapID to build onto its definitions, in build order
+	# The debug mapID (-1) leads and has no definitions of its own
+	if CONFIG.mapid.snapshotEnabled:
+		import snapshot
+		return snapshot.loadRenderPlan(basePath)
+	return loadRenderPlanFromJSON(basePath)
+
+
+def loadRenderPlanFromJSON(basePath):
 	mapDefsPath = CONFIG.mapid.mapDefsPath
 	mapDefsPath = os.path.join(basePath, mapDefsPath)
 	userMapDefsPath = CONFIG.mapid.userMapDefsPath
-	iconDefsPath = CONFIG.icon.iconDefs
-	iconDefsPath = os.path.join(basePath, iconDefsPath)
-	basemapsPath = CONFIG.mapid.basemapsPath
-	basemapsPath = os.path.join(basePath, basemapsPath)
 
 	# Load all defs to render
-	mapDefsToRender = dict()
+	mapDefsToRender = {-1: None}
 	with open(mapDefsPath) as mapDefsFile:
 		mapDefsJSON = json.load(mapDefsFile)
 		for mapDef in mapDefsJSON:
@@ -567,31 +982,107 @@ def actionRoutine(basePath):
 			# User map defs take priority (override) cache defs
 			mapID = umapDef["fileId"]
 			mapDefsToRender[mapID] = umapDef
+	return mapDefsToRender
 
-	# Create leaflet display data file per ID created
-	basemapsList = list()
 
-	# The icon manager should only be created once, as icons are reused in IDs
-	# Load icon definitions
+def createIconManager(basePath):
+	# Icon definitions and sprites come from the snapshot when enabled
+	if CONFIG.mapid.snapshotEnabled:
+		import snapshot
+		iconDefs = snapshot.loadIconDefinitions(basePath)
+		iconImages = snapshot.loadIconImages(basePath)
+		return MapIconManager(iconDefs, basePath, iconImages)
+	iconDefsPath = os.path.join(basePath, CONFIG.icon.iconDefs)
 	iconDefs = IconDefinition.iconDefsFromJSON(iconDefsPath)
-	iconManager = MapIconManager(iconDefs, basePath)
-
-	# Building the debug (-1) mapID (contains all tiles, with icons)
-	# This is created using spoofed definitions that render in-place
-	# Therefore each spoof definition is made by iterating the square ranges
-	debugSquareDefs = SquareDefinition.spoofAllSquareDefs(basePath)
-	debugZoneDefs = list() # There are no zone definitions for this
-	baseMapEntry = buildMapID(-1, basePath, None, iconManager, 
-						   	  debugSquareDefs, debugZoneDefs)
-	basemapsList.append(baseMapEntry)
-
-	# Build the mapIDs
-	for mapID, mapDef in mapDefsToRender.items():
-		baseMapEntry = buildMapID(mapID, basePath, mapDef, iconManager)
-		basemapsList.append(baseMapEntry)
-
-	with open(basemapsPath, 'w') as f:
-		json.dump(basemapsList, f)
+	return MapIconManager(iconDefs, basePath)
+
+
+def actionRoutine(basePath, shard=None, iconsOnly=False):
+	"""
+	Generates all tiles for all mapIDs using the worldMapCompositeDefinitions 
+	
+	Loads definition files dumped from RuneLite, passing the information to
+	classes to store the data. Using that information, the tile images are
+	generated. Each generated image is then rescaled, styled, composited, 
+	and sliced per config file settings. The resulting image directory from a
+	dzsave operation is then restructured to match Jagex/Leaflet coordinates,
+	Finally, icon locations are calculated and their sprites are inserted to 
+	the correct image files.
+
+	When a (index, count) shard is given only that shard's share of the
+	mapIDs is built, and its partial outputs are written for merging.
+
+	With iconsOnly, only the icon overlays or vector icon layers are written
+	again, which requires the overlay or vector icon output mode.
+	"""
+	# Data paths
+	basemapsPath = CONFIG.mapid.basemapsPath
+	basemapsPath = os.path.join(basePath, basemapsPath)
+
+	# Spans and metrics of this process and its workers are gathered once
+	# it finishes
+	tracing.startTrace(basePath)
+	memorybudget.startWatchdog(basePath)
+	metricsPath = os.path.join(basePath, CONFIG.metrics.metricsPath)
+	if CONFIG.metrics.metricsEnabled:
+		metrics.startMetrics(metricsPath)
+
+	# Load all defs to render
+	renderPlan = loadRenderPlan(basePath)
+	mapDefsToRender = renderPlan
+	if shard:
+		import shards
+		mapDefsToRender = shards.selectShard(renderPlan, basePath, *shard)
+
+	if CONFIG.icon.iconOutputMode == "vector":
+		# Every mapID's icon layer shares the one sprite atlas
+		iconlayer.writeSpriteAtlas(basePath,
+								   createIconManager(basePath).iconIDtoImage)
+
+	if iconsOnly:
+		if CONFIG.icon.iconOutputMode == "burned":
+			raise ValueError("Only icon overlays or vector icon layers can be "
+							 "written on their own, set iconOutputMode to "
+							 "overlay or vector")
+		if shard:
+			raise ValueError("Icons are not written on their own in shards")
+		iconManager = createIconManager(basePath)
+		for mapID, mapDef in mapDefsToRender.items():
+			buildMapIDIcons(mapID, basePath, mapDef, iconManager)
+		tracing.writeTrace(basePath)
+		metrics.writeMetrics(metricsPath, "mapIDs")
+		memorybudget.writePeaks(basePath)
+		return
+
+	if CONFIG.scheduler.schedulerEnabled:
+		# Jobs are packed into worker processes under the memory budget
+		import scheduler
+		basemapsList = scheduler.scheduleMapIDs(mapDefsToRender, basePath)
+	else:
+		# Create leaflet display data file per ID created
+		basemapsList = list()
+
+		# The icon manager should only be created once, as icons are reused
+		iconManager = createIconManager(basePath)
+
+		# Build the mapIDs, starting with the debug (-1) mapID
+		for mapID, mapDef in mapDefsToRender.items():
+			with memorybudget.watch(mapID, "mapID"):
+				baseMapEntry = buildMapID(mapID, basePath, mapDef, iconManager)
+			basemapsList.append(baseMapEntry)
+
+	if CONFIG.mapid.stageCacheEnabled:
+		stagecache.prune(basePath)
+
+	if shard:
+		shards.writeShardOutputs(basePath, renderPlan, basemapsList, *shard)
+	else:
+		with open(basemapsPath, 'w') as f:
+			json.dump(basemapsList, f)
+
+	tracing.writeTrace(basePath)
+	metrics.writeMetrics(metricsPath, "mapIDs")
+	memorybudget.writePeaks(basePath)
 
 	# mapID = 4
 	# buildMapID(mapID, basePath, mapDefsJSON, iconManager)
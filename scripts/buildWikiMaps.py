@@ -14,15 +14,17 @@ def getCache(reqVersion=None):
 		out.write(foundVersion)
 
 def createBaseTiles(version):
-	# Pyvips import is OS-dependent, use dispatcher file
-	from pyvips_import import pyvips as pv
-	import restructureDirectory
+	import metrics
 
 	# Slice the cache dump result to produce the base tiles for game maps
-	with open("./scripts/mapBuilderConfig.json") as configFile:
-		configData = json.load(configFile)
-		backgroundColor = configData["TILER_OPTS"]["backgroundColor"]
-		backgroundThreshold = configData["TILER_OPTS"]["backgroundThreshold"]
+	# Sections left out of the config take their defaults
+	from config import MapBuilderConfig
+	CONFIG = MapBuilderConfig.fromJSON("./scripts/mapBuilderConfig.json")
+	# Imported once the config is loaded, so that libvips' limits apply
+	from pyvips_import import getSpawnContext
+	backgroundColor = CONFIG.tiler.backgroundColor
+	backgroundThreshold = CONFIG.tiler.backgroundThreshold
+	workerCount = CONFIG.scheduler.workerCount
 	with open(os.path.join(BASE_DIRECTORY, version, "coordinateData.json")) as coordFile:
 		coordData = json.load(coordFile)
 
@@ -30,52 +32,175 @@ def createBaseTiles(version):
 	baseDirectory = os.path.join(BASE_DIRECTORY, version)
 	imageBasePath = os.path.join(baseDirectory, "fullplanes/base")
 	imageFilePaths = glob.glob(os.path.join(imageBasePath, "**.*png"))
-	dzSaveOutPath = os.path.join(baseDirectory, "tiles/dzSave")
-
-	# Identify the bottom left coordinates
-	LOWER_SQUARE_X = coordData["minSquareX"]
-
-	# Slice each image
-	for planeImagePath in imageFilePaths:
-		# Identify the plane
-		fileName = os.path.basename(planeImagePath)
-		_, planeNum = os.path.splitext(fileName)[0].split("_")
-
-		# Load the image and slice
-		planeImage = pv.Image.new_from_file(planeImagePath)
-		resultDir = os.path.join(dzSaveOutPath, f"plane_{planeNum}/2")
-		if not os.path.exists(resultDir):
-			os.makedirs(resultDir)
-		planeImage.dzsave(resultDir,
-						  tile_size= 256,
-						  suffix= '.png[Q=100]',
-						  depth= 'one',
-						  overlap= 0,
-						  layout='google',
-						  region_shrink='nearest',
-						  background=backgroundColor,
-						  skip_blanks=backgroundThreshold)
-		
-	# Restructure the output of the slicer to comport with Jagex coordinates
-	targetDirectory = os.path.join(baseDirectory, "tiles/base")
-	planeTileDirectories = glob.glob(os.path.join(dzSaveOutPath, "*/"))
-	for directory in planeTileDirectories:
-		restructureDirectory.restructureDirectory(directory, 
-												  targetDirectory,
-											  	  coordData, 2, 
-												  xOffset=LOWER_SQUARE_X)
-	restructureDirectory.removeSubdirectories(dzSaveOutPath)
-	os.rmdir(dzSaveOutPath)
-
-def buildAllMapIDs(version):
+	targetDirectory = os.path.join(baseDirectory, "tiles/base/2")
+	if not imageFilePaths:
+		print(f"No plane images found in {imageBasePath}")
+		return
+
+	# Workers share the output directory, so create it ahead of time
+	os.makedirs(targetDirectory, exist_ok=True)
+	metricsPath = os.path.join(baseDirectory, CONFIG.metrics.metricsPath)
+	if CONFIG.metrics.metricsEnabled:
+		metrics.startMetrics(metricsPath)
+
+	# Slice each plane image in its own process, up to the worker count
+	argList = [(planeImagePath, targetDirectory, coordData, backgroundColor,
+				backgroundThreshold)
+			   for planeImagePath in imageFilePaths]
+	processCount = min(len(argList), workerCount or os.cpu_count() or 1)
+	with getSpawnContext().Pool(processCount) as pool:
+		pool.starmap(createPlaneBaseTiles, argList)
+	metrics.writeMetrics(metricsPath, "baseTiles")
+
+def createPlaneBaseTiles(planeImagePath, targetDirectory, coordData,
+						 backgroundColor, backgroundThreshold):
+	# libvips' limits are applied from the configuration as it is imported
+	from config import MapBuilderConfig
+	MapBuilderConfig.fromJSON("./scripts/mapBuilderConfig.json")
+	# Pyvips import is OS-dependent, use dispatcher file
+	from pyvips_import import pyvips as pv
+	import numpy as np
+	import metrics
+	from images import MapImage
+	TILE_SIZE = 256
+
+	# Identify the plane
+	fileName = os.path.basename(planeImagePath)
+	_, planeNum = os.path.splitext(fileName)[0].split("_")
+	# Base tiles are counted per plane
+	with metrics.scope(f"plane_{planeNum}"):
+		# The plane image's top left square, in Jagex coordinates. Jagex uses
+		# a bottom left origin, while images use a top left one
+		LOWER_SQUARE_X = coordData["minSquareX"]
+		UPPER_SQUARE_Y = coordData["maxSquareY"]
+
+		# The plane images are huge, so stream them top to bottom a row of
+		# tiles at a time, saving each tile straight under its final name
+		planeImage = pv.Image.new_from_file(planeImagePath, access="sequential")
+		metrics.countRead(planeImagePath)
+		columns = -(-planeImage.width // TILE_SIZE)
+		rows = -(-planeImage.height // TILE_SIZE)
+		background = np.array(backgroundColor, dtype=np.int16)
+		tilesWritten, tilesBlank = 0, 0
+		for row in range(rows):
+			stripHeight = min(TILE_SIZE, planeImage.height - row * TILE_SIZE)
+			strip = planeImage.crop(0, row * TILE_SIZE, planeImage.width,
+									stripHeight).numpy()
+			strip = strip.reshape(stripHeight, planeImage.width, -1)
+			# Edge tiles are padded with the background, as dzsave did
+			if strip.shape[:2] != (TILE_SIZE, columns * TILE_SIZE):
+				padded = np.empty((TILE_SIZE, columns * TILE_SIZE,
+								   strip.shape[2]), dtype=np.uint8)
+				padded[...] = backgroundColor
+				padded[:stripHeight, :planeImage.width] = strip
+				strip = padded
+			# Tiles of only the background are skipped, like skip_blanks. The
+			# range of each tile is reduced down its rows first, as numpy does
+			# that fastest
+			bands = strip.shape[2]
+			rowView = strip.reshape(TILE_SIZE, columns, TILE_SIZE * bands)
+			tileMax = rowView.max(axis=0).reshape(columns, TILE_SIZE, bands) \
+				.max(axis=1).astype(np.int16)
+			tileMin = rowView.min(axis=0).reshape(columns, TILE_SIZE, bands) \
+				.min(axis=1).astype(np.int16)
+			blank = ((tileMax - background <= backgroundThreshold)
+					 & (background - tileMin <= backgroundThreshold)).all(axis=1)
+			for column in range(columns):
+				if blank[column]:
+					tilesBlank += 1
+					continue
+				tile = strip[:, column * TILE_SIZE:(column + 1) * TILE_SIZE]
+				tileX = column + LOWER_SQUARE_X
+				tileY = UPPER_SQUARE_Y - row
+				tilePath = os.path.join(targetDirectory,
+										f"{planeNum}_{tileX}_{tileY}.png")
+				# The coverage band is keyed here, once, and carried from
+				# then on. Tiles are saved without metadata, as dzsave did
+				tile = np.dstack((tile[..., :3], MapImage.keyCoverage(tile)))
+				pv.Image.new_from_array(tile, interpretation="srgb") \
+					.write_to_file(tilePath, keep="none")
+				metrics.countWrite(tilePath)
+				tilesWritten += 1
+		metrics.count("tilesEmitted", tilesWritten)
+		metrics.count("tilesBlank", tilesBlank)
+
+def buildAllMapIDs(version, shard=None, profile=None, profileMapid=None,
+				   vipsProfile=False, iconsOnly=False):
 	from config import GlobalCoordinateDefinition, MapBuilderConfig
 	WORKING_DIR = f"./osrs-wiki-maps/out/mapgen/versions/{version}"
 	GlobalCoordinateDefinition.fromJSON(f"{WORKING_DIR}/coordinateData.json")
 	MapBuilderConfig.fromJSON("./scripts/mapBuilderConfig.json")
+	import profiling
+	baseDirectory = os.path.join(BASE_DIRECTORY, version)
+
+	# libvips reads VIPS_PROFILE as it starts, so before pyvips is imported
+	if vipsProfile:
+		profiling.startVipsProfile(baseDirectory)
 	import buildMapIDs
+	import shards
+
+	# A shard "i/N" builds only its share of the mapIDs, see merge()
+	if shard:
+		shard = shards.parseShard(shard)
+
+	# "--profile" runs cProfile, "--profile=sampling" the stack sampler, and
+	# "--profile-mapid=a,b" limits either to those mapIDs
+	if profile or profileMapid:
+		mode = profile if isinstance(profile, str) else "cprofile"
+		profiling.startProfiling(baseDirectory, mode, profileMapid)
+
+	# "--icons-only" rewrites the icon overlays or vector icon layers alone
+	buildMapIDs.actionRoutine(baseDirectory, shard, iconsOnly)
+	profiling.writeProfiles(baseDirectory)
+
+def runDaemon(version, port=None, watch=False):
+	from config import GlobalCoordinateDefinition, MapBuilderConfig
+	WORKING_DIR = f"./osrs-wiki-maps/out/mapgen/versions/{version}"
+	GlobalCoordinateDefinition.fromJSON(f"{WORKING_DIR}/coordinateData.json")
+	MapBuilderConfig.fromJSON("./scripts/mapBuilderConfig.json")
+	import builddaemon
 
+	# Stays resident, rebuilding mapIDs on request or, with "--watch", as
+	# their definitions are saved
 	baseDirectory = os.path.join(BASE_DIRECTORY, version)
-	buildMapIDs.actionRoutine(baseDirectory)
+	builddaemon.serve(baseDirectory, "./scripts/mapBuilderConfig.json",
+					  port, watch)
+
+def serveTiles(version, port=None):
+	from config import GlobalCoordinateDefinition, MapBuilderConfig
+	WORKING_DIR = f"./osrs-wiki-maps/out/mapgen/versions/{version}"
+	GlobalCoordinateDefinition.fromJSON(f"{WORKING_DIR}/coordinateData.json")
+	MapBuilderConfig.fromJSON("./scripts/mapBuilderConfig.json")
+	import tileserver
+
+	# Renders tiles as they are requested, rather than building every mapID
+	baseDirectory = os.path.join(BASE_DIRECTORY, version)
+	tileserver.serve(baseDirectory, port)
+
+def merge(version):
+	from config import MapBuilderConfig
+	MapBuilderConfig.fromJSON("./scripts/mapBuilderConfig.json")
+	import shards
+
+	# Combine the outputs of every buildAllMapIDs shard
+	baseDirectory = os.path.join(BASE_DIRECTORY, version)
+	shards.merge(baseDirectory)
+
+def parseArguments(args):
+	# Positional args are passed through, while "--name=value" options
+	# become keyword args and a bare "--name" is a flag
+	positionalArgs = list()
+	options = dict()
+	for arg in args:
+		if arg.startswith("--"):
+			name, _, value = arg[2:].partition("=")
+			# Dashed option names match the camelCase function arguments
+			first, *rest = name.split("-")
+			name = first + "".join(part.capitalize() for part in rest)
+			options[name] = value if value else True
+		else:
+			positionalArgs.append(arg)
+	return positionalArgs, options
 
 if __name__ == "__main__":
 	"""
@@ -87,9 +212,14 @@ if __name__ == "__main__":
 	2) Dump from the game cache(workingPath)
 	3) createBaseTiles(workingPath)
 	4) buildMapIDs(workingPath)
+
+	The mapID build may instead be split across machines by running
+	buildAllMapIDs(workingPath, --shard=i/N) for each i from 1 to N, then
+	merge(workingPath) once every shard's outputs are in one place.
 	"""
 	args = sys.argv
 	# args[0] = current file
 	# args[1] = function name
-	# args[2:] = function args : (*unpacked)
-	globals()[args[1]](*args[2:])
\ No newline at end of file
+	# args[2:] = function args : (*unpacked), with --options as kwargs
+	positionalArgs, options = parseArguments(args[2:])
+	globals()[args[1]](*positionalArgs, **options)
\ No newline at end of file
@@ -0,0 +1,298 @@
+"""
+Keeps a map builder resident, rebuilding mapIDs as their inputs change
+
+A fresh build re-imports pyvips, parses the configuration and definitions,
+decodes every icon sprite and starts with a cold libvips operation cache. The
+daemon does that once, then rebuilds in its own process whenever asked over
+its HTTP API or, in watch mode, whenever a watched file is saved. Only the
+mapIDs whose fingerprint changed are rebuilt. A fingerprint hashes a mapID's
+definitions together with the configuration and icon inputs, and the
+fingerprints of the last build are kept in the daemon directory between
+runs. Rebuilt planes and composites still come from the stage cache when
+their own inputs are unchanged.
+
+	GET  /status     the daemon's state and its last build
+	POST /build      rebuilds the changed mapIDs, or {"mapIds": [...]} or
+	                 {"mapIds": "all"}, answering once they are built
+	POST /shutdown   stops the daemon
+"""
+from config import MapBuilderConfig
+CONFIG = MapBuilderConfig()
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import buildMapIDs
+import stagecache
+import iconlayer
+import traceback
+import threading
+import hashlib
+import shutil
+import glob
+import json
+import time
+import os
+
+# Only local editors and previews talk to the daemon
+HOST = "127.0.0.1"
+
+
+def getFileDigest(paths):
+	digest = hashlib.sha256()
+	for path in paths:
+		digest.update(os.path.basename(path).encode())
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				digest.update(hashlib.sha256(f.read()).digest())
+	return digest.hexdigest()
+
+
+def getDefinitionDigest(mapDefs):
+	# Definitions from the snapshot hold arrays of rows, and those from JSON
+	# hold lists, so each is hashed by its own contents
+	digest = hashlib.sha256()
+	for name, value in sorted((mapDefs or dict()).items()):
+		digest.update(name.encode())
+		if isinstance(value, np.ndarray):
+			digest.update(np.ascontiguousarray(value).tobytes())
+		else:
+			digest.update(json.dumps(value, sort_keys=True).encode())
+	return digest.hexdigest()
+
+
+class BuildDaemon:
+	def __init__(self, basePath, configPath):
+		self.basePath = basePath
+		self.configPath = configPath
+		self.renderPlan = dict()
+		self.iconManager = None
+		self.iconDigest = None
+		self.fingerprints = None
+		self.lastBuild = None
+		self.watching = False
+		self.buildLock = threading.Lock()
+		self.stopped = threading.Event()
+		self.statePath = os.path.join(basePath, CONFIG.daemon.daemonPath,
+									  "fingerprints.json")
+
+	def getWatchedPaths(self):
+		return [
+			self.configPath,
+			CONFIG.mapid.userMapDefsPath,
+			os.path.join(self.basePath, CONFIG.mapid.mapDefsPath),
+			*self.getIconPaths()
+		]
+
+	def getIconPaths(self):
+		iconImageDir = os.path.join(self.basePath, CONFIG.icon.iconPath)
+		return [os.path.join(self.basePath, CONFIG.icon.iconDefs),
+				*sorted(glob.glob(os.path.join(iconImageDir, "*.png")))]
+
+	def loadInputs(self):
+		# Rereads the configuration and definitions. The icon manager, which
+		# decodes every sprite, is only replaced when its inputs changed
+		MapBuilderConfig.reloadJSON(self.configPath)
+		self.renderPlan = buildMapIDs.loadRenderPlan(self.basePath)
+		iconDigest = getFileDigest(self.getIconPaths())
+		if iconDigest != self.iconDigest:
+			self.iconManager = buildMapIDs.createIconManager(self.basePath)
+			self.iconDigest = iconDigest
+
+	def getFingerprints(self):
+		# Any change to the options or icons may change every mapID
+		sharedDigest = getFileDigest([self.configPath]) + self.iconDigest
+		return {str(mapID): hashlib.sha256(
+					(sharedDigest + getDefinitionDigest(mapDefs)).encode()
+				).hexdigest()[:16]
+				for mapID, mapDefs in self.renderPlan.items()}
+
+	def loadFingerprints(self):
+		if not os.path.exists(self.statePath):
+			return None
+		with open(self.statePath) as stateFile:
+			return json.load(stateFile)
+
+	def saveFingerprints(self):
+		os.makedirs(os.path.dirname(self.statePath), exist_ok=True)
+		with open(f"{self.statePath}.tmp", 'w') as stateFile:
+			json.dump(self.fingerprints, stateFile, indent=4)
+		os.replace(f"{self.statePath}.tmp", self.statePath)
+
+	def start(self):
+		startTime = time.time()
+		self.loadInputs()
+		self.fingerprints = self.loadFingerprints()
+		if self.fingerprints is None:
+			# Without a record of the last build, the tiles on disk are taken
+			# to match the current inputs
+			self.fingerprints = self.getFingerprints()
+			self.saveFingerprints()
+		print(f"Loaded {len(self.renderPlan)} mapIDs in "
+			  f"{time.time()-startTime:.2f}s")
+
+	def removeOutputs(self, mapID):
+		# Tiles of the last build would otherwise outlive removed squares
+		for directory in {CONFIG.directory.outPath, CONFIG.icon.mapIDDirectory,
+						  CONFIG.icon.overlayPath, CONFIG.icon.vectorPath}:
+			shutil.rmtree(os.path.join(self.basePath, directory, mapID),
+						  ignore_errors=True)
+
+	def updateBasemaps(self, entries: dict, removed: list):
+		basemapsPath = os.path.join(self.basePath, CONFIG.mapid.basemapsPath)
+		basemaps = dict()
+		if os.path.exists(basemapsPath):
+			with open(basemapsPath) as basemapsFile:
+				basemaps = {str(entry["mapId"]): entry
+							for entry in json.load(basemapsFile)}
+		basemaps.update(entries)
+		# Entries are kept in render plan order
+		basemapsList = [basemaps[str(mapID)] for mapID in self.renderPlan
+						if str(mapID) in basemaps and str(mapID) not in removed]
+		with open(basemapsPath, 'w') as basemapsFile:
+			json.dump(basemapsList, basemapsFile)
+
+	def rebuild(self, mapIDs=None):
+		# Builds the given mapIDs, or every mapID whose fingerprint changed,
+		# and removes the outputs of mapIDs no longer defined
+		with self.buildLock:
+			startTime = time.time()
+			self.loadInputs()
+			fingerprints = self.getFingerprints()
+			if mapIDs == "all":
+				changed = list(fingerprints)
+			elif mapIDs is not None:
+				changed = [str(mapID) for mapID in mapIDs
+						   if str(mapID) in fingerprints]
+			else:
+				changed = [mapID for mapID, fingerprint in fingerprints.items()
+						   if self.fingerprints.get(mapID) != fingerprint]
+			removed = [mapID for mapID in self.fingerprints
+					   if mapID not in fingerprints]
+
+			planIDs = {str(mapID): mapID for mapID in self.renderPlan}
+			entries = dict()
+			for mapID in changed:
+				self.removeOutputs(mapID)
+				entries[mapID] = buildMapIDs.buildMapID(
+					planIDs[mapID], self.basePath, self.renderPlan[planIDs[mapID]],
+					self.iconManager)
+				# Recorded as each is built, so a failure keeps the others
+				self.fingerprints[mapID] = fingerprints[mapID]
+				self.saveFingerprints()
+			for mapID in removed:
+				self.removeOutputs(mapID)
+				del self.fingerprints[mapID]
+			# The sprites may have changed along with the mapIDs
+			if changed and CONFIG.icon.iconOutputMode == "vector":
+				iconlayer.writeSpriteAtlas(self.basePath,
+										   self.iconManager.iconIDtoImage)
+			self.saveFingerprints()
+			if entries or removed:
+				self.updateBasemaps(entries, removed)
+			if CONFIG.mapid.stageCacheEnabled:
+				stagecache.prune(self.basePath)
+
+			self.lastBuild = {
+				"built": changed,
+				"removed": removed,
+				"seconds": round(time.time()-startTime, 3),
+				"finished": time.strftime("%Y-%m-%dT%H:%M:%S")
+			}
+			print(f"Rebuilt {len(changed)} mapIDs and removed {len(removed)} "
+				  f"in {self.lastBuild['seconds']:.2f}s")
+			return self.lastBuild
+
+	def getModifiedTimes(self):
+		return {path: os.stat(path).st_mtime_ns if os.path.exists(path)
+				else None for path in self.getWatchedPaths()}
+
+	def watch(self, interval):
+		# Polls the watched files, rebuilding once they stop changing
+		lastTimes = self.getModifiedTimes()
+		while not self.stopped.wait(interval):
+			times = self.getModifiedTimes()
+			if times == lastTimes:
+				continue
+			# Editors may save a file in several writes
+			while not self.stopped.wait(interval):
+				settledTimes = self.getModifiedTimes()
+				if settledTimes == times:
+					break
+				times = settledTimes
+			lastTimes = times
+			try:
+				self.rebuild()
+			except Exception:
+				# A file saved half-edited must not stop the daemon
+				traceback.print_exc()
+
+	def getStatus(self):
+		return {
+			"basePath": self.basePath,
+			"mapIds": len(self.renderPlan),
+			"building": self.buildLock.locked(),
+			"watching": self.watching,
+			"lastBuild": self.lastBuild
+		}
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path == "/status":
+			self.sendJSON(200, self.server.buildDaemon.getStatus())
+		else:
+			self.sendJSON(404, {"error": f"Unknown path {self.path}"})
+
+	def do_POST(self):
+		buildDaemon = self.server.buildDaemon
+		length = int(self.headers.get("Content-Length") or 0)
+		try:
+			body = json.loads(self.rfile.read(length) or "{}")
+		except json.JSONDecodeError as error:
+			self.sendJSON(400, {"error": str(error)})
+			return
+
+		if self.path == "/build":
+			try:
+				self.sendJSON(200, buildDaemon.rebuild(body.get("mapIds")))
+			except Exception as error:
+				traceback.print_exc()
+				self.sendJSON(500, {"error": repr(error)})
+		elif self.path == "/shutdown":
+			self.sendJSON(200, {"stopping": True})
+			buildDaemon.stopped.set()
+			# shutdown() waits for this request to finish, so from elsewhere
+			threading.Thread(target=self.server.shutdown).start()
+		else:
+			self.sendJSON(404, {"error": f"Unknown path {self.path}"})
+
+	def sendJSON(self, status, data):
+		body = json.dumps(data).encode()
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+def serve(basePath, configPath, port=None, watch=False):
+	buildDaemon = BuildDaemon(basePath, configPath)
+	buildDaemon.start()
+	if watch:
+		buildDaemon.watching = True
+		watchThread = threading.Thread(target=buildDaemon.watch, daemon=True,
+									   args=(CONFIG.daemon.watchInterval,))
+		watchThread.start()
+
+	port = int(port or CONFIG.daemon.daemonPort)
+	server = ThreadingHTTPServer((HOST, port), DaemonRequestHandler)
+	server.buildDaemon = buildDaemon
+	print(f"Build daemon listening on http://{HOST}:{port}"
+		  + (f", watching {buildDaemon.getWatchedPaths()}" if watch else ""))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		buildDaemon.stopped.set()
+		server.server_close()
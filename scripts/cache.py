@@ -1,17 +1,53 @@
 from os import mkdir
 import os.path
-from io import BytesIO
 import json
+import bisect
+import shutil
+import hashlib
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 from zipfile import ZipFile
 from string import ascii_lowercase
 from dateutil.parser import isoparse
 import requests
+from requests.adapters import HTTPAdapter
 import pprint
 
 CACHE_URL_BASE = "https://archive.openrs2.org"
 UTC = dt.timezone.utc
 
+# Downloads are streamed to disk in chunks so memory use stays flat
+CHUNK_SIZE = 1024 * 1024
+# Attempts made to resume a download after the connection drops
+DOWNLOAD_RETRIES = 5
+# Ranged segments fetched in parallel, when the server supports ranges
+DOWNLOAD_SEGMENTS = 4
+# Threads decompressing zip entries during extraction
+EXTRACT_WORKERS = os.cpu_count()
+
+_session = None
+
+# Caches which are not listed by the archive, but may be requested by date
+LOCAL_CACHES = [{
+    "timestamp": dt.datetime(2024, 5, 29, 15, 0, 0, 0).strftime("%Y-%m-%dT%H:%M:%SZ"),
+    "id": 11111111111,
+    "scope": "runescape",
+    "game": "oldschool",
+    "environment": "live"
+}]
+
+
+def get_session() -> requests.Session:
+    # A single pooled session reuses connections across every request
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4,
+                              pool_maxsize=max(DOWNLOAD_SEGMENTS, 4))
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
 
 def make_output_folder(date_str: str, sub_ver: int, working_dir: str) -> str:
     # Determine the name of the output folder
@@ -34,45 +70,75 @@ def make_output_folder(date_str: str, sub_ver: int, working_dir: str) -> str:
     return out_folder
 
 
-def get_cache_info(version=None) -> tuple[int, str]:
+def get_cache_info(artifact_dir, version=None) -> tuple[int, str]:
+    cache_index = load_cache_index(artifact_dir)
     if not version:
         # Fetch the latest cache
-        cache_id, date_str, sub_ver = get_latest_cache()
+        cache_id, date_str, sub_ver = get_latest_cache(cache_index)
     else:
         # Fetch a specific cache, passed as an arg
         # Arg should be of format {year}-{month}-{day}_{alphanum}
         date, num = version.split("_")
-        cache_id, date_str, sub_ver = get_specific_cache(date, num)
+        cache_id, date_str, sub_ver = get_specific_cache(date, num,
+                                                         cache_index)
     print(f"Found cache {cache_id} from {date_str}\n")
     return cache_id, date_str, sub_ver
 
 
-def get_specific_cache(date, num) -> tuple[int, str]:
-    year, month, day = map(int, date.split("-"))
-    num = int(num)
-    targetDate = dt.date(year, month, day)
-    cache_list = requests.get(CACHE_URL_BASE + "/caches.json", timeout=15).json()
-    cachesOnSameDay = find_caches_on_date(targetDate, cache_list)
-    timeOptions = sorted(list(cachesOnSameDay.keys()))
+def load_cache_index(artifact_dir) -> list[tuple[dt.datetime, dict]]:
+    # Returns (timestamp, cache) pairs for live oldschool caches, sorted by
+    # timestamp. caches.json is only downloaded again when it has changed,
+    # and the parsed index is kept beside it.
+    os.makedirs(artifact_dir, exist_ok=True)
+    list_path = os.path.join(artifact_dir, "caches.json")
+    meta_path = os.path.join(artifact_dir, "caches.meta.json")
+    index_path = os.path.join(artifact_dir, "caches.index.json")
+
+    meta = dict()
+    headers = dict()
+    if os.path.exists(list_path) and os.path.exists(meta_path):
+        with open(meta_path) as file:
+            meta = json.load(file)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("lastModified"):
+            headers["If-Modified-Since"] = meta["lastModified"]
+
     try:
-        requestedTime = timeOptions[num]
-        cache_id = cachesOnSameDay[requestedTime]["id"]
-        date_str = requestedTime.strftime("%Y-%m-%d")
-        return cache_id, date_str, num
-    except IndexError:
-        raise IndexError(f"Could not find cache number {num} on {targetDate}.\n"
-                         f"Try another date or cache number.")
+        response = get_session().get(CACHE_URL_BASE + "/caches.json",
+                                     headers=headers, timeout=15)
+        response.raise_for_status()
+    except requests.RequestException:
+        if not headers:
+            raise
+        # The archive is unreachable, but the last known list will do
+        print("Could not reach the cache archive, using the saved cache list")
+        response = None
+
+    if response is not None and response.status_code != 304:
+        with open(list_path, "wb") as file:
+            file.write(response.content)
+        meta = {"etag": response.headers.get("ETag"),
+                "lastModified": response.headers.get("Last-Modified")}
+        with open(meta_path, "w") as file:
+            json.dump(meta, file)
+        cache_index = build_cache_index(response.json())
+        save_cache_index(cache_index, index_path)
+    elif os.path.exists(index_path):
+        cache_index = read_cache_index(index_path)
+    else:
+        with open(list_path) as file:
+            cache_index = build_cache_index(json.load(file))
+        save_cache_index(cache_index, index_path)
 
+    # Caches that only exist locally are always included
+    for cache in LOCAL_CACHES:
+        bisect.insort(cache_index, (isoparse(cache["timestamp"]), cache),
+                      key=lambda entry: entry[0])
+    return cache_index
 
-def find_caches_on_date(targetDate, cache_list):
-    cache_list.append({
-            "timestamp": dt.datetime(2024, 5, 29, 15, 0, 0, 0).strftime("%Y-%m-%dT%H:%M:%SZ"),
-            "id": 11111111111,
-            "scope": "runescape",
-            "game": "oldschool",
-            "environment": "live"
-        })
 
+def build_cache_index(cache_list) -> list[tuple[dt.datetime, dict]]:
     cacheTimeMap = dict()
     for cache in cache_list:
         # Cache must be of the correct type
@@ -87,39 +153,56 @@ def find_caches_on_date(targetDate, cache_list):
             continue
         timestamp = isoparse(timestamp)
         cacheTimeMap[timestamp] = cache
+    return sorted(cacheTimeMap.items(), key=lambda entry: entry[0])
 
-    def sameDate(targetDate: dt.datetime, itemToCheck: dt.datetime):
-        return targetDate == itemToCheck.date()
 
-    # Filter the dict to only entries that fall on the same day
-    cachesOnSameDay = {timestamp: cache for timestamp, cache 
-                       in cacheTimeMap.items() 
-                       if sameDate(targetDate, timestamp)}
-    return cachesOnSameDay
+def save_cache_index(cache_index, index_path):
+    # Only what is needed to choose a cache is kept, with parsed timestamps
+    entries = [{"timestamp": timestamp.timestamp(), "id": cache["id"]}
+               for timestamp, cache in cache_index]
+    with open(index_path, "w") as file:
+        json.dump(entries, file)
 
 
-def get_latest_cache() -> tuple[int, str]:
-    cache_list = requests.get(CACHE_URL_BASE + "/caches.json", timeout=15).json()
-    latest = dt.datetime(1970, 1, 1, tzinfo=UTC)
-    cache_id = -1
-    for cache in cache_list:
-        if (cache["scope"] != "runescape" 
-                or cache["game"] != "oldschool" 
-                or cache["environment"] != "live"):
-            continue
+def read_cache_index(index_path) -> list[tuple[dt.datetime, dict]]:
+    with open(index_path) as file:
+        entries = json.load(file)
+    return [(dt.datetime.fromtimestamp(entry["timestamp"], tz=UTC), entry)
+            for entry in entries]
+
+
+def get_specific_cache(date, num, cache_index) -> tuple[int, str]:
+    year, month, day = map(int, date.split("-"))
+    num = int(num)
+    targetDate = dt.date(year, month, day)
+    cachesOnSameDay = find_caches_on_date(targetDate, cache_index)
+    try:
+        requestedTime, cache = cachesOnSameDay[num]
+        cache_id = cache["id"]
+        date_str = requestedTime.strftime("%Y-%m-%d")
+        return cache_id, date_str, num
+    except IndexError:
+        raise IndexError(f"Could not find cache number {num} on {targetDate}.\n"
+                         f"Try another date or cache number.")
 
-        timestamp = cache["timestamp"]
-        if not timestamp:
-            continue
 
-        date = isoparse(timestamp)
-        if date > latest:
-            latest = date
-            cache_id = cache["id"]
+def find_caches_on_date(targetDate, cache_index):
+    # The index is sorted, so the day's caches are a contiguous slice
+    dayStart = dt.datetime.combine(targetDate, dt.time(), tzinfo=UTC)
+    dayEnd = dayStart + dt.timedelta(days=1)
+    lower = bisect.bisect_left(cache_index, dayStart,
+                               key=lambda entry: entry[0])
+    upper = bisect.bisect_left(cache_index, dayEnd,
+                               key=lambda entry: entry[0])
+    return cache_index[lower:upper]
 
-    cachesOnSameDay = find_caches_on_date(latest.date(), cache_list)
-    timeOptions = sorted(list(cachesOnSameDay.keys()))
-    sub_ver = len(timeOptions)-1
+
+def get_latest_cache(cache_index) -> tuple[int, str]:
+    latest, cache = cache_index[-1]
+    cache_id = cache["id"]
+
+    cachesOnSameDay = find_caches_on_date(latest.date(), cache_index)
+    sub_ver = len(cachesOnSameDay)-1
 
     date_str = latest.strftime("%Y-%m-%d")
     return cache_id, date_str, sub_ver
@@ -130,7 +213,7 @@ def download_xteas(cache_id, out_folder):
 
     print("Downloading xteas...")
     start = dt.datetime.now()
-    response = requests.get(CACHE_URL_BASE + f"/caches/runescape/{cache_id}/keys.json", timeout=30)
+    response = get_session().get(CACHE_URL_BASE + f"/caches/runescape/{cache_id}/keys.json", timeout=30)
     end = dt.datetime.now()
     print(f"{int((end-start).total_seconds())}s elapsed.\n")
 
@@ -149,27 +232,190 @@ def download_xteas(cache_id, out_folder):
         json.dump(key_list, file)
 
 
-def download_cache(cache_id, out_folder):
+def download_cache(cache_id, out_folder, expected_sha256=None):
+    # The archive is kept beside the output folder so that a failed run
+    # can resume it rather than starting over. The archive publishes no
+    # checksum for disk.zip, so one is only checked when given
+    download_dir = os.path.join(os.path.dirname(out_folder), "downloads")
+    os.makedirs(download_dir, exist_ok=True)
+    zip_path = os.path.join(download_dir, f"{cache_id}-disk.zip")
+
     print("Downloading cache...")
     start = dt.datetime.now()
-    raw = requests.get(CACHE_URL_BASE + f"/caches/runescape/{cache_id}/disk.zip", timeout=60).content
+    url = CACHE_URL_BASE + f"/caches/runescape/{cache_id}/disk.zip"
+    stream_download(url, zip_path, segments=DOWNLOAD_SEGMENTS,
+                    expected_sha256=expected_sha256, timeout=60)
     end = dt.datetime.now()
     print(f"{int((end-start).total_seconds())}s elapsed.\n")
 
-    z = ZipFile(BytesIO(raw))
-    z.extractall(out_folder)
+    extract_zip(zip_path, out_folder)
+    os.remove(zip_path)
+
+
+def stream_download(url, out_path, segments=1, expected_sha256=None,
+                    timeout=60):
+    # Streams the url to out_path, resuming with HTTP ranges after dropped
+    # connections, and optionally fetching ranged segments in parallel
+    session = get_session()
+    head = session.head(url, timeout=timeout, allow_redirects=True)
+    head.raise_for_status()
+    total = int(head.headers.get("Content-Length", 0))
+    supports_ranges = head.headers.get("Accept-Ranges") == "bytes"
+
+    part_path = out_path + ".part"
+    if segments > 1 and supports_ranges and total >= segments * CHUNK_SIZE:
+        download_segments(url, part_path, total, segments, timeout)
+    else:
+        download_range(url, part_path, 0, total - 1 if total else None,
+                       supports_ranges, timeout)
+
+    # Check the result is complete before it replaces anything
+    size = os.path.getsize(part_path)
+    if total and size != total:
+        raise IOError(f"Downloaded {size} of {total} bytes from {url}")
+    if expected_sha256:
+        digest = file_sha256(part_path)
+        if digest != expected_sha256.lower():
+            os.remove(part_path)
+            raise IOError(f"Checksum mismatch for {url}: {digest}")
+    os.replace(part_path, out_path)
+
+
+def download_range(url, part_path, start, end, supports_ranges, timeout):
+    # Appends bytes start to end (inclusive, None for all) of the url to
+    # part_path, picking up from however much of it is already on disk
+    for attempt in range(DOWNLOAD_RETRIES):
+        have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if end is not None and start + have > end:
+            return
+        if have and not supports_ranges:
+            # Without ranges the only option is to start again
+            have = 0
+
+        headers = dict()
+        if supports_ranges and (start + have > 0 or end is not None):
+            last = "" if end is None else end
+            headers["Range"] = f"bytes={start + have}-{last}"
+        try:
+            with get_session().get(url, headers=headers, stream=True,
+                                   timeout=timeout) as response:
+                response.raise_for_status()
+                if headers and response.status_code != 206:
+                    raise IOError(f"{url} ignored the requested byte range")
+                mode = "ab" if have else "wb"
+                with open(part_path, mode) as file:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        file.write(chunk)
+            if end is None:
+                return
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError) as error:
+            print(f"Download interrupted ({error}), resuming...")
+    # The final attempt may still have completed the range
+    have = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if end is None or start + have <= end:
+        raise IOError(f"Could not download {url} after "
+                      f"{DOWNLOAD_RETRIES} attempts")
+
+
+def download_segments(url, part_path, total, segments, timeout):
+    # Each segment resumes independently, then they are joined in order
+    bounds = [total * i // segments for i in range(segments + 1)]
+    segment_paths = [f"{part_path}.{i}" for i in range(segments)]
+    with ThreadPoolExecutor(segments) as pool:
+        futures = [pool.submit(download_range, url, segment_paths[i],
+                               bounds[i], bounds[i + 1] - 1, True, timeout)
+                   for i in range(segments)]
+        for future in futures:
+            future.result()
+
+    with open(part_path, "wb") as file:
+        for segment_path in segment_paths:
+            with open(segment_path, "rb") as segment:
+                shutil.copyfileobj(segment, file, CHUNK_SIZE)
+    for segment_path in segment_paths:
+        os.remove(segment_path)
+
+
+def file_sha256(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_zip(zip_path, out_folder, workers=EXTRACT_WORKERS):
+    # Entries are decompressed in parallel threads, each with its own handle
+    # on the archive. Reading an entry in full checks its CRC.
+    with ZipFile(zip_path) as archive:
+        members = archive.infolist()
+
+    # Directories are made up front so the threads never race to create them
+    for member in members:
+        target = os.path.join(out_folder, member.filename)
+        if member.is_dir():
+            os.makedirs(target, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    # Balance the threads by deflated size, largest entries first
+    files = sorted((member for member in members if not member.is_dir()),
+                   key=lambda member: member.compress_size, reverse=True)
+    workers = max(1, min(workers, len(files)))
+    groups = [files[i::workers] for i in range(workers)]
+
+    def extract_group(group):
+        with ZipFile(zip_path) as archive:
+            for member in group:
+                archive.extract(member, out_folder)
+
+    with ThreadPoolExecutor(workers) as pool:
+        for future in [pool.submit(extract_group, group) for group in groups]:
+            future.result()
 
 
 def download(working_dir, version=None):
-    cache_id, date_str, sub_ver = get_cache_info(version)
+    # Downloaded caches are kept by id beside the version folders, so a
+    # cache that has been fetched before is only linked into a new folder
+    artifact_dir = os.path.join(os.path.dirname(os.path.normpath(working_dir)),
+                                "artifacts")
+    cache_id, date_str, sub_ver = get_cache_info(artifact_dir, version)
     out_folder = make_output_folder(date_str, sub_ver, working_dir)
 
-    download_xteas(cache_id, out_folder)
-    download_cache(cache_id, out_folder)
+    artifact_path = os.path.join(artifact_dir, str(cache_id))
+    complete_path = os.path.join(artifact_path, ".complete")
+    if os.path.exists(complete_path):
+        print(f"Using saved cache {cache_id}\n")
+    else:
+        os.makedirs(artifact_path, exist_ok=True)
+        download_xteas(cache_id, artifact_path)
+        download_cache(cache_id, artifact_path)
+        # Only a fully downloaded and extracted cache may be reused
+        open(complete_path, "w").close()
+    link_artifact(artifact_path, out_folder)
 
     print(f"Cache and xteas saved to {out_folder}")
 
     return os.path.basename(out_folder)
 
+
+def link_artifact(artifact_path, out_folder):
+    # Hardlinks every saved file into the version folder, copying instead
+    # where the filesystem cannot link
+    for dir_path, _, file_names in os.walk(artifact_path):
+        target_dir = os.path.join(out_folder,
+                                  os.path.relpath(dir_path, artifact_path))
+        os.makedirs(target_dir, exist_ok=True)
+        for file_name in file_names:
+            if dir_path == artifact_path and file_name == ".complete":
+                continue
+            source = os.path.join(dir_path, file_name)
+            target = os.path.join(target_dir, file_name)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copy2(source, target)
+
 if __name__ == "__main__":
     download("osrs-wiki-maps/out/mapgen/versions", "2024-05-29_0")
\ No newline at end of file
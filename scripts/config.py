@@ -1,6 +1,10 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, is_dataclass
 import json
 
+# Icons are burned into the rendered tiles, drawn onto overlay tiles of their
+# own, or written as data for the map viewer to draw
+ICON_OUTPUT_MODES = ("burned", "overlay", "vector")
+
 
 class Singleton(type):
 	_instances = {}
@@ -28,6 +32,9 @@ class MapBuilderConfig(metaclass=Singleton):
 		blurRadius: int
 		sourcePath: str
 		outPath: str
+		fusedStyling: bool = True
+		styleCheck: bool = False
+		styleTolerance: int = 0
 
 	@dataclass
 	class ZoomConfig(metaclass=Singleton):
@@ -36,6 +43,7 @@ class MapBuilderConfig(metaclass=Singleton):
 		kernels: dict
 		sourcePath: str
 		outPath: str
+		cullEmptyTiles: bool = True
 
 		def __post_init__(self):
 			# Extract min and max zoom levels for ease of reference
@@ -56,8 +64,14 @@ class MapBuilderConfig(metaclass=Singleton):
 		defsWithIconsFromOtherPlanes: dict
 		planeHasIconsFromPlanes: dict
 		iconSize: int
+		iconOutputMode: str = "burned"
+		overlayPath: str = "tiles/icons"
+		vectorPath: str = "tiles/vector"
 
 		def __post_init__(self):
+			if self.iconOutputMode not in ICON_OUTPUT_MODES:
+				raise ValueError(f"Unknown iconOutputMode {self.iconOutputMode}, "
+								 f"expected one of {ICON_OUTPUT_MODES}")
 			# Adjust str keys to ints for ease of use
 			self.zoomLevelHasIcons = {int(k):v for k,v in 
 				self.zoomLevelHasIcons.items()}
@@ -96,16 +110,93 @@ class MapBuilderConfig(metaclass=Singleton):
 		mapDefsPath: str
 		userMapDefsPath: str
 		basemapsPath: str
+		shardsPath: str = "shards"
+		snapshotEnabled: bool = True
+		snapshotPath: str = "snapshot"
+		stageCacheEnabled: bool = False
+		stageCachePath: str = "stages"
+		stageCacheMB: int = 2048
+
+	# Sections below may be left out of the JSON, which uses these defaults
+	@dataclass
+	class SchedulerConfig(metaclass=Singleton):
+		schedulerEnabled: bool = True
+		workerCount: int = 0
+		mapIDThreads: int = 0
+		memoryBudgetMB: int = 12288
+		workerBaseMemoryMB: int = 200
+		renderBytesPerPixel: float = 1.5
+		tileBytesPerPixel: float = 0.75
+		pixelsPerSecond: int = 20000000
+		splitThresholdSquares: int = 256
+		workPath: str = "jobs"
+
+	@dataclass
+	class TraceConfig(metaclass=Singleton):
+		traceEnabled: bool = False
+		tracePath: str = "traces"
+
+	@dataclass
+	class MetricsConfig(metaclass=Singleton):
+		metricsEnabled: bool = False
+		metricsPath: str = "metrics"
+
+	@dataclass
+	class MemoryConfig(metaclass=Singleton):
+		vipsCacheMaxMB: int = 100
+		vipsCacheMaxOperations: int = 100
+		vipsCacheMaxFiles: int = 100
+		vipsConcurrency: int = 0
+		watchdogEnabled: bool = True
+		watchdogInterval: float = 0.2
+		jobMemoryBudgetMB: int = 0
+		memoryPath: str = "memory"
+
+	@dataclass
+	class DaemonConfig(metaclass=Singleton):
+		daemonPort: int = 8700
+		watchInterval: float = 0.5
+		daemonPath: str = "daemon"
+
+	@dataclass
+	class TileServerConfig(metaclass=Singleton):
+		tileServerPort: int = 8701
+		memoryCacheMB: int = 256
+		diskCacheMB: int = 2048
+		prefetchRadius: int = 1
+		prefetchWorkers: int = 1
+		tileServerPath: str = "tileserver"
 
 	def __init__(self, composite: CompositeConfig, zoom: ZoomConfig, 
 				 tiler: TilerConfig, dir: DirConfig, 
-				 icon: IconConfig, mapid: MapIDConfig) -> None:
+				 icon: IconConfig, mapid: MapIDConfig,
+				 scheduler: SchedulerConfig, trace: TraceConfig,
+				 metrics: MetricsConfig, memory: MemoryConfig,
+				 daemon: DaemonConfig, tileserver: TileServerConfig,
+				 jsonFilePath=None) -> None:
 		self.composite = composite
 		self.zoom = zoom
 		self.tiler = tiler
 		self.directory = dir
 		self.icon = icon
 		self.mapid = mapid
+		self.scheduler = scheduler
+		self.trace = trace
+		self.metrics = metrics
+		self.memory = memory
+		self.daemon = daemon
+		self.tileserver = tileserver
+		# Kept so that worker processes can load the same configuration
+		self.jsonFilePath = jsonFilePath
+
+	@staticmethod
+	def loadSection(sectionClass, options: dict):
+		# Singletons treat a call without arguments as a lookup, so a section
+		# left out of the JSON is created with its defaults here
+		if not options:
+			return Singleton._instances.setdefault(
+				sectionClass, type.__call__(sectionClass))
+		return sectionClass(**options)
 
 	@classmethod
 	def fromJSON(cls, jsonFilePath):
@@ -124,11 +215,49 @@ class MapBuilderConfig(metaclass=Singleton):
 		iconConfig = cls.IconConfig(**iconOpts)
 		mapidOpts = jsonData.get("MAPID_OPTS")
 		mapidConfig = cls.MapIDConfig(**mapidOpts)
+		schedulerOpts = jsonData.get("SCHEDULER_OPTS", dict())
+		schedulerConfig = cls.loadSection(cls.SchedulerConfig, schedulerOpts)
+		traceOpts = jsonData.get("TRACE_OPTS", dict())
+		traceConfig = cls.loadSection(cls.TraceConfig, traceOpts)
+		metricsOpts = jsonData.get("METRICS_OPTS", dict())
+		metricsConfig = cls.loadSection(cls.MetricsConfig, metricsOpts)
+		memoryOpts = jsonData.get("MEMORY_OPTS", dict())
+		memoryConfig = cls.loadSection(cls.MemoryConfig, memoryOpts)
+		daemonOpts = jsonData.get("DAEMON_OPTS", dict())
+		daemonConfig = cls.loadSection(cls.DaemonConfig, daemonOpts)
+		tileServerOpts = jsonData.get("TILESERVER_OPTS", dict())
+		tileServerConfig = cls.loadSection(cls.TileServerConfig, tileServerOpts)
 
 		new = cls(compositeConfig, zoomConfig, tilerConfig, 
-				  dirConfig, iconConfig, mapidConfig)
+				  dirConfig, iconConfig, mapidConfig,
+				  schedulerConfig, traceConfig, metricsConfig,
+				  memoryConfig, daemonConfig, tileServerConfig,
+				  jsonFilePath)
 
 		return new
+
+	@classmethod
+	def reloadJSON(cls, jsonFilePath):
+		# Modules keep the instances they found when imported, so the new
+		# values are copied into those rather than replacing them
+		current = cls()
+		if current is None:
+			return cls.fromJSON(jsonFilePath)
+		sections = {type(section): section for section in vars(current).values()
+					if is_dataclass(section)}
+		for singletonClass in (cls, *sections):
+			Singleton._instances.pop(singletonClass)
+		reloaded = cls.fromJSON(jsonFilePath)
+
+		for name, value in vars(reloaded).items():
+			if is_dataclass(value):
+				vars(sections[type(value)]).update(vars(value))
+				value = sections[type(value)]
+			setattr(current, name, value)
+		Singleton._instances[cls] = current
+		for sectionClass, section in sections.items():
+			Singleton._instances[sectionClass] = section
+		return current
 	
 
 # Alternative approach I'm not sure about
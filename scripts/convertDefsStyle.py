@@ -8,6 +8,8 @@
 # Zone (8x8 tiles) definitions, split into separate files per MapID:
 # Square: https://gist.github.com/TWCCarlson/99936eee7f6728680bde4cb164e0609e
 # Zone: https://gist.github.com/TWCCarlson/23c32818ffaa4a77b8eae41754708524
+# Rectangles of zones are written as region definitions, which the builder
+# expands lazily rather than storing one zone definition per zone
 
 # This file provides utility functions that convert from one to the other
 # Results may not be indentical .json files but should yield identical results
@@ -167,38 +169,27 @@ def unpackWorldMapDef(wmd):
 
 def createCompositeDefs_FromWMD0(wmd, id):
     # Selects a set of squares (in a rectangle) and zones to render in place
-    minLevel = wmd["plane"]
-    levels = wmd["numberOfPlanes"]
-    lowerSquareX = wmd["xLow"]
-    lowerSquareZ = wmd["zLow"]
-    upperSquareX = wmd["xHigh"]
-    upperSquareZ = wmd["zHigh"]
-    lowerZoneX = wmd["chunk_xLow"]
-    lowerZoneZ = wmd["chunk_zLow"]
-    upperZoneX = wmd["chunk_xHigh"]
-    upperZoneZ = wmd["chunk_zHigh"]
-    defsList = list()
-    for sqX in range(lowerSquareX, upperSquareX+1):
-        for sqZ in range(lowerSquareZ, upperSquareZ+1):
-            for znX in range(lowerZoneX, upperZoneX+1):
-                for znZ in range(lowerZoneZ, upperZoneZ+1):
-                    zoneDef = {
-                        "minLevel": minLevel,
-                        "levels": levels,
-                        "sourceSquareX": sqX,
-                        "sourceSquareZ": sqZ,
-                        "displaySquareX": sqX,
-                        "displaySquareZ": sqZ,
-                        "sourceZoneX": znX,
-                        "sourceZoneZ": znZ,
-                        "displayZoneX": znX,
-                        "displayZoneZ": znZ,
-                        "groupId": id,
-                        "fileId": 0,
-                        "WMD_type": 0
-                    }
-                    defsList.append(zoneDef)
-    return defsList
+    # The rectangle is kept whole, the builder places it one square at a time
+    regionDef = {
+        "minLevel": wmd["plane"],
+        "levels": wmd["numberOfPlanes"],
+        "sourceSquareX": wmd["xLow"],
+        "sourceSquareZ": wmd["zLow"],
+        "displaySquareX": wmd["xLow"],
+        "displaySquareZ": wmd["zLow"],
+        "sourceZoneX": wmd["chunk_xLow"],
+        "sourceZoneZ": wmd["chunk_zLow"],
+        "displayZoneX": wmd["chunk_xLow"],
+        "displayZoneZ": wmd["chunk_zLow"],
+        "squareWidth": wmd["xHigh"] - wmd["xLow"] + 1,
+        "squareHeight": wmd["zHigh"] - wmd["zLow"] + 1,
+        "zoneWidth": wmd["chunk_xHigh"] - wmd["chunk_xLow"] + 1,
+        "zoneHeight": wmd["chunk_zHigh"] - wmd["chunk_zLow"] + 1,
+        "groupId": id,
+        "fileId": 0,
+        "WMD_type": 0
+    }
+    return [regionDef]
 
 
 def createCompositeDefs_FromWMD1(wmd, id):
@@ -271,53 +262,40 @@ def createCompositeDefs_FromWMD2(wmd, id):
 
 
 def createCompositeDefs_FromWMD3(wmd, id):
-    minLevel = wmd["oldPlane"]
-    levels = wmd["numberOfPlanes"]
-    sourceSquareX = wmd["oldX"]
-    sourceSquareZ = wmd["oldZ"]
-    displaySquareX = wmd["newX"]
-    displaySquareZ = wmd["newZ"]
-    sourceLowerZoneX = wmd["chunk_oldXLow"]
-    sourceLowerZoneZ = wmd["chunk_oldZLow"]
-    sourceUpperZoneX = wmd["chunk_oldXHigh"]
-    sourceUpperZoneZ = wmd["chunk_oldZHigh"]
-    displayLowerZoneX = wmd["chunk_newXLow"]
-    displayLowerZoneZ = wmd["chunk_newZLow"]
-    displayUpperZoneX = wmd["chunk_newXHigh"]
-    displayUpperZoneZ = wmd["chunk_newZHigh"]
-    defsList = list()
-    for x in range(sourceLowerZoneX, sourceUpperZoneX+1):
-        for z in range(sourceLowerZoneZ, sourceUpperZoneZ+1):
-            zoneDef = {
-                "minLevel": minLevel,
-                "levels": levels,
-                "sourceSquareX": sourceSquareX,
-                "sourceSquareZ": sourceSquareZ,
-                "displaySquareX": displaySquareX,
-                "displaySquareZ": displaySquareZ,
-                "sourceZoneX": x,
-                "sourceZoneZ": z,
-                "displayZoneX": x-sourceLowerZoneX + displayLowerZoneX,
-                "displayZoneZ": z-sourceLowerZoneZ + displayLowerZoneZ,
-                "groupId": id,
-                "fileId": 0,
-                "WMD_type": 3
-            }
-            defsList.append(zoneDef)
-    return defsList
+    # Selects a rectangle of zones in one square, rendering them somewhere
+    regionDef = {
+        "minLevel": wmd["oldPlane"],
+        "levels": wmd["numberOfPlanes"],
+        "sourceSquareX": wmd["oldX"],
+        "sourceSquareZ": wmd["oldZ"],
+        "displaySquareX": wmd["newX"],
+        "displaySquareZ": wmd["newZ"],
+        "sourceZoneX": wmd["chunk_oldXLow"],
+        "sourceZoneZ": wmd["chunk_oldZLow"],
+        "displayZoneX": wmd["chunk_newXLow"],
+        "displayZoneZ": wmd["chunk_newZLow"],
+        "squareWidth": 1,
+        "squareHeight": 1,
+        "zoneWidth": wmd["chunk_oldXHigh"] - wmd["chunk_oldXLow"] + 1,
+        "zoneHeight": wmd["chunk_oldZHigh"] - wmd["chunk_oldZLow"] + 1,
+        "groupId": id,
+        "fileId": 0,
+        "WMD_type": 3
+    }
+    return [regionDef]
 
 def createCompositeDefs_FromWorldMapDef(wmd, type, id):
     squareDefs = list()
-    zoneDefs = list()
+    regionDefs = list()
     if type == "0":
-        zoneDefs.extend(createCompositeDefs_FromWMD0(wmd, id))
+        regionDefs.extend(createCompositeDefs_FromWMD0(wmd, id))
     elif type == "1":
         squareDefs.extend(createCompositeDefs_FromWMD1(wmd, id))
     elif type == "2":
         squareDefs.extend(createCompositeDefs_FromWMD2(wmd, id))
     elif type == "3":
-        zoneDefs.extend(createCompositeDefs_FromWMD3(wmd, id))
-    return squareDefs, zoneDefs
+        regionDefs.extend(createCompositeDefs_FromWMD3(wmd, id))
+    return squareDefs, regionDefs
 
 
 def WorldMapDef_to_CompositeMapDef(filePath):
@@ -343,6 +321,7 @@ def WorldMapDef_to_CompositeMapDef(filePath):
             newDef["name"] = f"Unknown - {mapID}"
         newDef["mapSquareDefinitions"] = list()
         newDef["zoneDefinitions"] = list()
+        newDef["regionDefinitions"] = list()
         for i, defn in enumerate(mapDefs.get("regionList"), 0):
             # Unload (and correct) the data while determining type
             data, wmd_type = unpackWorldMapDef(defn)
@@ -357,10 +336,10 @@ def WorldMapDef_to_CompositeMapDef(filePath):
                 count[wmd_type] += 1
 
             defn["wmd_type"] = int(wmd_type)
-            sqDefs, znDefs = createCompositeDefs_FromWorldMapDef(data, wmd_type, 
+            sqDefs, rgDefs = createCompositeDefs_FromWorldMapDef(data, wmd_type, 
                                                                  i)
             newDef["mapSquareDefinitions"].extend(sqDefs)
-            newDef["zoneDefinitions"].extend(znDefs)
+            newDef["regionDefinitions"].extend(rgDefs)
         defnList.append(newDef)
     
     # Write the resulting defs to disk
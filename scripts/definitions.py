@@ -2,22 +2,49 @@ from config import MapBuilderConfig, GlobalCoordinateDefinition
 CONFIG = MapBuilderConfig()
 GCS = GlobalCoordinateDefinition()
 
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 import json
 
 
+# Field order of definitions stored as rows of typed arrays
+SQUARE_COLUMNS = ("groupId", "sourceSquareX", "sourceSquareZ",
+				  "displaySquareX", "displaySquareZ", "minLevel", "levels",
+				  "fileId")
+ZONE_COLUMNS = SQUARE_COLUMNS + ("sourceZoneX", "sourceZoneZ",
+								 "displayZoneX", "displayZoneZ")
+REGION_COLUMNS = ZONE_COLUMNS + ("squareWidth", "squareHeight",
+								   "zoneWidth", "zoneHeight")
+ICON_COLUMNS = ("x_tile", "z_tile", "plane", "spriteID")
+
+
 def loadMapDefinitions(mapID, mapDefs: dict, basePath):
 	# Reads the map definitions and extracts the square and zone definitions
 	# for the supplied mapID, returning the list of definition objects
+	# Definitions loaded from a snapshot are already typed arrays
+	if "squareRows" in mapDefs:
+		squareDefs = SquareDefinition.squareDefsFromArray(
+			mapDefs["squareRows"], basePath)
+		zoneDefs = ZoneDefinition.zoneDefsFromArray(
+			mapDefs["zoneRows"], basePath)
+		zoneDefs.extend(RegionDefinition.regionDefsFromArray(
+			mapDefs["regionRows"], basePath))
+		return squareDefs, zoneDefs
+
 	# Load baseline definitions
 	squareDefsJSON = mapDefs.get("mapSquareDefinitions")
 	zoneDefsJSON = mapDefs.get("zoneDefinitions")
+	regionDefsJSON = mapDefs.get("regionDefinitions")
 	squareDefs = SquareDefinition.squareDefsFromJSON(squareDefsJSON, basePath)
 	zoneDefs = ZoneDefinition.zoneDefsFromJSON(zoneDefsJSON, basePath)
+	# Regions are rectangles of zones, kept whole until the builder places
+	# them, and sorted among the zones they would otherwise expand into
+	zoneDefs.extend(RegionDefinition.regionDefsFromJSON(regionDefsJSON,
+														basePath))
 	return squareDefs, zoneDefs
 
 
-@dataclass(order=True)
+# Definitions are slotted, as the debug mapID alone creates one per square
+@dataclass(order=True, slots=True)
 class SquareDefinition:
 	groupId: int
 	sourceSquareX: int = field(compare=False)
@@ -66,6 +93,11 @@ class SquareDefinition:
 			squareList.append(newSquare)
 		return squareList
 	
+	@classmethod
+	def squareDefsFromArray(cls, squareRows, basePath):
+		# Rows hold the SQUARE_COLUMNS fields in constructor order
+		return [cls(*row, basePath) for row in squareRows.tolist()]
+
 	@classmethod
 	def spoofAllSquareDefs(cls, basePath):
 		# Creates all definitions spanning the plane, where source = display
@@ -102,6 +134,11 @@ class SquareDefinition:
 	
 	def getFullDisplay(self) -> tuple:
 		return (self.displaySquareX, self.displaySquareZ)
+
+	def getDisplayBounds(self) -> tuple:
+		# Lower and upper display squares covered by the definition
+		return (self.displaySquareX, self.displaySquareX,
+				self.displaySquareZ, self.displaySquareZ)
 	
 	def getPlaneRange(self) -> tuple:
 		return (self.lowerPlane, self.upperPlane)
@@ -112,7 +149,7 @@ class SquareDefinition:
 		return repr
 
 
-@dataclass(order=True)
+@dataclass(order=True, slots=True)
 class ZoneDefinition(SquareDefinition):
 	# Specifies a subset of a mapSquare, 32 x 32px
 	sourceZoneX: int = field(compare=False)
@@ -155,6 +192,14 @@ class ZoneDefinition(SquareDefinition):
 			zoneList.append(newZone)
 		return zoneList
 
+	@classmethod
+	def zoneDefsFromArray(cls, zoneRows, basePath):
+		# Rows hold the ZONE_COLUMNS fields, with basePath between the square
+		# and zone fields in the constructor
+		squareFields = len(SQUARE_COLUMNS)
+		return [cls(*row[:squareFields], basePath, *row[squareFields:])
+				for row in zoneRows.tolist()]
+
 	def getSourceZone(self) -> tuple:
 		return (self.sourceZoneX, self.sourceZoneZ)
 
@@ -177,7 +222,121 @@ class ZoneDefinition(SquareDefinition):
 		return repr
 
 
-@dataclass(order=True)
+@dataclass(order=True, slots=True)
+class RegionDefinition(ZoneDefinition):
+	# A rectangle of squares, each contributing the same rectangle of zones
+	# The inherited fields give the lower left square and zone of each
+	squareWidth: int = field(compare=False)
+	squareHeight: int = field(compare=False)
+	zoneWidth: int = field(compare=False)
+	zoneHeight: int = field(compare=False)
+
+	@classmethod
+	def regionDefsFromJSON(cls, regionDefsList, basePath):
+		# Parse the passed list, generating region definition objects
+		regionList = list()
+		# If there are no regions, skip
+		if not regionDefsList:
+			return regionList
+
+		for data in regionDefsList:
+			# Get definition data
+			sourceZoneX = data.get("sourceZoneX")
+			sourceZoneZ = data.get("sourceZoneZ")
+			displayZoneX = data.get("displayZoneX")
+			displayZoneZ = data.get("displayZoneZ")
+			minLevel = data.get("minLevel")
+			levels = data.get("levels")
+			sourceSquareX = data.get("sourceSquareX")
+			sourceSquareZ = data.get("sourceSquareZ")
+			displaySquareX = data.get("displaySquareX")
+			displaySquareZ = data.get("displaySquareZ")
+			groupID = data.get("groupId")
+			fileID = data.get("fileId")
+			squareWidth = data.get("squareWidth")
+			squareHeight = data.get("squareHeight")
+			zoneWidth = data.get("zoneWidth")
+			zoneHeight = data.get("zoneHeight")
+
+			# Create new instance
+			newRegion = cls(groupID,
+							sourceSquareX, sourceSquareZ, 
+							displaySquareX, displaySquareZ,
+							minLevel, levels,
+							fileID, basePath,
+							sourceZoneX, sourceZoneZ,
+							displayZoneX, displayZoneZ,
+							squareWidth, squareHeight,
+							zoneWidth, zoneHeight
+						)
+			regionList.append(newRegion)
+		return regionList
+
+	@classmethod
+	def regionDefsFromArray(cls, regionRows, basePath):
+		# Rows hold the REGION_COLUMNS fields, with basePath between the
+		# square and zone fields in the constructor
+		squareFields = len(SQUARE_COLUMNS)
+		return [cls(*row[:squareFields], basePath, *row[squareFields:])
+				for row in regionRows.tolist()]
+
+	def getDisplayBounds(self) -> tuple:
+		return (self.displaySquareX, self.displaySquareX + self.squareWidth - 1,
+				self.displaySquareZ, self.displaySquareZ + self.squareHeight - 1)
+
+	def getDisplayZones(self) -> list[tuple]:
+		# Display zones covered within each square
+		return [(self.displayZoneX + i, self.displayZoneZ + j)
+				for i in range(0, self.zoneWidth)
+				for j in range(0, self.zoneHeight)]
+
+	def splitSquares(self) -> list['RegionDefinition']:
+		# One region per square, each a single rectangle of one source square
+		if self.squareWidth == 1 and self.squareHeight == 1:
+			return [self]
+		regionList = list()
+		for i in range(0, self.squareWidth):
+			for j in range(0, self.squareHeight):
+				regionList.append(replace(self,
+					sourceSquareX=self.sourceSquareX + i,
+					sourceSquareZ=self.sourceSquareZ + j,
+					displaySquareX=self.displaySquareX + i,
+					displaySquareZ=self.displaySquareZ + j,
+					squareWidth=1, squareHeight=1))
+		return regionList
+
+	def getZoneDefinition(self, displayZoneX, displayZoneZ) -> ZoneDefinition:
+		# The zone of a single square region drawn at the display zone
+		return ZoneDefinition(self.groupId,
+							  self.sourceSquareX, self.sourceSquareZ,
+							  self.displaySquareX, self.displaySquareZ,
+							  self.minLevel, self.levels,
+							  self.fileId, self.basePath,
+							  displayZoneX - self.displayZoneX + self.sourceZoneX,
+							  displayZoneZ - self.displayZoneZ + self.sourceZoneZ,
+							  displayZoneX, displayZoneZ
+							)
+
+	def expandToZones(self) -> list[ZoneDefinition]:
+		# The zone definitions the region stands for, in the order the old
+		# per-zone definitions were written
+		zoneList = list()
+		for squareRegion in self.splitSquares():
+			for displayZone in squareRegion.getDisplayZones():
+				zoneList.append(squareRegion.getZoneDefinition(*displayZone))
+		return zoneList
+
+	def __repr__(self) -> str:
+		repr = (f"RegionDef: Source[{self.sourceSquareX}, {self.sourceSquareZ}]"
+				f"{self.sourceZoneX, self.sourceZoneZ} -> "
+				f"Display[{self.displaySquareX}, {self.displaySquareZ}]"
+				f"{self.displayZoneX, self.displayZoneZ} "
+				f"x [{self.squareWidth}, {self.squareHeight}]"
+				f"{self.zoneWidth, self.zoneHeight}")
+		return repr
+
+
+@dataclass(order=True, slots=True)
 class IconDefinition:
 	iconIndex: int
 	x_tile: int = field(compare=False)
@@ -238,6 +397,12 @@ class IconDefinition:
 			iconIndex += 1
 		return iconList
 
+	@classmethod
+	def iconDefsFromArray(cls, iconRows):
+		# Rows hold the ICON_COLUMNS fields, indexed in the order given
+		return [cls(iconIndex, *row)
+				for iconIndex, row in enumerate(iconRows.tolist())]
+
 	def __repr__(self) -> str:
 		repr = (f"IconDef: {self.spriteID}@"
 		  		f"[{self.plane, self.x_tile, self.z_tile}]")
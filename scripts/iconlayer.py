@@ -0,0 +1,97 @@
+"""
+Writes a mapID's icons as data for the map viewer to draw as markers
+
+With the vector icon output mode, icons are not drawn into any tile. Each
+mapID's icons are instead written to <vectorPath>/<mapID>/icons.json as
+[x, z, plane, spriteId] records, in the order a build draws them, where x and
+z are the game tile the icon is displayed on and plane is the plane whose
+tiles it would be drawn onto. Every sprite is packed into one sprites.png
+atlas, and sprites.json gives each sprite's rectangle in the atlas, its
+anchor, which is the pixel drawn over the south-west corner of the icon's
+game tile, and the zoom levels icons are shown at.
+"""
+from config import MapBuilderConfig
+CONFIG = MapBuilderConfig()
+
+from mapelements import MapIcon
+from images import IconImage
+import snapshot
+import metrics
+import math
+import json
+import os
+
+# Pyvips import is OS-dependent, use dispatcher file
+from pyvips_import import pyvips as pv
+
+LAYER_NAME = "icons.json"
+ATLAS_NAME = "sprites.png"
+OFFSETS_NAME = "sprites.json"
+RECORD_FIELDS = ["x", "z", "plane", "spriteId"]
+
+
+def getIconRecords(iconList: dict[int, list[MapIcon]]):
+	return [[icon.displayX_tile, icon.displayZ_tile, plane,
+			 icon.definition.spriteID]
+			for plane, icons in sorted(iconList.items()) for icon in icons]
+
+
+def createIconLayer(mapID, iconList: dict[int, list[MapIcon]]):
+	return {"mapId": mapID, "fields": RECORD_FIELDS,
+			"icons": getIconRecords(iconList)}
+
+
+def encodeJSON(data):
+	return json.dumps(data, separators=(",", ":")).encode()
+
+
+def writeIconLayer(layerPath, mapID, iconList: dict[int, list[MapIcon]]):
+	# Returns the number of icons written
+	metrics.makeDirectories(layerPath)
+	iconLayer = createIconLayer(mapID, iconList)
+	with open(os.path.join(layerPath, LAYER_NAME), 'wb') as layerFile:
+		layerFile.write(encodeJSON(iconLayer))
+	metrics.count("iconsPlaced", len(iconLayer["icons"]))
+	return len(iconLayer["icons"])
+
+
+def getAnchor(width, height):
+	# The inverse of MapBuilder.getIconPosition, which draws an icon's top
+	# left this far left of and above the corner of its game tile
+	return [math.ceil(width/2) + 1, math.ceil(height/2) + 1]
+
+
+def createSpriteAtlas(iconImages: dict[int, IconImage]):
+	# Returns the atlas image and the offsets of the sprites in it
+	sprites = dict()
+	for spriteID, iconImage in iconImages.items():
+		image = iconImage.image
+		sprites[spriteID] = (image.numpy().reshape(image.height, image.width,
+												   image.bands),
+							 image.interpretation)
+	# Sprites carry their coverage band, so markers show only the pixels
+	# tiles do
+	atlas, rects = snapshot.packSpriteArrays(sprites)
+
+	offsets = {
+		"zoomLevels": sorted(zoomLevel for zoomLevel, hasIcons in
+							 CONFIG.icon.zoomLevelHasIcons.items() if hasIcons),
+		"sprites": {str(spriteID): {"x": x, "y": y, "width": width,
+									"height": height,
+									"anchor": getAnchor(width, height)}
+					for spriteID, (x, y, width, height, _, _)
+					in sorted(rects.items())}
+	}
+	return pv.Image.new_from_array(atlas, interpretation="srgb"), offsets
+
+
+def writeSpriteAtlas(basePath, iconImages: dict[int, IconImage]):
+	vectorPath = os.path.join(basePath, CONFIG.icon.vectorPath)
+	os.makedirs(vectorPath, exist_ok=True)
+	atlas, offsets = createSpriteAtlas(iconImages)
+	atlasPath = os.path.join(vectorPath, ATLAS_NAME)
+	atlas.write_to_file(atlasPath)
+	metrics.countWrite(atlasPath)
+	with open(os.path.join(vectorPath, OFFSETS_NAME), 'wb') as offsetsFile:
+		offsetsFile.write(encodeJSON(offsets))
+	print(f"Sprite atlas of {len(iconImages)} icons saved to {vectorPath}")
@@ -2,8 +2,10 @@ from config import MapBuilderConfig, GlobalCoordinateDefinition
 CONFIG = MapBuilderConfig()
 GCS = GlobalCoordinateDefinition()
 
+import metrics
 import os
 import math
+import numpy as np
 
 # Pyvips import is OS-dependent, use dispatcher file
 from pyvips_import import pyvips as pv
@@ -24,17 +26,47 @@ class MapImage():
 		self.image = image
 
 	def getMask(self):
-		color = CONFIG.composite.transparencyColor
-		tolerance = CONFIG.composite.transparencyTolerance
-		return (abs(self.image - color) > tolerance).bandor()
+		return MapImage.getCoverage(self.image)
 	
 	def overlayImage(self, baseImage):
 		mask = self.getMask()
-		return mask.ifthenelse(self.image, baseImage)
+		return mask.ifthenelse(MapImage.getColour(self.image), baseImage)
 	
 	def writeImageToFile(self, name):
 		self.image.write_to_file(name)
 
+	### Coverage
+	# Map images carry a fourth, coverage band which is 255 wherever a pixel
+	# is drawn. The cache dump marks undrawn pixels with the transparency
+	# colour, so the band is keyed from it once, as the base tiles are
+	# sliced. Cells without a source tile are left out of the band by the
+	# definitions, and it is then carried through compositing and rescaling
+	@staticmethod
+	def keyCoverage(array: np.ndarray):
+		# The coverage band of an RGB array from the cache dump
+		color = CONFIG.composite.transparencyColor
+		tolerance = CONFIG.composite.transparencyTolerance
+		difference = np.abs(array.astype(np.int16) - color)
+		covered = (difference > tolerance).any(axis=2)
+		return covered.astype(np.uint8) * 255
+
+	@staticmethod
+	def loadTile(sourcePath):
+		image = pv.Image.new_from_file(sourcePath)
+		metrics.countRead(sourcePath)
+		if image.bands != 4:
+			raise ValueError(f"Base tile {sourcePath} has no coverage band, "
+							 f"slice the base tiles again with createBaseTiles")
+		return image
+
+	@staticmethod
+	def getCoverage(image):
+		return image[3]
+
+	@staticmethod
+	def getColour(image):
+		return image.extract_band(0, n=3)
+
 	### Generic image processing
 	@staticmethod
 	def brightnessAndContrast(image):
@@ -77,6 +109,72 @@ class MapImage():
 			return image.gaussblur(sigma, min_ampl=nthGaussTerm, precision="float")
 		return image
 
+	@staticmethod
+	def getBlurMask():
+		# The separable Gaussian mask of the blur, a single row
+		sigma = 1
+		n = CONFIG.composite.blurRadius + 1
+		nthGaussTerm = math.e ** (-(n**2)/(2 * (sigma**2)))
+		return pv.Image.gaussmat(sigma, nthGaussTerm, separable=True,
+								 precision="float")
+
+	@staticmethod
+	def blurCoverage(coverage):
+		# Blurring spreads colour as far as its mask reaches, so the
+		# coverage band is grown by that much. Colour that rounds away at the
+		# very edge is still covered, as it would be by any wider stroke
+		if CONFIG.composite.blurRadius <= 0:
+			return coverage
+		width = MapImage.getBlurMask().width
+		square = pv.Image.new_from_list([[255] * width] * width)
+		return coverage.morph(square, "dilate")
+
+	### Fused image processing
+	# Equivalent to the generic steps above, but kept in 8-bit integers. The
+	# float steps are truncated to 8 bits where the generic ones are cast,
+	# so both give the same pixels once saved
+	@staticmethod
+	def styleImage(image):
+		# Fused brightnessAndContrast, grayscale and blur
+		image = MapImage.adjustLevels(image)
+		image = MapImage.desaturate(image)
+		image = MapImage.blur(image)
+		return image.cast("uchar")
+
+	@staticmethod
+	def adjustLevels(image):
+		# Brightness and contrast act on each value alone, so they are
+		# precomputed for all 256 values and applied as a lookup table
+		identity = pv.Image.identity()
+		lookupTable = MapImage.brightnessAndContrast(identity).cast("uchar")
+		if (lookupTable == identity).min() == 255:
+			return image
+		return image.maplut(lookupTable)
+
+	@staticmethod
+	def desaturate(image):
+		# The saturation is scaled in libvips' 8-bit HSV, as grayscale does,
+		# through a lookup table. The round trip through HSV rounds colours
+		# too, so it is made even when nothing is grayscaled
+		grayscaleFrac = CONFIG.composite.grayscaleFraction
+		if not 0 <= grayscaleFrac <= 1:
+			raise ValueError("Grayscale adjustment fraction not between 0 and 1")
+		lookupTable = (pv.Image.identity() * (1 - grayscaleFrac)).cast("uchar")
+		hue, saturation, value = image.colourspace("hsv").bandsplit()
+		image = hue.bandjoin([saturation.maplut(lookupTable), value])
+		return image.copy(interpretation="hsv").colourspace("srgb")
+
+	@staticmethod
+	def compareImages(image, referenceImage, tolerance):
+		# Raises if any pixel value differs by more than the tolerance
+		difference = (image.cast("float") - referenceImage.cast("float")).abs()
+		maxDifference = difference.max()
+		if maxDifference > tolerance:
+			raise ValueError(f"Styled image differs from the reference styling "
+							 f"by {maxDifference:.0f}, more than the tolerance "
+							 f"of {tolerance}")
+		return maxDifference
+
 
 class PlaneImage(MapImage):
 	# Plane images are used for processing composites and styling
@@ -93,38 +191,79 @@ class SquareImage(MapImage):
 		# Load the image in from file
 		px = GCS.squarePixelLength
 		if os.path.exists(self.sourcePath):
-			self.image = pv.Image.new_from_file(self.sourcePath)
+			self.image = MapImage.loadTile(self.sourcePath)
 		else:
-			self.image = self.createBlankImage(px, px, 3)
+			self.image = self.createBlankImage(px, px, 4)
 
 	def __repr__(self) -> str:
 		return f"SquareImage: {self.image}"
 
 
-class ZoneImage(MapImage):
-	def __init__(self, sourcePath, x, z) -> None:
-		super().__init__(sourcePath)
-		self.sourceZoneX = x
-		self.sourceZoneZ = z
+class ZoneRemapImage(MapImage):
+	# Square images assembled from zones, gathered by a single remap
+	def __init__(self, remapTable: dict) -> None:
+		super().__init__(None)
+		# Maps each (displayZoneX, displayZoneZ) slot to the source image
+		# path and (sourceZoneX, sourceZoneZ) of the zone drawn there
+		self.remapTable = remapTable
 
 	def render(self):
-		# Load the source image from file and crop out the zone
 		px = GCS.zonePixelLength
 		zones = GCS.squareZoneLength
-		if os.path.exists(self.sourcePath):
-			sourceImage = pv.Image.new_from_file(self.sourcePath)
-			# Convert coordinates from bottom left to top left
-			x = (self.sourceZoneX) * px
-			z = (zones - self.sourceZoneZ - 1) * px
-			self.image = sourceImage.crop(x, z, px, px)
-		else:
-			self.image = self.createBlankImage(px, px, 3)
+		squarePx = GCS.squarePixelLength
+
+		# Every distinct source square is read once, side by side after a
+		# blank square which empty slots, and missing sources, are taken from
+		sourcePaths = sorted({sourcePath for sourcePath, _, _
+							  in self.remapTable.values()})
+		sourcePaths = [sourcePath for sourcePath in sourcePaths
+					   if os.path.exists(sourcePath)]
+		sources = [self.createBlankImage(squarePx, squarePx, 4)]
+		sources.extend(MapImage.loadTile(sourcePath)
+					   for sourcePath in sourcePaths)
+		sourceIndex = {sourcePath: index
+					   for index, sourcePath in enumerate(sourcePaths, 1)}
+
+		# The pixel origin of the zone to draw in each slot, top left origin
+		slotOrigins = np.zeros((zones, zones, 2), dtype=np.int32)
+		for (i, j), (sourcePath, sourceZoneX, sourceZoneZ) in self.remapTable.items():
+			if sourcePath not in sourceIndex:
+				continue
+			slotOrigins[zones - j - 1, i] = (
+				sourceIndex[sourcePath] * squarePx + sourceZoneX * px,
+				(zones - sourceZoneZ - 1) * px
+			)
+
+		# Expand the zone origins into a per-pixel index and gather the zones
+		originImage = pv.Image.new_from_array(slotOrigins).zoom(px, px)
+		index = originImage + pv.Image.xyz(squarePx, squarePx) % px
+		atlas = pv.Image.arrayjoin(sources)
+		nearest = pv.Interpolate.new("nearest")
+		self.image = atlas.mapim(index, interpolate=nearest)
 
 	def __repr__(self) -> str:
-		return f"ZoneImage: {self.image}"
+		return f"ZoneRemapImage: {self.image}"
+
 
 class IconImage(MapImage):
-	def __init__(self, sourcePath) -> None:
+	def __init__(self, sourcePath, image=None) -> None:
 		super().__init__(sourcePath)
 		# Load the image immediately for repeated referencing
-		self.image = pv.Image.new_from_file(sourcePath)
\ No newline at end of file
+		# Images already in memory (e.g. from a sprite atlas) have their
+		# coverage band already, while sprites are reduced to it as decoded
+		if image is None:
+			image = IconImage.loadSprite(sourcePath)
+		self.image = image.copy_memory()
+
+	@staticmethod
+	def loadSprite(sourcePath):
+		# Icons are drawn only where they are fully opaque, so the alpha band
+		# is reduced to that coverage once, as the sprite is decoded
+		sprite = pv.Image.new_from_file(sourcePath)
+		sprite = sprite.numpy().reshape(sprite.height, sprite.width,
+										sprite.bands)
+		coverage = np.full(sprite.shape[:2], 255, dtype=np.uint8)
+		if sprite.shape[2] == 4:
+			coverage[sprite[..., 3] != 255] = 0
+		sprite = np.dstack((sprite[..., :3], coverage))
+		return pv.Image.new_from_array(sprite, interpretation="srgb")
@@ -5,13 +5,15 @@ if TYPE_CHECKING:
     from buildMapIDs import MapBuilder
 	
 # Necessary class imports
-from definitions import (SquareDefinition, ZoneDefinition, IconDefinition)
-from images import MapImage, PlaneImage, SquareImage, ZoneImage, IconImage
+from definitions import (SquareDefinition, ZoneDefinition, RegionDefinition,
+                         IconDefinition)
+from images import MapImage, PlaneImage, SquareImage, IconImage
 from mapelements import (MapPlane, MapSquare, MapZone, MapIcon, MapMosaic,
-                        MapSquareOfZones)
+                        MapSquareOfZones, MapZoneBlock)
 from config import MapBuilderConfig, GlobalCoordinateDefinition
 CONFIG = MapBuilderConfig()
 GCS = GlobalCoordinateDefinition()
+import tracing
 
 # Functional imports
 import math
@@ -55,18 +57,20 @@ class MapDefsManager():
 			self.upperSquareZ = max(self.upperSquareZ, sd.displaySquareZ)
 			self.lowerPlane = min(self.lowerPlane, sd.lowerPlane)
 			self.upperPlane = max(self.upperPlane, sd.upperPlane)
-		# Check zone definitions
+		# Check zone definitions, where regions may cover several squares
 		for zd in self.zoneDefs:
-			self.lowerSquareX = min(self.lowerSquareX, zd.displaySquareX)
-			self.upperSquareX = max(self.upperSquareX, zd.displaySquareX)
-			self.lowerSquareZ = min(self.lowerSquareZ, zd.displaySquareZ)
-			self.upperSquareZ = max(self.upperSquareZ, zd.displaySquareZ)
+			lowerX, upperX, lowerZ, upperZ = zd.getDisplayBounds()
+			self.lowerSquareX = min(self.lowerSquareX, lowerX)
+			self.upperSquareX = max(self.upperSquareX, upperX)
+			self.lowerSquareZ = min(self.lowerSquareZ, lowerZ)
+			self.upperSquareZ = max(self.upperSquareZ, upperZ)
 			self.lowerPlane = min(self.lowerPlane, zd.lowerPlane)
 			self.upperPlane = max(self.upperPlane, zd.upperPlane)
 	
 	def sortDefinitions(self) -> None:
 		self.squareDefs.sort()
-		self.zoneDefs.sort()
+		# Zones and regions are different classes, so compare groupIds directly
+		self.zoneDefs.sort(key=lambda zd: zd.groupId)
 
 	def buildReferences(self, squareDefs: list[SquareDefinition],
 						 zoneDefs: list[ZoneDefinition]) -> None:
@@ -91,7 +95,14 @@ class MapDefsManager():
 				parentSquare = self.sourceToDisplay[plane][source]
 				parentSquare['displaySquare'] = display
 
-		# Load zone definition mappings
+		# Load zone definition mappings, with regions mapped zone by zone
+		for regionOrZone in zoneDefs:
+			zoneList = [regionOrZone]
+			if isinstance(regionOrZone, RegionDefinition):
+				zoneList = regionOrZone.expandToZones()
+			self.buildZoneReferences(zoneList)
+
+	def buildZoneReferences(self, zoneDefs: list[ZoneDefinition]) -> None:
 		for zd in zoneDefs:
 			for plane in range(zd.lowerPlane, zd.upperPlane+1):
 				sourceSquare = zd.getSourceSquare()
@@ -138,16 +149,20 @@ class MapDefsManager():
 class MapIconManager:
 	# Holds definitions for icons
 	# Holds a square-coordinate indexable map, a list of all icons in the square
-	def __init__(self, iconDefs: list[IconDefinition], basePath) -> None:
+	def __init__(self, iconDefs: list[IconDefinition], basePath,
+			  	 iconImages: dict[int, IconImage] = None) -> None:
 		# Sort the icon defs and save
 		self.iconDefs = iconDefs
 
-		# Manager loads its own icons for reference
+		# Manager loads its own icons for reference, unless they are supplied
 		self.basePath = basePath
 		
 		# Filter out icons not in the definitions
 		self.sortDefinitions()
-		self.loadIconImages()
+		if iconImages is None:
+			self.loadIconImages()
+		else:
+			self.iconIDtoImage = iconImages
 		self.processIconList()
 
 	def sortDefinitions(self):
@@ -175,6 +190,12 @@ class MapIconManager:
 			self.iconStore[plane][(sqX, sqZ)][(znX, znZ)].append(iconDef)
 
 	def getIconsInID(self, mapBuilder: 'MapBuilder'):
+		with tracing.span("icon collection", mapID=mapBuilder.mapID) as span:
+			renderedIcons = self.collectIcons(mapBuilder)
+			span["icons"] = sum(len(icons) for icons in renderedIcons.values())
+		return renderedIcons
+
+	def collectIcons(self, mapBuilder: 'MapBuilder'):
 		# Return dict with plane numbers as keys, mapped to icons in plane
 		renderedIcons = defaultdict(list)
 
@@ -187,6 +208,11 @@ class MapIconManager:
 				if isinstance(element, MapSquareOfZones):
 					# Another layer of mosaic needs to be parsed
 					for zone, subelem in element.mosaic.items():
+						if subelem is None:
+							continue
+						# Blocks span cells, so look up each cell's own zone
+						if isinstance(subelem, MapZoneBlock):
+							subelem = subelem.getZone(*zone)
 						newIconList = self.getIconsInCell(plane, subelem, mapBuilder.mapID)
 						renderedIcons[plane].extend(newIconList)
 				elif isinstance(element, MapSquare):
@@ -1,5 +1,7 @@
-from definitions import (SquareDefinition, ZoneDefinition, IconDefinition)
-from images import MapImage, PlaneImage, SquareImage, ZoneImage, IconImage
+from definitions import (SquareDefinition, ZoneDefinition, RegionDefinition,
+						 IconDefinition)
+from images import (MapImage, PlaneImage, SquareImage, ZoneRemapImage,
+					IconImage)
 from config import MapBuilderConfig, GlobalCoordinateDefinition
 CONFIG = MapBuilderConfig()
 GCS = GlobalCoordinateDefinition()
@@ -46,16 +48,36 @@ class MapMosaic():
 	def getCellContents(self, x, z):
 		return self.mosaic[(x, z)]
 
+	def getRenderKey(self):
+		# Everything the rendered mosaic depends on, in a stable order
+		renderKey = list()
+		for coords, item in sorted(self.mosaic.items()):
+			itemKey = item.getRenderKey() if item is not None else None
+			if itemKey is not None:
+				renderKey.append((coords, itemKey))
+		return tuple(renderKey)
+
+	def getSourcePaths(self) -> set:
+		sourcePaths = set()
+		for item in self.mosaic.values():
+			if item is not None:
+				sourcePaths.update(item.getSourcePaths())
+		return sourcePaths
+
+	def getOccupiedCells(self) -> set:
+		# Cells with a source tile to draw from, found without rendering
+		return {coords for coords, item in self.mosaic.items()
+				if item is not None and item.hasSource()}
+
 	def render(self):
-		# Render all items composing the mosaic
-		item: MapSquare | MapSquareOfZones | MapZone
-		for coords, item in self.mosaic.items():
-			validTypes = (MapSquare, MapSquareOfZones, MapZone)
-			if isinstance(item, validTypes):
-				item.render()
-			else:
-				item = self.makeBlank()
-				self.mosaic[coords] = item
+		# Render the items of the cells the definitions populate with a
+		# source tile. Every other cell shares one blank image, so the empty
+		# parts of the coverage band are laid out without reading anything
+		item: MapSquare | MapSquareOfZones
+		occupiedCells = self.getOccupiedCells()
+		for coords in occupiedCells:
+			self.mosaic[coords].render()
+		blankImage = self.makeBlank().getImage()
 
 		# Create the output list
 		tileList = list()
@@ -64,8 +86,10 @@ class MapMosaic():
 		# Therefore the y-ordering is descending
 		for z in range(self.bbox["upperZ"], self.bbox["lowerZ"]-1, -1):
 			for x in range(self.bbox["lowerX"], self.bbox["upperX"]+1):
-				item = self.mosaic[(x, z)]
-				tileList.append(item.getImage())
+				if (x, z) in occupiedCells:
+					tileList.append(self.mosaic[(x, z)].getImage())
+				else:
+					tileList.append(blankImage)
 
 		# Now join them together to render the mosaic
 		tiledImage = pv.Image.arrayjoin(tileList, across=self.width)
@@ -93,8 +117,27 @@ class MapSquareOfZones(MapMosaic):
 		maxZoneIndex = GCS.squareZoneLength - 1
 		super().__init__(0, maxZoneIndex, 0, maxZoneIndex, level)
 
-	def makeBlank(self):
-		return MapZone.makeBlank()
+	def render(self):
+		# All zones are gathered from their source squares in one remap,
+		# rather than cropped one by one and joined
+		self.imageContainer = ZoneRemapImage(self.getRemapTable())
+		self.imageContainer.render()
+
+	def hasSource(self):
+		return bool(self.getOccupiedCells())
+
+	def getRenderKey(self):
+		return ("zones", tuple(sorted(self.getRemapTable().items())))
+
+	def getRemapTable(self):
+		# Maps each populated zone slot to the source of the zone drawn there
+		remapTable = dict()
+		for (i, j), item in self.mosaic.items():
+			if item is None:
+				continue
+			sourceZoneX, sourceZoneZ = item.getSourceZoneAt(i, j)
+			remapTable[(i, j)] = (item.getSourcePath(), sourceZoneX, sourceZoneZ)
+		return remapTable
 
 	def getImage(self):
 		return self.imageContainer.image
@@ -111,14 +154,32 @@ class MapSquare():
 		self.sourceLevel = sourcePlane
 
 	def render(self):
+		self.imageContainer = SquareImage(self.getSourcePath())
+		self.imageContainer.render()
+
+	def getSourcePath(self):
 		# Construct the tile path from the source data
 		self.definition: SquareDefinition
 		sourceX, sourceY = self.definition.getSourceSquare()
 		baseTileName = (f"{CONFIG.mapid.baseTilePath}/"
 				  		f"{self.sourceLevel}_{sourceX}_{sourceY}.png")
-		baseTilePath = os.path.join(self.definition.basePath, baseTileName)
-		self.imageContainer = SquareImage(baseTilePath)
-		self.imageContainer.render()
+		return os.path.join(self.definition.basePath, baseTileName)
+
+	def getRenderKey(self):
+		if self.definition is None:
+			return None
+		return ("square", self.getSourcePath())
+
+	def getSourcePaths(self) -> set:
+		if self.definition is None:
+			return set()
+		return {self.getSourcePath()}
+
+	def hasSource(self):
+		# Blank squares have no definition, and missing source tiles are blank
+		if self.definition is None:
+			return False
+		return os.path.exists(self.getSourcePath())
 
 	def getImage(self):
 		return self.imageContainer.image
@@ -136,32 +197,41 @@ class MapSquare():
 	
 
 class MapZone(MapSquare):
-	# Class which contains the definition and image of a zone
+	# Class which contains the definition of a zone
+	# Zones are drawn by the square of zones holding them, in one remap
 	def __init__(self, definition, sourcePlane) -> None:
 		super().__init__(definition, sourcePlane)
 
-	def render(self):
-		# Extract the sub-section of the source image
-		definition = self.definition # type: ZoneDefinition
-		sourceSquareX, sourceSquareZ = definition.getSourceSquare()
-		sourceZoneX, sourceZoneZ = definition.getSourceZone()
-		baseTileName = (f"{CONFIG.mapid.baseTilePath}/"
-				  		f"{self.sourceLevel}_{sourceSquareX}_{sourceSquareZ}.png")
-		baseTilePath = os.path.join(definition.basePath, baseTileName)
-		self.imageContainer = ZoneImage(baseTilePath, sourceZoneX, sourceZoneZ)
-		self.imageContainer.render()
-
-	@classmethod
-	def makeBlank(cls):
-		newZone = cls(None, 0)
-		newZone.imageContainer = ZoneImage(None, 0, 0)
-		newZone.imageContainer.render()
-		return newZone
+	def getSourceZoneAt(self, displayZoneX, displayZoneZ):
+		# The source zone drawn in a display zone cell
+		return self.definition.getSourceZone()
 
 	def __repr__(self) -> str:
 		repr = (f"MapZone: \n\t{self.definition}")
 		return repr
 
+class MapZoneBlock(MapZone):
+	# Class which contains a rectangle of zones taken from a single square
+	# It fills every cell it covers as a single element
+	def __init__(self, definition, sourcePlane) -> None:
+		super().__init__(definition, sourcePlane)
+
+	def getSourceZoneAt(self, displayZoneX, displayZoneZ):
+		# Blocks keep their zones in place relative to each other
+		definition = self.definition # type: RegionDefinition
+		return (displayZoneX - definition.displayZoneX + definition.sourceZoneX,
+				displayZoneZ - definition.displayZoneZ + definition.sourceZoneZ)
+
+	def getZone(self, displayZoneX, displayZoneZ):
+		# The single zone drawn in one of the block's cells
+		zoneDef = self.definition.getZoneDefinition(displayZoneX, displayZoneZ)
+		return MapZone(zoneDef, self.sourceLevel)
+
+	def __repr__(self) -> str:
+		repr = (f"MapZoneBlock: \n\t{self.definition}")
+		return repr
+
+
 class MapIcon():
 	def __init__(self, definition: IconDefinition, targetPlane) -> None:
 		# Load in the data
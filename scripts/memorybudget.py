@@ -0,0 +1,188 @@
+"""
+Watches the memory of build jobs, and runs jobs over budget with less
+
+While a job runs, a watchdog thread samples the resident set size of its
+process, and its peak, and how far it grew over the RSS the job started with,
+are recorded against the job's mapID and stage. The peaks of every process
+are collected as parts, see parts, and once the build ends they are gathered
+into peakRss.json.
+
+Scheduler jobs which can be run again are stopped at their next step once
+their growth passes the job memory budget, and the scheduler requeues them to
+run alone with the low-memory strategy: no libvips operation cache, a single
+libvips thread, and zoom levels sliced from a composite streamed top to
+bottom. A job which the system kills outright, taking its worker pool with
+it, is requeued the same way.
+"""
+from config import MapBuilderConfig
+
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import psutil
+import parts
+import json
+import os
+
+# Set by startWatchdog, and inherited by worker processes
+MEMORY_DIR_ENV = "MAPBUILDER_MEMORY_DIR"
+MEGABYTE = 1024 ** 2
+# Peaks of this process, written out as each watched job ends
+PEAKS = list()
+STRATEGY = {"lowMemory": False}
+WATCH = {"watchdog": None}
+
+
+class MemoryBudgetExceeded(MemoryError):
+	pass
+
+
+def getConfig():
+	# Scheduler workers import this module before loading the configuration
+	return MapBuilderConfig()
+
+
+def getMemoryPath(basePath):
+	return os.path.join(basePath, getConfig().memory.memoryPath)
+
+
+def getJobBudget():
+	# The job budget defaults to the scheduler's whole budget
+	budgetMB = getConfig().memory.jobMemoryBudgetMB or \
+		getConfig().scheduler.memoryBudgetMB
+	return budgetMB * MEGABYTE
+
+
+def startWatchdog(basePath):
+	# Records job peaks in this process and the workers it starts, if enabled
+	if not getConfig().memory.watchdogEnabled:
+		return
+	parts.startParts(os.path.join(getMemoryPath(basePath), "parts"),
+					 MEMORY_DIR_ENV)
+
+
+class MemoryWatchdog(threading.Thread):
+	# Samples the RSS of this process until stopped, noting when its growth
+	# since the start passes the budget, if given one
+	def __init__(self, interval, budget=None):
+		super().__init__(daemon=True)
+		self.interval = interval
+		self.budget = budget
+		self.process = psutil.Process()
+		# Workers are reused, and keep memory from their earlier jobs that
+		# this job did not use
+		self.startRss = self.process.memory_info().rss
+		self.peak = self.startRss
+		self.exceeded = False
+		self.stopped = threading.Event()
+
+	def getGrowth(self):
+		return self.peak - self.startRss
+
+	def run(self):
+		while True:
+			self.peak = max(self.peak, self.process.memory_info().rss)
+			if self.budget and self.getGrowth() > self.budget:
+				self.exceeded = True
+			if self.stopped.wait(self.interval):
+				return
+
+	def stop(self):
+		self.stopped.set()
+		self.join()
+
+
+@contextmanager
+def watch(mapID, stage, abortable=False):
+	# Records the peak RSS of the enclosed block. Abortable blocks raise
+	# MemoryBudgetExceeded at the next checkBudget() once they pass the job
+	# budget, or as they end, unless they already use the low-memory strategy
+	peaksPath = parts.getParts(MEMORY_DIR_ENV)
+	if not peaksPath:
+		yield
+		return
+	budget = getJobBudget() if abortable and not isLowMemory() else None
+	watchdog = MemoryWatchdog(getConfig().memory.watchdogInterval, budget)
+	watchdog.start()
+	WATCH["watchdog"] = watchdog
+	try:
+		yield
+	finally:
+		WATCH["watchdog"] = None
+		watchdog.stop()
+		PEAKS.append({"mapID": mapID, "stage": stage,
+					  "peakRssMB": round(watchdog.peak / MEGABYTE, 1),
+					  "growthMB": round(watchdog.getGrowth() / MEGABYTE, 1),
+					  "lowMemory": isLowMemory(),
+					  "overBudget": watchdog.exceeded})
+		flushPeaks(peaksPath)
+	if watchdog.exceeded:
+		raise MemoryBudgetExceeded(f"{stage} of {mapID} passed "
+								   f"{budget // MEGABYTE}MB")
+
+
+def checkBudget():
+	# Called between the steps of a job, as libvips cannot be interrupted
+	watchdog = WATCH["watchdog"]
+	if watchdog and watchdog.exceeded:
+		raise MemoryBudgetExceeded(f"passed {watchdog.budget // MEGABYTE}MB")
+
+
+def flushPeaks(peaksPath):
+	parts.appendRecords(peaksPath, PEAKS)
+	PEAKS.clear()
+
+
+def writePeaks(basePath):
+	# Gathers the peaks of every process into peakRss.json, keeping the
+	# highest of each mapID and stage
+	peaksPath = parts.stopParts(MEMORY_DIR_ENV)
+	if not peaksPath:
+		return
+	peaks = defaultdict(dict)
+	for peak in parts.gatherRecords(peaksPath):
+		stagePeaks = peaks[str(peak.pop("mapID"))]
+		stage = peak.pop("stage")
+		stagePeak = stagePeaks.setdefault(stage, peak)
+		# A job over budget is remembered through its retry
+		overBudget = stagePeak["overBudget"] or peak["overBudget"]
+		if peak["peakRssMB"] > stagePeak["peakRssMB"]:
+			stagePeaks[stage] = peak
+		stagePeaks[stage]["overBudget"] = overBudget
+
+	memoryPath = os.path.dirname(peaksPath)
+	with open(os.path.join(memoryPath, "peakRss.json"), 'w') as peaksFile:
+		json.dump(peaks, peaksFile, indent=4, sort_keys=True)
+	highest = max(((peak["peakRssMB"], stage, mapID)
+				   for mapID, stagePeaks in peaks.items()
+				   for stage, peak in stagePeaks.items()), default=None)
+	if highest:
+		print(f"Highest peak RSS {highest[0]}MB in the {highest[1]} of "
+			  f"{highest[2]}")
+	print(f"Peak RSS saved to {os.path.join(memoryPath, 'peakRss.json')}")
+
+
+def isLowMemory():
+	return STRATEGY["lowMemory"]
+
+
+@contextmanager
+def lowMemory(enabled=True):
+	# Runs the enclosed block with the low-memory strategy, restoring the
+	# configured libvips limits afterwards
+	if not enabled:
+		yield
+		return
+	from pyvips_import import pyvips as pv
+	import pyvips_import
+	concurrency = pv.vips_lib.vips_concurrency_get()
+	pv.cache_set_max(0)
+	pv.cache_set_max_mem(0)
+	pv.vips_lib.vips_concurrency_set(1)
+	STRATEGY["lowMemory"] = True
+	try:
+		yield
+	finally:
+		STRATEGY["lowMemory"] = False
+		pv.vips_lib.vips_concurrency_set(concurrency)
+		pyvips_import.applyCacheLimits()
@@ -0,0 +1,234 @@
+"""
+Counts the I/O and libvips activity of a build, per mapID
+
+Counters, such as the images opened, PNG bytes read and written, tiles
+emitted or skipped as blank, renames, directories created and icons drawn or
+placed, are added to the mapID being built in the current process. When a
+mapID finishes, and as each file is written, libvips' tracked memory
+high-water mark, open files and operation cache size are sampled as gauges.
+The values of every process are collected as parts, see parts, and once the
+build ends they are summed per mapID and written in the Prometheus text-file
+format and as JSON.
+
+While metrics are disabled, counting only checks the environment.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import ctypes.util
+import ctypes
+import threading
+import parts
+import glob
+import json
+import os
+
+# Set by startMetrics, and inherited by worker processes
+METRICS_DIR_ENV = "MAPBUILDER_METRICS_DIR"
+METRIC_PREFIX = "mapbuilder"
+
+# Exported name and help text of every counter and gauge
+COUNTERS = {
+	"imagesOpened": ("images_opened_total", "Images opened from disk"),
+	"pngBytesRead": ("png_bytes_read_total", "Bytes of PNG files opened"),
+	"pngBytesWritten": ("png_bytes_written_total", "Bytes of PNG files written"),
+	"tilesEmitted": ("tiles_emitted_total", "Tiles written by slicing"),
+	"tilesBlank": ("tiles_blank_total", "Tiles skipped as blank by slicing"),
+	"renames": ("renames_total", "Files renamed into place"),
+	"directoriesCreated": ("directories_created_total", "Directories created"),
+	"iconsDrawn": ("icons_drawn_total", "Icons drawn onto tiles"),
+	"iconsPlaced": ("icons_placed_total", "Icons written to vector icon layers")
+}
+GAUGES = {
+	"vipsMemoryHighwater": ("vips_memory_highwater_bytes",
+							"Highest memory libvips tracked at once"),
+	"vipsFilesOpen": ("vips_files_open", "Files libvips held open"),
+	"vipsCacheOperations": ("vips_cache_operations",
+							"Operations held in the libvips operation cache")
+}
+
+# Values of this process, written out when its outermost scope ends
+VALUES = defaultdict(lambda: defaultdict(int))
+# The threads building a mapID count into the same values
+VALUES_LOCK = threading.Lock()
+SCOPE = {"label": None, "depth": 0}
+VIPS_LIBRARY = dict()
+
+
+def isEnabled():
+	return parts.getParts(METRICS_DIR_ENV) is not None
+
+
+def startMetrics(metricsPath):
+	# Begins collecting in this process and the workers it starts
+	parts.startParts(os.path.join(metricsPath, "parts"), METRICS_DIR_ENV)
+
+
+@contextmanager
+def scope(label):
+	# Values counted inside are added to the label, normally the mapID.
+	# Nested scopes keep the outermost label
+	if not isEnabled():
+		yield
+		return
+	outermost = SCOPE["depth"] == 0
+	if outermost:
+		SCOPE["label"] = str(label)
+	SCOPE["depth"] += 1
+	try:
+		yield
+	finally:
+		SCOPE["depth"] -= 1
+		if outermost:
+			sampleVips(SCOPE["label"])
+			flushValues(parts.getParts(METRICS_DIR_ENV))
+			SCOPE["label"] = None
+
+
+def count(name, value=1):
+	if isEnabled():
+		with VALUES_LOCK:
+			VALUES[SCOPE["label"] or "build"][name] += value
+
+
+def countRead(path):
+	# An image opened from disk
+	if isEnabled() and os.path.exists(path):
+		count("imagesOpened")
+		count("pngBytesRead", os.path.getsize(path))
+
+
+def countWrite(path):
+	# Files are sampled while pipelines are running, as they are written
+	if isEnabled():
+		count("pngBytesWritten", os.path.getsize(path))
+		sampleVips(SCOPE["label"] or "build")
+
+
+def makeDirectories(path):
+	# os.makedirs, counting the directory if it did not exist yet
+	if not os.path.isdir(path):
+		os.makedirs(path, exist_ok=True)
+		count("directoriesCreated")
+
+
+def countSlices(directory, width, height, tileSize):
+	# Tiles dzsave wrote for an image, and those it skipped as blank
+	if not isEnabled():
+		return
+	emitted = 0
+	for tilePath in glob.glob(os.path.join(directory, "**/*.png"),
+							  recursive=True):
+		if os.path.basename(tilePath) == "blank.png":
+			continue
+		emitted += 1
+		countWrite(tilePath)
+	count("tilesEmitted", emitted)
+	columns = -(-width // tileSize)
+	rows = -(-height // tileSize)
+	count("tilesBlank", max(0, columns * rows - emitted))
+
+
+def findVipsLibrary():
+	# Wheels bundle their own libvips, which is found among the libraries
+	# mapped into the process rather than on the library path
+	libraryName = ctypes.util.find_library("vips") or \
+		ctypes.util.find_library("libvips-42")
+	if libraryName or not os.path.exists("/proc/self/maps"):
+		return libraryName
+	with open("/proc/self/maps") as mapsFile:
+		for line in mapsFile:
+			path = line.split()[-1]
+			if os.path.basename(path).startswith("libvips") and ".so" in path:
+				return path
+	return None
+
+
+def getVipsLibrary():
+	# The tracking functions are not bound by pyvips, so they are called in
+	# the libvips already loaded into the process
+	if "library" not in VIPS_LIBRARY:
+		libraryName = findVipsLibrary()
+		try:
+			library = ctypes.CDLL(libraryName)
+			library.vips_tracked_get_mem_highwater.restype = ctypes.c_size_t
+			library.vips_tracked_get_files.restype = ctypes.c_int
+			library.vips_cache_get_size.restype = ctypes.c_int
+		except (OSError, AttributeError, TypeError):
+			library = None
+		VIPS_LIBRARY["library"] = library
+	return VIPS_LIBRARY["library"]
+
+
+def sampleVips(label):
+	# libvips keeps its high-water mark for the life of the process, so
+	# workers report the highest of every mapID they have built so far
+	library = getVipsLibrary()
+	if library is None:
+		return
+	gauges = {
+		"vipsMemoryHighwater": library.vips_tracked_get_mem_highwater(),
+		"vipsFilesOpen": library.vips_tracked_get_files(),
+		"vipsCacheOperations": library.vips_cache_get_size()
+	}
+	with VALUES_LOCK:
+		for name, value in gauges.items():
+			VALUES[label][name] = max(VALUES[label][name], value)
+
+
+def flushValues(partsPath):
+	with VALUES_LOCK:
+		parts.appendRecords(partsPath, ({"label": label, "values": values}
+										for label, values in VALUES.items()))
+		VALUES.clear()
+
+
+def sumValues(records):
+	# Counters are summed per label, while gauges keep the highest value
+	values = defaultdict(lambda: defaultdict(int))
+	for record in records:
+		labelValues = values[record["label"]]
+		for name, value in record["values"].items():
+			if name in GAUGES:
+				labelValues[name] = max(labelValues[name], value)
+			else:
+				labelValues[name] += value
+	return values
+
+
+def formatPrometheus(values):
+	lines = list()
+	for metrics, metricType in ((COUNTERS, "counter"), (GAUGES, "gauge")):
+		for name, (metricName, helpText) in metrics.items():
+			metricName = f"{METRIC_PREFIX}_{metricName}"
+			lines.append(f"# HELP {metricName} {helpText}")
+			lines.append(f"# TYPE {metricName} {metricType}")
+			for label, labelValues in sorted(values.items()):
+				if name in labelValues:
+					lines.append(f'{metricName}{{mapid="{label}"}} '
+								 f'{labelValues[name]}')
+	return "\n".join(lines) + "\n"
+
+
+def writeMetrics(metricsPath, name):
+	# Gathers the values of every process into <name>.prom and <name>.json
+	partsPath = parts.stopParts(METRICS_DIR_ENV)
+	if not partsPath:
+		return
+	# Anything counted outside of a mapID in this process
+	flushValues(partsPath)
+	values = sumValues(parts.gatherRecords(partsPath))
+
+	# Prometheus' textfile collector must never read a partial file
+	promPath = os.path.join(metricsPath, f"{name}.prom")
+	with open(f"{promPath}.tmp", 'w') as promFile:
+		promFile.write(formatPrometheus(values))
+	os.replace(f"{promPath}.tmp", promPath)
+	with open(os.path.join(metricsPath, f"{name}.json"), 'w') as jsonFile:
+		json.dump(values, jsonFile, indent=4, sort_keys=True)
+	totals = defaultdict(int)
+	for labelValues in values.values():
+		for counterName in COUNTERS:
+			totals[counterName] += labelValues.get(counterName, 0)
+	print("Metrics: " + ", ".join(f"{counterName} {value}"
+								  for counterName, value in totals.items()))
+	print(f"Metrics saved to {promPath}")
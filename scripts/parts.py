@@ -0,0 +1,51 @@
+"""
+Collects the records of every process of a build into one place
+
+Metrics, trace spans, memory peaks and profiles are produced by the build's
+own process and by each of its scheduler workers. A collection is started by
+emptying its parts directory and naming it in an environment variable, which
+the worker processes inherit. Each process then appends its records to its
+own <pid>.jsonl file there, and once the build ends the parts are read back
+and removed along with the directory.
+"""
+import glob
+import json
+import os
+
+
+def startParts(partsPath, envName):
+	# Begins a collection in this process and the workers it starts
+	partsPath = os.path.abspath(partsPath)
+	os.makedirs(partsPath, exist_ok=True)
+	for partPath in glob.glob(os.path.join(partsPath, "*")):
+		os.remove(partPath)
+	os.environ[envName] = partsPath
+	return partsPath
+
+
+def getParts(envName):
+	# The parts directory of a started collection, or None
+	return os.environ.get(envName)
+
+
+def stopParts(envName):
+	# Ends the collection, returning its parts directory or None
+	return os.environ.pop(envName, None)
+
+
+def appendRecords(partsPath, records, default=None):
+	# Appends records to this process's part, one JSON object per line
+	with open(os.path.join(partsPath, f"{os.getpid()}.jsonl"), 'a') as f:
+		for record in records:
+			f.write(json.dumps(record, default=default) + "\n")
+
+
+def gatherRecords(partsPath):
+	# Returns the records of every process, removing the parts directory
+	records = list()
+	for partPath in sorted(glob.glob(os.path.join(partsPath, "*.jsonl"))):
+		with open(partPath) as partFile:
+			records.extend(json.loads(line) for line in partFile)
+		os.remove(partPath)
+	os.rmdir(partsPath)
+	return records
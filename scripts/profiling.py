@@ -0,0 +1,284 @@
+"""
+Profiles the Python and libvips time of selected mapIDs
+
+Each selected mapID, or each scheduler job of one, runs under cProfile, or
+under a sampler of its thread's stack which costs far less but does not count
+calls. Every process writes its profiles to the parts directory, see parts,
+and once the build ends they are merged into a .pstats file and a
+collapsed-stack file per mapID, ready for flamegraph.pl or speedscope. Time
+spent beneath pyvips is counted as libvips, while the rest is Python, split
+by the stages which do the most of it.
+
+libvips' own profile is recorded by setting VIPS_PROFILE before it starts,
+see pyvips_import.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import cProfile
+import pstats
+import parts
+import glob
+import time
+import sys
+import os
+
+# Set by startProfiling and startVipsProfile, and inherited by workers
+PROFILE_DIR_ENV = "MAPBUILDER_PROFILE_DIR"
+PROFILE_MODE_ENV = "MAPBUILDER_PROFILE_MODE"
+PROFILE_MAPIDS_ENV = "MAPBUILDER_PROFILE_MAPIDS"
+VIPS_PROFILE_ENV = "MAPBUILDER_VIPS_PROFILE_DIR"
+PROFILE_PATH = "profiles"
+MODES = ("cprofile", "sampling")
+SAMPLE_INTERVAL = 0.005
+# Stacks through less time than this are not rebuilt from cProfile's calls
+MIN_STACK_SECONDS = 1e-6
+# Python stages, named by the outermost of their functions on a stack
+PYTHON_STAGES = (
+	("definitions", ("buildMapIDs:loadMapIDDefinitions", "managers:__init__",
+					 "buildMapIDs:loadDefinitions")),
+	("icons", ("scheduler:getIconManager", "managers:getIconsInID",
+			   "buildMapIDs:renderIcons")),
+	("renaming", ("buildMapIDs:restructureDirectory",))
+)
+
+PROFILE_STATE = {"active": False, "parts": 0}
+FRAME_LABELS = dict()
+
+
+def isEnabled():
+	return parts.getParts(PROFILE_DIR_ENV) is not None
+
+
+def startProfiling(basePath, mode="cprofile", mapIDs=None):
+	# Profiles the given mapIDs, or all of them, in this process and the
+	# workers it starts
+	if mode not in MODES:
+		raise ValueError(f"Unknown profile mode {mode}, expected one of {MODES}")
+	parts.startParts(os.path.join(basePath, PROFILE_PATH, "parts"),
+					 PROFILE_DIR_ENV)
+	os.environ[PROFILE_MODE_ENV] = mode
+	os.environ[PROFILE_MAPIDS_ENV] = str(mapIDs) if mapIDs else ""
+
+
+def startVipsProfile(basePath):
+	# Must be called before pyvips is first imported
+	profilePath = os.path.abspath(os.path.join(basePath, PROFILE_PATH))
+	os.makedirs(profilePath, exist_ok=True)
+	os.environ[VIPS_PROFILE_ENV] = profilePath
+
+
+def isActive():
+	# Whether a block of this process is being profiled. Only the thread
+	# which started the profile is seen
+	return PROFILE_STATE["active"]
+
+
+def isVipsProfiling():
+	return bool(os.environ.get(VIPS_PROFILE_ENV))
+
+
+def isSelected(mapID):
+	mapIDs = os.environ[PROFILE_MAPIDS_ENV]
+	return not mapIDs or str(mapID) in mapIDs.split(",")
+
+
+def getFrameLabel(fileName, functionName):
+	# Frames are labelled <module>:<function>, with pyvips' modules kept
+	# apart from the builder's by their package
+	key = (fileName, functionName)
+	if key not in FRAME_LABELS:
+		if fileName == "~":
+			# Built-in functions are only known by name
+			label = functionName
+		else:
+			module = os.path.splitext(os.path.basename(fileName))[0]
+			package = os.path.basename(os.path.dirname(fileName))
+			if package == "pyvips":
+				module = f"pyvips.{module}"
+			label = f"{module}:{functionName}"
+		# Collapsed stacks are separated by semicolons
+		FRAME_LABELS[key] = label.replace(";", ",")
+	return FRAME_LABELS[key]
+
+
+class StackSampler(threading.Thread):
+	# Adds the time between samples to the stack of the thread which created
+	# it. pyvips releases the GIL while libvips works, so it is sampled too
+	def __init__(self, interval):
+		super().__init__(daemon=True)
+		self.targetID = threading.get_ident()
+		self.interval = interval
+		self.stacks = defaultdict(float)
+		self.stopped = threading.Event()
+
+	def run(self):
+		lastTime = time.perf_counter()
+		while not self.stopped.wait(self.interval):
+			frame = sys._current_frames().get(self.targetID)
+			sampleTime = time.perf_counter()
+			stack = list()
+			while frame is not None:
+				stack.append(getFrameLabel(frame.f_code.co_filename,
+										   frame.f_code.co_name))
+				frame = frame.f_back
+			self.stacks[tuple(reversed(stack))] += sampleTime - lastTime
+			lastTime = sampleTime
+
+	def stop(self):
+		self.stopped.set()
+		self.join()
+
+
+def stacksFromStats(stats):
+	# cProfile only keeps caller and callee pairs, so stacks are rebuilt from
+	# the outermost functions down, sharing each function's time between its
+	# callers in proportion to the time each caller spent in it
+	callees = defaultdict(list)
+	for function, (_, _, _, _, callers) in stats.items():
+		for caller, (_, _, _, callerSeconds) in callers.items():
+			callees[caller].append((function, callerSeconds))
+
+	stacks = defaultdict(float)
+	def addStack(function, seconds, stack):
+		_, _, ownSeconds, totalSeconds, _ = stats[function]
+		share = seconds / totalSeconds if totalSeconds else 0
+		stack = stack + (getFrameLabel(function[0], function[2]),)
+		stacks[stack] += ownSeconds * share
+		for callee, calleeSeconds in callees[function]:
+			# Recursion is folded into the outermost call
+			if (calleeSeconds * share >= MIN_STACK_SECONDS
+					and getFrameLabel(callee[0], callee[2]) not in stack):
+				addStack(callee, calleeSeconds * share, stack)
+
+	for function, (_, _, _, totalSeconds, callers) in stats.items():
+		if not callers:
+			addStack(function, totalSeconds, ())
+	return stacks
+
+
+def writeStacks(path, stacks):
+	# Collapsed stacks count whole microseconds
+	with open(path, 'w') as f:
+		for stack, seconds in sorted(stacks.items()):
+			microseconds = round(seconds * 1e6)
+			if microseconds:
+				f.write(f"{';'.join(stack)} {microseconds}\n")
+
+
+def readStacks(path):
+	stacks = defaultdict(float)
+	with open(path) as f:
+		for line in f:
+			stack, _, microseconds = line.rstrip("\n").rpartition(" ")
+			stacks[tuple(stack.split(";"))] += int(microseconds) / 1e6
+	return stacks
+
+
+@contextmanager
+def profile(mapID):
+	# Profiles the enclosed block if the mapID is selected. Nested blocks are
+	# part of the outermost one
+	partsPath = parts.getParts(PROFILE_DIR_ENV)
+	if not partsPath or PROFILE_STATE["active"] or not isSelected(mapID):
+		yield
+		return
+	PROFILE_STATE["active"] = True
+	sampling = os.environ[PROFILE_MODE_ENV] == "sampling"
+	if sampling:
+		profiler = StackSampler(SAMPLE_INTERVAL)
+		profiler.start()
+	else:
+		profiler = cProfile.Profile()
+		profiler.enable()
+	try:
+		yield
+	finally:
+		# Jobs of the same mapID may run in several processes
+		partName = os.path.join(partsPath, f"{mapID}_{os.getpid()}_"
+											f"{PROFILE_STATE['parts']}")
+		PROFILE_STATE["parts"] += 1
+		if sampling:
+			profiler.stop()
+			stacks = profiler.stacks
+		else:
+			profiler.disable()
+			stats = pstats.Stats(profiler)
+			stats.dump_stats(f"{partName}.pstats")
+			stacks = stacksFromStats(stats.stats)
+		writeStacks(f"{partName}.collapsed", stacks)
+		PROFILE_STATE["active"] = False
+
+
+def getStage(stack):
+	for label in stack:
+		for stage, labels in PYTHON_STAGES:
+			if label in labels:
+				return stage
+	return "other"
+
+
+def attributeTime(stacks):
+	# Seconds beneath pyvips count as libvips, and the rest as Python in the
+	# stage it was spent in
+	times = defaultdict(float)
+	for stack, seconds in stacks.items():
+		times["total"] += seconds
+		if any(label.startswith("pyvips.") for label in stack):
+			times["libvips"] += seconds
+		else:
+			times["python"] += seconds
+			times[getStage(stack)] += seconds
+	return times
+
+
+def summarise(mapIDTimes):
+	names = ("total", "libvips", "python") + \
+		tuple(stage for stage, _ in PYTHON_STAGES) + ("other",)
+	lines = [f"{'mapID':>6}" + "".join(f"{name:>13}" for name in names)]
+	for mapID, times in sorted(mapIDTimes.items(),
+							   key=lambda item: -item[1]["total"]):
+		lines.append(f"{mapID:>6}" +
+					 "".join(f"{times[name]:>13.2f}" for name in names))
+	return "\n".join(lines)
+
+
+def writeProfiles(basePath):
+	# Merges the profiles of every process into files per mapID, with a
+	# summary of where their time went
+	# Profiles are binary, so their parts are merged here rather than
+	# gathered as records
+	partsPath = parts.stopParts(PROFILE_DIR_ENV)
+	if not partsPath:
+		return
+	mode = os.environ.pop(PROFILE_MODE_ENV)
+	os.environ.pop(PROFILE_MAPIDS_ENV)
+	profilePath = os.path.join(basePath, PROFILE_PATH)
+
+	mapIDParts = defaultdict(list)
+	for partPath in glob.glob(os.path.join(partsPath, "*.collapsed")):
+		mapID = os.path.basename(partPath).split("_")[0]
+		mapIDParts[mapID].append(os.path.splitext(partPath)[0])
+
+	mapIDTimes = dict()
+	for mapID, partNames in mapIDParts.items():
+		stacks = defaultdict(float)
+		for partName in partNames:
+			for stack, seconds in readStacks(f"{partName}.collapsed").items():
+				stacks[stack] += seconds
+			os.remove(f"{partName}.collapsed")
+		writeStacks(os.path.join(profilePath, f"{mapID}.collapsed"), stacks)
+		if mode == "cprofile":
+			pstatsPaths = [f"{partName}.pstats" for partName in partNames]
+			pstats.Stats(*pstatsPaths).dump_stats(
+				os.path.join(profilePath, f"{mapID}.pstats"))
+			for pstatsPath in pstatsPaths:
+				os.remove(pstatsPath)
+		mapIDTimes[mapID] = attributeTime(stacks)
+	os.rmdir(partsPath)
+
+	summary = summarise(mapIDTimes)
+	with open(os.path.join(profilePath, "summary.txt"), 'w') as summaryFile:
+		summaryFile.write(summary + "\n")
+	print(summary)
+	print(f"Profiles of {len(mapIDTimes)} mapIDs saved to {profilePath}")
@@ -1,6 +1,13 @@
+import multiprocessing
 import platform
+import atexit
 import os
 
+from config import MapBuilderConfig
+import profiling
+
+MEGABYTE = 1024 ** 2
+
 def initializePyvips():
     # Detects the OS, then dispatches the import as needed
     OPERATING_SYSTEM = platform.system()
@@ -11,14 +18,45 @@ def initializePyvips():
         LIBVIPS_VERSION = "8.15"
         vipsbin = os.path.abspath(f"vipsbin/vips-dev-{LIBVIPS_VERSION}/bin")
         os.environ['PATH'] = os.pathsep.join((vipsbin, os.environ['PATH']))
-        # os.environ['VIPS_PROFILE'] = "1"
-        # os.environ["VIPS_CONCURRENCY"] = "1"
         # logging.basicConfig(level = logging.DEBUG)
     elif OPERATING_SYSTEM == "Linux":
         pass
     else:
         raise OSError("Operating system not recognized as Linux or Windows "
                     "for Pyvips Import")
+    # libvips only reads VIPS_PROFILE as it starts, see buildAllMapIDs
+    if profiling.isVipsProfiling():
+        os.environ['VIPS_PROFILE'] = "1"
+    # As is VIPS_CONCURRENCY, where 0 leaves libvips a thread per core
+    config = MapBuilderConfig()
+    if config and config.memory.vipsConcurrency:
+        os.environ['VIPS_CONCURRENCY'] = str(config.memory.vipsConcurrency)
+
+def applyCacheLimits():
+    # Limits of the libvips operation cache, from MEMORY_OPTS. Processes
+    # which have not loaded the configuration keep the libvips defaults
+    config = MapBuilderConfig()
+    if config:
+        pyvips.cache_set_max_mem(config.memory.vipsCacheMaxMB * MEGABYTE)
+        pyvips.cache_set_max(config.memory.vipsCacheMaxOperations)
+        pyvips.cache_set_max_files(config.memory.vipsCacheMaxFiles)
+
+def getSpawnContext():
+    # libvips does not survive forking once its threads exist, so worker
+    # processes are always spawned
+    return multiprocessing.get_context("spawn")
+
+def saveVipsProfile():
+    # libvips writes its profile to the working directory as it shuts down,
+    # so it is shut down before exiting and the file moved to the profiles
+    pyvips.vips_lib.vips_shutdown()
+    if os.path.exists("vips-profile.txt"):
+        profilePath = os.environ[profiling.VIPS_PROFILE_ENV]
+        os.replace("vips-profile.txt", os.path.join(
+            profilePath, f"vips-profile-{os.getpid()}.txt"))
     
 initializePyvips()
-import pyvips
\ No newline at end of file
+import pyvips
+applyCacheLimits()
+if profiling.isVipsProfiling():
+    atexit.register(saveVipsProfile)
\ No newline at end of file
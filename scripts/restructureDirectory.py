@@ -3,10 +3,9 @@ import os
 import numpy as np
 import time
 import glob
-import multiprocessing
-from memory_profiler import memory_usage
 import json
 import shutil
+import metrics
 
 def removeSubdirectories(topLevelDir):
 	# Use DFS to find tree leaves and remove them
@@ -21,28 +20,13 @@ def removeSubdirectories(topLevelDir):
 	for file in filesToRemove:
 		os.remove(file)
 
-def restructureDirectories(dzPath, outPath, coordinateData, baselineZoomLevel, multiprocessingEnabled):
+def restructureDirectories(dzPath, outPath, coordinateData, baselineZoomLevel):
 	# Grab the parent plane directory locations
 	planeDirectories = [os.path.normpath(path) for path in glob.glob(os.path.join(dzPath, "*/"))]
 
 	# Restructure on a plane by plane basis
-	if multiprocessingEnabled:
-		# Bundle with args for starmapping
-		# Pre-create directories when doing this, to avoid collisions
-		argList = list()
-		for planeDir in planeDirectories:
-			argList.append((planeDir, outPath, coordinateData, baselineZoomLevel))
-			for path in glob.glob(os.path.join(planeDir, "**/")):
-				zoomLevel = os.path.basename(os.path.dirname(path))
-				zoomLevelPath = os.path.join(outPath, zoomLevel)
-				if not os.path.exists(zoomLevelPath):
-					os.makedirs(zoomLevelPath)
-		# Assign cores to plane directories
-		# with multiprocessing.Pool() as pool:
-		# 	pool.starmap(restructureDirectory, argList)
-	else:
-		for directory in planeDirectories:
-			restructureDirectory(directory, outPath, coordinateData, baselineZoomLevel)
+	for directory in planeDirectories:
+		restructureDirectory(directory, outPath, coordinateData, baselineZoomLevel)
 	
 	removeSubdirectories(dzPath)
 	os.rmdir(dzPath)
@@ -89,9 +73,9 @@ def renameFile(imagePath, outPath, coordinateData, baselineZoomLevel,
 	# And conversion from the top left to bottom left origin can be made
 	y = int(layerHeight - y - 1)
 	outputPath = os.path.join(outPath, f"{zoom}")
-	if not os.path.exists(outputPath):
-		os.makedirs(outputPath)
+	os.makedirs(outputPath, exist_ok=True)
 	os.rename(imagePath, os.path.join(outputPath, f"{planeNum}_{x}_{y}.png"))
+	metrics.count("renames")
 
 
 def actionRoutine(basePath):
@@ -110,7 +94,6 @@ def actionRoutine(basePath):
 	with open(os.path.join(basePath, "coordinateData.json")) as coordFile:
 		coordinateData = json.load(coordFile)
 	
-	multiprocessingEnabled = configOpts["multiprocessingEnabled"]
 	dzPath = configOpts["dzPath"]
 	outPath = configOpts["outPath"]
 	baselineZoomLevel = configOpts["baselineZoomLevel"]
@@ -118,12 +101,11 @@ def actionRoutine(basePath):
 	dzPath = os.path.join(basePath, dzPath)
 	outPath = os.path.join(basePath, outPath)
 
-	restructureDirectories(dzPath, outPath, coordinateData, baselineZoomLevel, multiprocessingEnabled)
+	restructureDirectories(dzPath, outPath, coordinateData, baselineZoomLevel)
 
 
 if __name__ == "__main__":
 	startTime = time.time()
 	# restructureDirectories()
 	actionRoutine("./osrs-wiki-maps/out/mapgen/versions/2024-05-29_a")
-	# print(f"Peak memory usage: {max(memory_usage(proc=restructureDirectories))}")
 	print(f"Runtime: {time.time()-startTime}")
\ No newline at end of file
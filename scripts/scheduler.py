@@ -0,0 +1,372 @@
+"""
+Schedules mapID builds across worker processes under a memory budget
+
+Each mapID is costed from the bounding box of its definitions and its plane
+count. Small mapIDs are built whole by a single job, which runs the graph of
+its planes on threads, see taskgraph. Giant mapIDs are split into a graph of
+jobs: one render job per plane, a chain of composite jobs each stacking a
+plane over the composite beneath it, one tiling job per (plane, zoom) and a
+final icon job. Either way planes render concurrently, and each plane is
+tiled as soon as its own composite exists. Ready jobs are started
+largest-first whenever their estimated peak memory fits in what remains of
+the configured budget. Jobs which pass the job memory budget, and every job
+in flight when a worker is killed, are requeued once to run alone with the
+low-memory strategy, see memorybudget, in a new pool.
+"""
+from config import MapBuilderConfig, GlobalCoordinateDefinition
+# Spawned workers replace these once the configuration has been loaded
+GCS = GlobalCoordinateDefinition()
+CONFIG = MapBuilderConfig()
+
+from dataclasses import dataclass, field, replace
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from memorybudget import MemoryBudgetExceeded
+from pyvips_import import getSpawnContext
+import memorybudget
+import tracing
+import metrics
+import profiling
+import shutil
+import os
+import time
+
+MEGABYTE = 1024 ** 2
+# Stages which may be run again. Plane and tile jobs only overwrite their
+# outputs, a whole mapID starts again from nothing, and icons are opaque
+# wherever they are drawn, so drawing them over a tile twice changes nothing
+REQUEUE_STAGES = ("mapID", "render", "composite", "tile", "icons")
+
+# Worker processes keep expensive shared state between jobs
+WORKER_STATE = dict()
+
+
+@dataclass
+class BuildJob:
+	jobID: str
+	mapID: int
+	stage: str
+	estimatedMemory: int
+	estimatedRuntime: float
+	plane: int = None
+	zoomLevel: int = None
+	dependsOn: tuple = ()
+	mapDefs: dict = field(default=None, repr=False)
+	lowMemory: bool = False
+
+
+def estimateMapIDCost(defsStore):
+	# Size the mapID the same way the builder will lay out its planes
+	bbox = defsStore.getDefsBBox()
+	widthSquares = bbox["upperX"] - bbox["lowerX"] + 1
+	heightSquares = bbox["upperZ"] - bbox["lowerZ"] + 1
+	squareCount = widthSquares * heightSquares
+	# The builder clamps planes to the range 0 through 3
+	planeCount = min(3, bbox["upperPlane"]) + 1
+	planePixels = squareCount * GCS.squarePixelLength ** 2
+	return squareCount, planeCount, planePixels
+
+
+def estimateCompositeJob(planePixels, planeCount):
+	# Planes are assembled one after another, so memory is a single plane's
+	opts = CONFIG.scheduler
+	memory = opts.workerBaseMemoryMB * MEGABYTE
+	memory += opts.renderBytesPerPixel * planePixels
+	runtime = planePixels * planeCount / opts.pixelsPerSecond
+	return int(memory), runtime
+
+
+def estimatePlaneJob(planePixels):
+	# Rendering or compositing a single plane
+	return estimateCompositeJob(planePixels, 1)
+
+
+def estimateTileJob(planePixels, zoomLevel):
+	# Zooming scales the pixel count by the square of the scale factor
+	opts = CONFIG.scheduler
+	scaleFactor = 2.0 ** zoomLevel / 2.0 ** CONFIG.zoom.baselineZoomLevel
+	pixels = planePixels * scaleFactor ** 2
+	memory = opts.workerBaseMemoryMB * MEGABYTE
+	memory += opts.tileBytesPerPixel * pixels
+	runtime = pixels / opts.pixelsPerSecond
+	return int(memory), runtime
+
+
+def planMapIDJobs(mapID, mapDefs, defsStore) -> list[BuildJob]:
+	squareCount, planeCount, planePixels = estimateMapIDCost(defsStore)
+	compositeMemory, compositeRuntime = estimateCompositeJob(planePixels,
+															 planeCount)
+	zoomLevels = range(CONFIG.zoom.minZoom, CONFIG.zoom.maxZoom+1)
+	tileCosts = {zoomLevel: estimateTileJob(planePixels, zoomLevel)
+				 for zoomLevel in zoomLevels}
+
+	# Most mapIDs are small enough to be built in one go. Their planes are
+	# still rendered and tiled on as many threads as there are, see
+	# MapBuilder.createMapTiles, so they may hold several planes at once
+	if squareCount * planeCount < CONFIG.scheduler.splitThresholdSquares:
+		baseMemory = CONFIG.scheduler.workerBaseMemoryMB * MEGABYTE
+		planeMemory = max(compositeMemory,
+						  *(tileMemory for tileMemory, _ in tileCosts.values()))
+		threadCount = CONFIG.scheduler.mapIDThreads or os.cpu_count() or 1
+		memory = baseMemory + (planeMemory - baseMemory) * min(planeCount,
+															   threadCount)
+		runtime = compositeRuntime + planeCount * sum(
+			tileRuntime for _, tileRuntime in tileCosts.values())
+		return [BuildJob(f"{mapID}", mapID, "mapID", memory, runtime,
+						 mapDefs=mapDefs)]
+
+	# Giant mapIDs are split so their planes can be rendered, and their zoom
+	# levels tiled, concurrently. Only the composites form a chain, as each
+	# stacks its plane over the composited planes beneath it
+	planeMemory, planeRuntime = estimatePlaneJob(planePixels)
+	planeJobs = list()
+	tileJobs = list()
+	for planeNum in range(0, planeCount):
+		renderJob = BuildJob(f"{mapID}:render:{planeNum}", mapID, "render",
+							 planeMemory, planeRuntime, plane=planeNum,
+							 mapDefs=mapDefs)
+		compositeDeps = (renderJob.jobID,)
+		if planeNum > 0:
+			compositeDeps += (f"{mapID}:composite:{planeNum-1}",)
+		compositeJob = BuildJob(f"{mapID}:composite:{planeNum}", mapID,
+								"composite", planeMemory, planeRuntime,
+								plane=planeNum, dependsOn=compositeDeps,
+								mapDefs=mapDefs)
+		planeJobs.extend((renderJob, compositeJob))
+		for zoomLevel, (tileMemory, tileRuntime) in tileCosts.items():
+			tileJob = BuildJob(f"{mapID}:tile:{planeNum}:{zoomLevel}", mapID,
+							   "tile", tileMemory, tileRuntime,
+							   plane=planeNum, zoomLevel=zoomLevel,
+							   dependsOn=(compositeJob.jobID,),
+							   mapDefs=mapDefs)
+			tileJobs.append(tileJob)
+	iconJob = BuildJob(f"{mapID}:icons", mapID, "icons",
+					   CONFIG.scheduler.workerBaseMemoryMB * MEGABYTE, 0.0,
+					   dependsOn=tuple(job.jobID for job in tileJobs),
+					   mapDefs=mapDefs)
+	return [*planeJobs, *tileJobs, iconJob]
+
+
+def createBuildPlan(renderPlan: dict, basePath) -> list[BuildJob]:
+	from buildMapIDs import loadMapIDDefinitions
+	from managers import MapDefsManager
+
+	jobs = list()
+	for mapID, mapDefs in renderPlan.items():
+		squareDefs, zoneDefs = loadMapIDDefinitions(mapID, mapDefs, basePath)
+		defsStore = MapDefsManager(squareDefs, zoneDefs)
+		jobs.extend(planMapIDJobs(mapID, mapDefs, defsStore))
+	return jobs
+
+
+def runJobs(jobs: list[BuildJob], basePath, workerCount, memoryBudget):
+	# Returns the result of every job, keyed by job ID
+	# Longest jobs are started first so they do not trail at the end
+	pending = sorted(jobs, key=lambda job: job.estimatedRuntime, reverse=True)
+	finished = dict()
+	# A pool is replaced whenever one of its workers is killed
+	while pending:
+		pending = runPool(pending, finished, basePath, workerCount,
+						  memoryBudget)
+	return finished
+
+
+def runPool(pending: list[BuildJob], finished: dict, basePath, workerCount,
+			memoryBudget):
+	# Runs jobs until all have finished, or the pool breaks, returning the
+	# jobs still to run
+	running = dict()
+	reservedMemory = 0
+
+	context = getSpawnContext()
+	coordinatePath = os.path.join(basePath, "coordinateData.json")
+	initArgs = (CONFIG.jsonFilePath, coordinatePath)
+	with ProcessPoolExecutor(workerCount, mp_context=context,
+							 initializer=initializeWorker,
+							 initargs=initArgs) as pool:
+		while pending or running:
+			# Start every ready job that fits in the remaining budget
+			for job in list(pending):
+				if len(running) >= workerCount:
+					break
+				if not all(dep in finished for dep in job.dependsOn):
+					continue
+				# Requeued jobs run alone, so nothing starts beside them
+				if running and (job.lowMemory or any(
+						runningJob.lowMemory for runningJob, _ in running.values())):
+					continue
+				# A job larger than the whole budget runs alone, not never
+				jobMemory = min(job.estimatedMemory, memoryBudget)
+				if running and reservedMemory + jobMemory > memoryBudget:
+					continue
+				future = pool.submit(runJob, job, basePath)
+				running[future] = (job, jobMemory)
+				reservedMemory += jobMemory
+				pending.remove(job)
+
+			if not running:
+				blocked = [job.jobID for job in pending]
+				raise RuntimeError(f"Jobs can never be started: {blocked}")
+
+			# Release the budget of whichever jobs finish first
+			done, _ = wait(running, return_when=FIRST_COMPLETED)
+			broken = list()
+			for future in done:
+				job, jobMemory = running.pop(future)
+				reservedMemory -= jobMemory
+				try:
+					finished[job.jobID] = future.result()
+				except MemoryBudgetExceeded as error:
+					print(f"\t{job.jobID} passed the job memory budget, "
+						  f"requeued")
+					pending.insert(0, requeueJob(job, memoryBudget, error))
+				except BrokenProcessPool as error:
+					broken.append((job, error))
+
+			if broken:
+				# Every job left in a broken pool fails with it, without
+				# telling which worker was killed
+				broken += [(job, broken[0][1]) for job, _ in running.values()]
+				print(f"\tA worker was killed, requeued "
+					  f"{[job.jobID for job, _ in broken]}")
+				return [requeueJob(job, memoryBudget, error)
+						for job, error in broken] + pending
+	return pending
+
+
+def requeueJob(job: BuildJob, memoryBudget, error):
+	# Jobs are run again alone, with the low-memory strategy, but only once
+	if job.stage not in REQUEUE_STAGES or job.lowMemory:
+		raise error
+	return replace(job, lowMemory=True,
+				   estimatedMemory=min(job.estimatedMemory, memoryBudget))
+
+
+def scheduleMapIDs(renderPlan: dict, basePath):
+	# Builds every mapID in the render plan, returning the basemaps entries
+	# in render plan order
+	planTime = time.time()
+	jobs = createBuildPlan(renderPlan, basePath)
+	workerCount = CONFIG.scheduler.workerCount or os.cpu_count()
+	# Every libvips writes its profile to the same file until it exits
+	if profiling.isVipsProfiling():
+		workerCount = 1
+	memoryBudget = CONFIG.scheduler.memoryBudgetMB * MEGABYTE
+	print(f"Planned {len(jobs)} jobs for {len(renderPlan)} mapIDs on "
+		  f"{workerCount} workers within {CONFIG.scheduler.memoryBudgetMB}MB "
+		  f"({time.time()-planTime:.2f}s)")
+
+	results = runJobs(jobs, basePath, workerCount, memoryBudget)
+
+	# The last job of each mapID reports its basemaps entry
+	basemapsList = [results[job.jobID] for job in jobs
+					if job.stage in ("mapID", "icons")]
+
+	# Every job has cleaned up after itself, leaving an empty work directory
+	# unless another shard is still building in the same working directory
+	workPath = os.path.join(basePath, CONFIG.scheduler.workPath)
+	if os.path.exists(workPath) and not os.listdir(workPath):
+		try:
+			os.rmdir(workPath)
+		except OSError:
+			pass
+	return basemapsList
+
+
+def initializeWorker(configPath, coordinatePath):
+	# Spawned workers start without the singletons the builder relies on
+	global GCS, CONFIG
+	GCS = GlobalCoordinateDefinition.fromJSON(coordinatePath)
+	CONFIG = MapBuilderConfig.fromJSON(configPath)
+
+
+def getIconManager(basePath):
+	# Icon sprites are decoded once per worker rather than once per job
+	if "iconManager" not in WORKER_STATE:
+		from buildMapIDs import createIconManager
+		WORKER_STATE["iconManager"] = createIconManager(basePath)
+	return WORKER_STATE["iconManager"]
+
+
+def loadMapBuilder(job: BuildJob, basePath, tempPath):
+	# Sub-jobs rebuild the mosaic layout, which does not touch any pixels
+	from buildMapIDs import MapBuilder, loadMapIDDefinitions
+	from managers import MapDefsManager
+	squareDefs, zoneDefs = loadMapIDDefinitions(job.mapID, job.mapDefs,
+												basePath)
+	defsStore = MapDefsManager(squareDefs, zoneDefs)
+	return MapBuilder(defsStore, job.mapID, tempPath)
+
+
+def runJob(job: BuildJob, basePath):
+	# Executed inside a worker process
+	jobTime = time.time()
+	tempPath = os.path.join(basePath, CONFIG.scheduler.workPath,
+							str(job.mapID))
+
+	# Jobs which can be run again are stopped once over the memory budget
+	abortable = job.stage in REQUEUE_STAGES
+	with memorybudget.lowMemory(job.lowMemory), \
+			memorybudget.watch(job.mapID, job.stage, abortable):
+		# Whole mapIDs are traced and counted by buildMapID itself
+		if job.stage == "mapID":
+			return runJobStage(job, basePath, tempPath)
+		with tracing.span("job", mapID=job.mapID, stage=job.stage,
+						  plane=job.plane, zoom=job.zoomLevel,
+						  lowMemory=job.lowMemory), \
+				metrics.scope(job.mapID), profiling.profile(job.mapID):
+			result = runJobStage(job, basePath, tempPath)
+	print(f"\t{job.jobID} took {time.time()-jobTime:.2f}")
+	return result
+
+
+def removeMapIDOutputs(mapID, basePath, tempPath):
+	shutil.rmtree(tempPath, ignore_errors=True)
+	for directory in {CONFIG.directory.outPath, CONFIG.icon.mapIDDirectory}:
+		shutil.rmtree(os.path.join(basePath, directory, str(mapID)),
+					  ignore_errors=True)
+
+
+def runJobStage(job: BuildJob, basePath, tempPath):
+	import buildMapIDs
+	result = None
+	if job.stage == "mapID":
+		if job.lowMemory:
+			# A requeued mapID starts again without its partial outputs
+			removeMapIDOutputs(job.mapID, basePath, tempPath)
+		iconManager = getIconManager(basePath)
+		result = buildMapIDs.buildMapID(job.mapID, basePath, job.mapDefs,
+										iconManager, tempPath=tempPath)
+		os.rmdir(tempPath)
+	elif job.stage in ("render", "composite"):
+		mapBuilder = loadMapBuilder(job, basePath, tempPath)
+		# Planes without any display content are neither rendered nor stacked
+		if not (mapBuilder.lowerDisplayPlane <= job.plane
+				<= mapBuilder.upperDisplayPlane):
+			pass
+		elif job.stage == "render":
+			mapBuilder.renderPlane(job.plane, basePath)
+		else:
+			mapBuilder.compositePlane(job.plane, basePath)
+	elif job.stage == "tile":
+		mapBuilder = loadMapBuilder(job, basePath, tempPath)
+		compositePath = mapBuilder.getCompositePath(job.plane)
+		# Planes without any display content have no composite
+		if os.path.exists(compositePath):
+			mapBuilder.createZoomTiles(compositePath, job.plane,
+									   job.zoomLevel, basePath)
+	elif job.stage == "icons":
+		mapBuilder = loadMapBuilder(job, basePath, tempPath)
+		iconManager = getIconManager(basePath)
+		iconList = iconManager.getIconsInID(mapBuilder)
+		mapBuilder.renderIcons(
+			buildMapIDs.prepareIconTilesPath(basePath, job.mapID), iconList)
+		mapBuilder.removeTempDirectories()
+		# A requeued icon job may find it already removed
+		if os.path.exists(tempPath):
+			os.rmdir(tempPath)
+		result = buildMapIDs.getBaseMapsEntry(job.mapID, job.mapDefs,
+											  mapBuilder.defsStore)
+	else:
+		raise ValueError(f"Unknown job stage: {job.stage}")
+	return result
@@ -0,0 +1,160 @@
+"""
+Splits a build across several machines and merges the results
+
+The render plan is partitioned into shards with a deterministic, greedy
+longest-first assignment of estimated mapID costs, so every machine computes
+the same partition from the same definitions. Each shard writes its part of
+basemaps.json and an archive of its rendered tiles, and of its icon overlays
+or vector icon layers when icons are kept apart, which merge() combines into
+the output of a single-machine build.
+"""
+from config import MapBuilderConfig
+CONFIG = MapBuilderConfig()
+
+from zipfile import ZipFile, ZIP_STORED
+import json
+import glob
+import os
+
+
+def parseShard(shardSpec: str) -> tuple[int, int]:
+	# Shards are given as "i/N", counting from 1
+	try:
+		index, count = map(int, shardSpec.split("/"))
+	except ValueError:
+		raise ValueError(f"Shard must be given as i/N, not {shardSpec}")
+	if not 1 <= index <= count:
+		raise ValueError(f"Shard {index} is not in the range 1 to {count}")
+	return index, count
+
+
+def getShardName(index, count):
+	return f"{index}-of-{count}"
+
+
+def getArchivedDirectories():
+	# Each archive of a shard's tiles and the directory it is unpacked into
+	directories = {"rendered.zip": CONFIG.mapid.mapIDoutPath}
+	if CONFIG.icon.iconOutputMode == "overlay":
+		directories["icons.zip"] = CONFIG.icon.overlayPath
+	elif CONFIG.icon.iconOutputMode == "vector":
+		directories["icons.zip"] = CONFIG.icon.vectorPath
+	return directories
+
+
+def estimateMapIDCosts(renderPlan: dict, basePath) -> dict:
+	# The scheduler's runtime estimates are used to balance shards
+	from buildMapIDs import loadMapIDDefinitions
+	from managers import MapDefsManager
+	import scheduler
+
+	costs = dict()
+	for mapID, mapDefs in renderPlan.items():
+		squareDefs, zoneDefs = loadMapIDDefinitions(mapID, mapDefs, basePath)
+		defsStore = MapDefsManager(squareDefs, zoneDefs)
+		jobs = scheduler.planMapIDJobs(mapID, mapDefs, defsStore)
+		costs[mapID] = sum(job.estimatedRuntime for job in jobs)
+	return costs
+
+
+def partitionMapIDs(costs: dict, count) -> list[list]:
+	# Assign the most expensive mapIDs first, each to the least loaded shard
+	# Ties are broken by mapID and shard index so the result is reproducible
+	shardLoads = [0.0] * count
+	partition = [list() for _ in range(count)]
+	ordered = sorted(costs.items(), key=lambda item: (-item[1], item[0]))
+	for mapID, cost in ordered:
+		target = min(range(count), key=lambda i: (shardLoads[i], i))
+		partition[target].append(mapID)
+		shardLoads[target] += cost
+	return partition
+
+
+def selectShard(renderPlan: dict, basePath, index, count) -> dict:
+	# Returns the part of the render plan to be built by this shard
+	costs = estimateMapIDCosts(renderPlan, basePath)
+	partition = partitionMapIDs(costs, count)
+	shardMapIDs = set(partition[index-1])
+	print(f"Shard {index}/{count} builds {len(shardMapIDs)} of "
+		  f"{len(renderPlan)} mapIDs")
+	return {mapID: mapDefs for mapID, mapDefs in renderPlan.items()
+			if mapID in shardMapIDs}
+
+
+def writeShardOutputs(basePath, renderPlan: dict, basemapsList: list,
+					  index, count):
+	# Writes the partial basemaps and the archive of this shard's tiles
+	shardPath = os.path.join(basePath, CONFIG.mapid.shardsPath,
+							 getShardName(index, count))
+	os.makedirs(shardPath, exist_ok=True)
+
+	# The full render order lets the merge restore a single-machine ordering
+	partialBasemaps = {
+		"shardIndex": index,
+		"shardCount": count,
+		"renderOrder": list(renderPlan.keys()),
+		"basemaps": basemapsList
+	}
+	with open(os.path.join(shardPath, CONFIG.mapid.basemapsPath), 'w') as f:
+		json.dump(partialBasemaps, f)
+
+	# Tiles are already compressed PNGs, so they are stored as-is
+	for archiveName, directory in getArchivedDirectories().items():
+		tilesPath = os.path.join(basePath, directory)
+		archivePath = os.path.join(shardPath, archiveName)
+		with ZipFile(archivePath, 'w', ZIP_STORED) as archive:
+			for entry in basemapsList:
+				mapIDPath = os.path.join(tilesPath, str(entry["mapId"]))
+				tilePaths = glob.iglob(os.path.join(mapIDPath, "**/*.*"),
+									   recursive=True)
+				for tilePath in tilePaths:
+					archive.write(tilePath, os.path.relpath(tilePath, tilesPath))
+			# Files shared by every mapID, such as the sprite atlas
+			for sharedPath in glob.iglob(os.path.join(tilesPath, "*.*")):
+				archive.write(sharedPath, os.path.relpath(sharedPath, tilesPath))
+	print(f"Shard outputs saved to {shardPath}")
+
+
+def merge(basePath):
+	# Combines every shard's outputs into the final tiles and basemaps.json
+	shardsPath = os.path.join(basePath, CONFIG.mapid.shardsPath)
+	partialPaths = sorted(glob.glob(os.path.join(shardsPath, "*",
+												 CONFIG.mapid.basemapsPath)))
+	if not partialPaths:
+		raise FileNotFoundError(f"No shard outputs found in {shardsPath}")
+
+	partials = list()
+	for partialPath in partialPaths:
+		with open(partialPath) as partialFile:
+			partials.append((os.path.dirname(partialPath),
+							 json.load(partialFile)))
+
+	# Shards must all come from the same partition of the same render plan
+	renderOrder = partials[0][1]["renderOrder"]
+	count = partials[0][1]["shardCount"]
+	indices = sorted(partial["shardIndex"] for _, partial in partials)
+	if indices != list(range(1, count+1)):
+		raise ValueError(f"Expected shards 1 to {count}, found {indices}")
+	for shardPath, partial in partials:
+		if (partial["shardCount"] != count
+				or partial["renderOrder"] != renderOrder):
+			raise ValueError(f"{shardPath} was built from a different plan")
+
+	# Unpack the tiles and collect the basemaps entries
+	renderedPath = os.path.join(basePath, CONFIG.mapid.mapIDoutPath)
+	entries = dict()
+	for shardPath, partial in partials:
+		for archiveName, directory in getArchivedDirectories().items():
+			with ZipFile(os.path.join(shardPath, archiveName)) as archive:
+				archive.extractall(os.path.join(basePath, directory))
+		for entry in partial["basemaps"]:
+			entries[entry["mapId"]] = entry
+
+	missing = [mapID for mapID in renderOrder if mapID not in entries]
+	if missing:
+		raise ValueError(f"No shard built mapIDs {missing}")
+	basemapsList = [entries[mapID] for mapID in renderOrder]
+	basemapsPath = os.path.join(basePath, CONFIG.mapid.basemapsPath)
+	with open(basemapsPath, 'w') as f:
+		json.dump(basemapsList, f)
+	print(f"Merged {count} shards into {renderedPath}")
@@ -0,0 +1,246 @@
+"""
+Caches the parsed definitions and icon sprites as a binary snapshot
+
+Parsing the map definitions JSON and decoding every icon PNG is repeated by
+each build and by each scheduler worker. The snapshot stores the square,
+zone, region and icon definitions as typed NumPy arrays and the icon sprites
+as one packed atlas, in a directory named by a hash of every input it was
+built from. Any change to the definitions or sprites therefore produces a
+new snapshot, and an existing one is memory-mapped rather than parsed.
+"""
+from config import MapBuilderConfig
+CONFIG = MapBuilderConfig()
+
+from definitions import (IconDefinition, SQUARE_COLUMNS, ZONE_COLUMNS,
+						 REGION_COLUMNS, ICON_COLUMNS)
+
+import numpy as np
+import hashlib
+import shutil
+import glob
+import json
+import os
+import time
+
+# Pyvips import is OS-dependent, use dispatcher file
+from pyvips_import import pyvips as pv
+
+# Bump whenever the layout of the snapshot files changes
+SNAPSHOT_VERSION = 3
+ATLAS_WIDTH = 512
+
+# Loaded snapshots are reused for the lifetime of the process
+SNAPSHOTS = dict()
+
+
+def getInputPaths(basePath):
+	# Every file the snapshot is derived from, in a stable order
+	iconImageDir = os.path.join(basePath, CONFIG.icon.iconPath)
+	iconImagePaths = sorted(glob.glob(os.path.join(iconImageDir, "*.png")))
+	return [
+		os.path.join(basePath, CONFIG.mapid.mapDefsPath),
+		CONFIG.mapid.userMapDefsPath,
+		os.path.join(basePath, CONFIG.icon.iconDefs),
+		*iconImagePaths
+	]
+
+
+def getSnapshotKey(basePath):
+	# Hashes the contents of the inputs, so touched but unchanged files and
+	# copied working directories still reuse the snapshot
+	digest = hashlib.sha256(f"snapshot-v{SNAPSHOT_VERSION}".encode())
+	for inputPath in getInputPaths(basePath):
+		digest.update(os.path.basename(inputPath).encode())
+		with open(inputPath, 'rb') as inputFile:
+			digest.update(hashlib.sha256(inputFile.read()).digest())
+	return digest.hexdigest()[:16]
+
+
+def definitionRows(defsList, columns):
+	# Converts a list of JSON definitions into an int32 array of columns
+	rows = [[data.get(column) for column in columns]
+			for data in defsList or list()]
+	return np.array(rows, dtype=np.int32).reshape(-1, len(columns))
+
+
+def packSprites(iconImagePaths):
+	# Sprites are packed with their coverage band, see IconImage
+	from images import IconImage
+	sprites = dict()
+	for iconImagePath in iconImagePaths:
+		spriteID = int(os.path.basename(iconImagePath).split(".")[0])
+		image = IconImage.loadSprite(iconImagePath)
+		sprites[spriteID] = (image.numpy().reshape(image.height, image.width,
+												   image.bands),
+							 image.interpretation)
+	return packSpriteArrays(sprites)
+
+
+def packSpriteArrays(sprites: dict):
+	# Shelf-packs the (array, interpretation) sprites, tallest first, into a
+	# single RGBA atlas
+	rects = dict()
+	shelfX, shelfY, shelfHeight = 0, 0, 0
+	order = sorted(sprites, key=lambda s: (-sprites[s][0].shape[0], s))
+	for spriteID in order:
+		height, width, bands = sprites[spriteID][0].shape
+		if shelfX + width > ATLAS_WIDTH:
+			shelfX, shelfY, shelfHeight = 0, shelfY + shelfHeight, 0
+		rects[spriteID] = (shelfX, shelfY, width, height, bands,
+						   sprites[spriteID][1])
+		shelfX += width
+		shelfHeight = max(shelfHeight, height)
+
+	atlas = np.zeros((shelfY + shelfHeight, ATLAS_WIDTH, 4), dtype=np.uint8)
+	for spriteID, (x, y, width, height, bands, _) in rects.items():
+		atlas[y:y+height, x:x+width, :bands] = sprites[spriteID][0]
+	return atlas, rects
+
+
+def buildSnapshot(basePath, snapshotDir):
+	# Parses every input once and writes the arrays beside a manifest
+	from buildMapIDs import loadRenderPlanFromJSON
+	renderPlan = loadRenderPlanFromJSON(basePath)
+
+	# Definitions of all mapIDs are stacked, with each mapID owning a range
+	mapIDs = list()
+	squareRows = list()
+	zoneRows = list()
+	regionRows = list()
+	squareCount, zoneCount, regionCount = 0, 0, 0
+	for mapID, mapDefs in renderPlan.items():
+		if mapDefs is None:
+			mapIDs.append({"mapId": mapID})
+			continue
+		squares = definitionRows(mapDefs.get("mapSquareDefinitions"),
+								 SQUARE_COLUMNS)
+		zones = definitionRows(mapDefs.get("zoneDefinitions"), ZONE_COLUMNS)
+		regions = definitionRows(mapDefs.get("regionDefinitions"),
+								 REGION_COLUMNS)
+		# Everything except the definitions is kept as JSON
+		fields = {key: value for key, value in mapDefs.items()
+				  if key not in ("mapSquareDefinitions", "zoneDefinitions",
+								 "regionDefinitions")}
+		mapIDs.append({
+			"mapId": mapID,
+			"fields": fields,
+			"squares": [squareCount, squareCount + len(squares)],
+			"zones": [zoneCount, zoneCount + len(zones)],
+			"regions": [regionCount, regionCount + len(regions)]
+		})
+		squareRows.append(squares)
+		zoneRows.append(zones)
+		regionRows.append(regions)
+		squareCount += len(squares)
+		zoneCount += len(zones)
+		regionCount += len(regions)
+
+	iconDefsPath = os.path.join(basePath, CONFIG.icon.iconDefs)
+	iconDefs = IconDefinition.iconDefsFromJSON(iconDefsPath)
+	iconRows = np.array([[getattr(iconDef, column) for column in ICON_COLUMNS]
+						 for iconDef in iconDefs],
+						dtype=np.int32).reshape(-1, len(ICON_COLUMNS))
+
+	iconImageDir = os.path.join(basePath, CONFIG.icon.iconPath)
+	atlas, rects = packSprites(
+		sorted(glob.glob(os.path.join(iconImageDir, "*.png"))))
+
+	os.makedirs(snapshotDir)
+	np.save(os.path.join(snapshotDir, "squares.npy"),
+			np.concatenate(squareRows or [definitionRows([], SQUARE_COLUMNS)]))
+	np.save(os.path.join(snapshotDir, "zones.npy"),
+			np.concatenate(zoneRows or [definitionRows([], ZONE_COLUMNS)]))
+	np.save(os.path.join(snapshotDir, "regions.npy"),
+			np.concatenate(regionRows or [definitionRows([], REGION_COLUMNS)]))
+	np.save(os.path.join(snapshotDir, "icons.npy"), iconRows)
+	np.save(os.path.join(snapshotDir, "atlas.npy"), atlas)
+	manifest = {
+		"version": SNAPSHOT_VERSION,
+		"mapIds": mapIDs,
+		"sprites": {str(spriteID): rect for spriteID, rect in rects.items()}
+	}
+	with open(os.path.join(snapshotDir, "manifest.json"), 'w') as f:
+		json.dump(manifest, f)
+
+
+def readSnapshot(snapshotDir):
+	# Arrays are memory-mapped, so only the rows in use are ever read
+	with open(os.path.join(snapshotDir, "manifest.json")) as manifestFile:
+		manifest = json.load(manifestFile)
+	arrays = {name: np.load(os.path.join(snapshotDir, f"{name}.npy"),
+							mmap_mode="r")
+			  for name in ("squares", "zones", "regions", "icons", "atlas")}
+
+	renderPlan = dict()
+	for entry in manifest["mapIds"]:
+		if "fields" not in entry:
+			renderPlan[entry["mapId"]] = None
+			continue
+		mapDefs = dict(entry["fields"])
+		mapDefs["squareRows"] = arrays["squares"][slice(*entry["squares"])]
+		mapDefs["zoneRows"] = arrays["zones"][slice(*entry["zones"])]
+		mapDefs["regionRows"] = arrays["regions"][slice(*entry["regions"])]
+		renderPlan[entry["mapId"]] = mapDefs
+
+	return {
+		"renderPlan": renderPlan,
+		"iconRows": arrays["icons"],
+		"atlas": arrays["atlas"],
+		"sprites": {int(spriteID): rect
+					for spriteID, rect in manifest["sprites"].items()}
+	}
+
+
+def loadSnapshot(basePath):
+	# Returns the snapshot for the current inputs, building it if needed
+	snapshotPath = os.path.join(basePath, CONFIG.mapid.snapshotPath)
+	key = getSnapshotKey(basePath)
+	snapshotDir = os.path.join(snapshotPath, key)
+	if snapshotDir in SNAPSHOTS:
+		return SNAPSHOTS[snapshotDir]
+
+	if not os.path.exists(snapshotDir):
+		startTime = time.time()
+		# Built aside and renamed into place, so readers never see a partial
+		# snapshot and concurrent builders do not collide
+		tempDir = f"{snapshotDir}.tmp-{os.getpid()}"
+		shutil.rmtree(tempDir, ignore_errors=True)
+		buildSnapshot(basePath, tempDir)
+		try:
+			os.rename(tempDir, snapshotDir)
+		except OSError:
+			# Another process finished the same snapshot first
+			shutil.rmtree(tempDir, ignore_errors=True)
+		# Snapshots of earlier inputs are never read again
+		for oldDir in glob.glob(os.path.join(snapshotPath, "*")):
+			if oldDir != snapshotDir and ".tmp-" not in oldDir:
+				shutil.rmtree(oldDir, ignore_errors=True)
+		print(f"Definitions snapshot {key} built in "
+			  f"{time.time()-startTime:.2f}s")
+
+	SNAPSHOTS[snapshotDir] = readSnapshot(snapshotDir)
+	return SNAPSHOTS[snapshotDir]
+
+
+def loadRenderPlan(basePath):
+	return loadSnapshot(basePath)["renderPlan"]
+
+
+def loadIconDefinitions(basePath):
+	return IconDefinition.iconDefsFromArray(loadSnapshot(basePath)["iconRows"])
+
+
+def loadIconImages(basePath):
+	# Cuts each sprite back out of the atlas, keyed by sprite ID
+	from images import IconImage
+	snapshot = loadSnapshot(basePath)
+	atlas = snapshot["atlas"]
+	iconImageDir = os.path.join(basePath, CONFIG.icon.iconPath)
+	iconImages = dict()
+	for spriteID, rect in snapshot["sprites"].items():
+		x, y, width, height, bands, interpretation = rect
+		sprite = np.ascontiguousarray(atlas[y:y+height, x:x+width, :bands])
+		image = pv.Image.new_from_array(sprite, interpretation=interpretation)
+		iconImagePath = os.path.join(iconImageDir, f"{spriteID}.png")
+		iconImages[spriteID] = IconImage(iconImagePath, image)
+	return iconImages
@@ -0,0 +1,120 @@
+"""
+Caches rendered planes and composites between builds
+
+Rendering a mapID's planes and stacking them into composites is the most
+expensive part of a build, yet it only depends on the definitions, the source
+tiles and the composite options. Each stage's output is stored under a hash
+of exactly those inputs, so a build that only changes the zoom, icon or tiling
+options starts from the cached composites. A styling change reuses every
+rendered plane and stacked base, and only composites the planes above 0 again.
+
+Entries are hard links to the files the builder writes anyway to restart its
+pipelines, so storing one costs no extra encoding. Where a link cannot be made,
+such as across filesystems or where links are not permitted, the file is
+copied instead. The least recently used entries are pruned to the size limit
+before each entry is stored, and again once a build ends.
+"""
+from config import MapBuilderConfig
+CONFIG = MapBuilderConfig()
+
+import hashlib
+import shutil
+import glob
+import os
+
+# Bump whenever the rendering or compositing of planes changes
+STAGE_CACHE_VERSION = 1
+MEGABYTE = 1024 ** 2
+
+# Source tiles are hashed once per process, unless they change on disk
+FILE_DIGESTS = dict()
+
+
+def getCachePath(basePath):
+	return os.path.join(basePath, CONFIG.mapid.stageCachePath)
+
+
+def fileDigest(path):
+	# Missing source tiles are rendered blank, which is part of the key too
+	if not os.path.exists(path):
+		return None
+	stat = os.stat(path)
+	fileKey = (path, stat.st_size, stat.st_mtime_ns)
+	if fileKey not in FILE_DIGESTS:
+		with open(path, 'rb') as sourceFile:
+			FILE_DIGESTS[fileKey] = hashlib.sha256(sourceFile.read()).hexdigest()
+	return FILE_DIGESTS[fileKey]
+
+
+def makeKey(*parts):
+	# Hashes the repr of the parts, which must be plain, ordered values
+	digest = hashlib.sha256(f"stages-v{STAGE_CACHE_VERSION}".encode())
+	digest.update(repr(parts).encode())
+	return digest.hexdigest()[:32]
+
+
+def getEntryPath(basePath, key, targetPath):
+	extension = os.path.splitext(targetPath)[1]
+	return os.path.join(getCachePath(basePath), f"{key}{extension}")
+
+
+def linkFile(sourcePath, targetPath):
+	# Links are created aside and renamed into place, so that concurrent
+	# workers never see a partial file. Copies are used across filesystems
+	tempPath = f"{targetPath}.tmp-{os.getpid()}"
+	try:
+		os.link(sourcePath, tempPath)
+	except OSError:
+		shutil.copyfile(sourcePath, tempPath)
+	os.replace(tempPath, targetPath)
+
+
+def fetch(basePath, key, targetPath) -> bool:
+	# Places the cached output of a stage at the target path, if there is one
+	entryPath = getEntryPath(basePath, key, targetPath)
+	try:
+		linkFile(entryPath, targetPath)
+		# Entries are pruned least recently used first
+		os.utime(entryPath)
+	except FileNotFoundError:
+		# Missing, or pruned by another worker meanwhile
+		return False
+	return True
+
+
+def store(basePath, key, sourcePath):
+	# Keeps the output of a stage for later builds
+	entryPath = getEntryPath(basePath, key, sourcePath)
+	os.makedirs(os.path.dirname(entryPath), exist_ok=True)
+	# Room is made first, so the cache never grows past its limit
+	prune(basePath, os.path.getsize(sourcePath))
+	linkFile(sourcePath, entryPath)
+
+
+def prune(basePath, reservedBytes=0):
+	# Removes the least recently used entries beyond the size limit, less
+	# the bytes reserved for an entry about to be stored
+	entries = list()
+	for entryPath in glob.iglob(os.path.join(getCachePath(basePath), "*.*")):
+		if ".tmp-" in entryPath:
+			continue
+		try:
+			stat = os.stat(entryPath)
+		except FileNotFoundError:
+			# Pruned by another worker meanwhile
+			continue
+		entries.append((stat.st_mtime, stat.st_size, entryPath))
+	entries.sort(reverse=True)
+	limit = CONFIG.mapid.stageCacheMB * MEGABYTE - reservedBytes
+	totalSize = 0
+	removed = 0
+	for _, size, entryPath in entries:
+		totalSize += size
+		if totalSize > limit:
+			try:
+				os.remove(entryPath)
+				removed += 1
+			except FileNotFoundError:
+				pass
+	if removed:
+		print(f"Pruned {removed} stage cache entries")
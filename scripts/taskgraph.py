@@ -0,0 +1,61 @@
+"""
+Runs a graph of dependent tasks on a pool of threads
+
+Each task starts as soon as every task it depends on has finished, and
+whenever a thread is free the first ready task, in the order the tasks were
+given, is started. libvips and the PNG codecs release the GIL while they
+work, so the threads of a single process use every core. With a single
+thread the tasks are run in the calling thread, one after another.
+
+The first task to fail stops any more from starting, and its error is raised
+once the tasks already running have ended.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import Callable
+
+
+@dataclass
+class Task:
+	run: Callable
+	dependsOn: tuple = ()
+
+
+def runTasks(tasks: dict[object, Task], threadCount):
+	# Returns the result of every task, keyed like the tasks
+	for key, task in tasks.items():
+		unknown = [dep for dep in task.dependsOn if dep not in tasks]
+		if unknown:
+			raise ValueError(f"Task {key} depends on unknown tasks {unknown}")
+	pending = dict(tasks)
+	finished = dict()
+	if threadCount <= 1:
+		while pending:
+			key = nextReadyTask(pending, finished)
+			finished[key] = pending.pop(key).run()
+		return finished
+
+	running = dict()
+	with ThreadPoolExecutor(threadCount) as pool:
+		while pending or running:
+			# Tasks are only handed to free threads, so that a task which
+			# becomes ready later can still start ahead of those after it
+			while len(running) < threadCount:
+				key = nextReadyTask(pending, finished, required=not running)
+				if key is None:
+					break
+				running[pool.submit(pending.pop(key).run)] = key
+			done, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				finished[running.pop(future)] = future.result()
+	return finished
+
+
+def nextReadyTask(pending: dict, finished: dict, required=True):
+	# The first pending task whose dependencies have all finished
+	for key, task in pending.items():
+		if all(dep in finished for dep in task.dependsOn):
+			return key
+	if required and pending:
+		raise RuntimeError(f"Tasks can never be started: {list(pending)}")
+	return None
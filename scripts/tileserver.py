@@ -0,0 +1,474 @@
+"""
+Serves map tiles rendered on demand, for previews and QA
+
+Rather than building every tile of every mapID, the tile server renders a
+tile the first time it is asked for, at the same paths as the rendered tiles,
+/<mapID>/<zoom>/<plane>_<x>_<y>.png. A mapID's definitions and icons are
+loaded when it is first asked for, and each plane's composite when one of its
+tiles is, through the builder's own stages, so the stage cache is shared with
+builds. Tiles are then cut from the rescaled composite and have their icons
+drawn exactly as a build would. With the overlay icon output mode, the tiles
+are left without icons, which are served as overlays at /icons/<mapID>/...
+instead, and with the vector mode each mapID's icon layer is served at
+/vector/<mapID>/icons.json beside the sprite atlas at /vector/sprites.png and
+/vector/sprites.json.
+
+Tiles are kept under a hash of everything they depend on, in memory and on
+disk, each bounded in size and evicting the least recently used. Concurrent
+requests for a tile render it once, and the tiles around each requested tile
+are rendered in the background, as a map viewer will likely ask for them next.
+Tiles a build would not write are answered with 404.
+"""
+from config import MapBuilderConfig, GlobalCoordinateDefinition
+GCS = GlobalCoordinateDefinition()
+CONFIG = MapBuilderConfig()
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict
+from managers import MapDefsManager
+from buildMapIDs import MapBuilder
+import buildMapIDs
+import stagecache
+import iconlayer
+import traceback
+import threading
+import shutil
+import glob
+import json
+import re
+import numpy as np
+import os
+
+# Pyvips import is OS-dependent, use dispatcher file
+from pyvips_import import pyvips as pv
+
+# Only local map viewers talk to the tile server
+HOST = "127.0.0.1"
+TILE_PATTERN = re.compile(
+	r"^/(icons/)?(-?\d+)/(-?\d+)/(\d+)_(-?\d+)_(-?\d+)\.png$")
+VECTOR_PATTERN = re.compile(
+	r"^/vector/(?:(-?\d+)/icons\.json|sprites\.(png|json))$")
+CONTENT_TYPES = {"png": "image/png", "json": "application/json"}
+MEGABYTE = 1024 ** 2
+# Tiles a build would not write are cached too, as empty entries
+NO_TILE = b""
+# Counted against the memory limit for every entry, even empty ones
+ENTRY_OVERHEAD = 256
+# The disk cache is pruned below its limit, so pruning is not repeated for
+# every new tile
+DISK_PRUNE_FRACTION = 0.75
+
+
+class TileCache:
+	# Keeps tiles by key in memory and on disk, evicting the least recently
+	# used once either passes its limit
+	def __init__(self, cachePath, memoryLimit, diskLimit):
+		self.cachePath = cachePath
+		self.memoryLimit = memoryLimit
+		self.diskLimit = diskLimit
+		self.memoryTiles = OrderedDict()
+		self.memorySize = 0
+		self.diskSize = sum(os.path.getsize(entryPath)
+							for entryPath in self.getEntryPaths())
+		self.lock = threading.Lock()
+		self.pruneLock = threading.Lock()
+
+	def getTilePath(self, key):
+		return os.path.join(self.cachePath, key[:2], f"{key}.png")
+
+	def getEntryPaths(self):
+		entryPaths = glob.glob(os.path.join(self.cachePath, "*", "*.png"))
+		return [entryPath for entryPath in entryPaths
+				if ".tmp-" not in entryPath]
+
+	def get(self, key):
+		with self.lock:
+			if key in self.memoryTiles:
+				self.memoryTiles.move_to_end(key)
+				return self.memoryTiles[key]
+		tilePath = self.getTilePath(key)
+		try:
+			with open(tilePath, 'rb') as tileFile:
+				data = tileFile.read()
+			# Entries are pruned least recently used first
+			os.utime(tilePath)
+		except FileNotFoundError:
+			return None
+		self.putMemory(key, data)
+		return data
+
+	def put(self, key, data):
+		self.putMemory(key, data)
+		tilePath = self.getTilePath(key)
+		os.makedirs(os.path.dirname(tilePath), exist_ok=True)
+		# Written aside and renamed into place, so readers never see a
+		# partial tile
+		tempPath = f"{tilePath}.tmp-{threading.get_ident()}"
+		with open(tempPath, 'wb') as tileFile:
+			tileFile.write(data)
+		os.replace(tempPath, tilePath)
+		with self.lock:
+			self.diskSize += len(data)
+			pruneDisk = self.diskSize > self.diskLimit
+		if pruneDisk:
+			self.pruneDisk()
+
+	def putMemory(self, key, data):
+		with self.lock:
+			if key in self.memoryTiles:
+				return
+			self.memoryTiles[key] = data
+			self.memorySize += len(data) + ENTRY_OVERHEAD
+			while self.memorySize > self.memoryLimit and self.memoryTiles:
+				_, evicted = self.memoryTiles.popitem(last=False)
+				self.memorySize -= len(evicted) + ENTRY_OVERHEAD
+
+	def pruneDisk(self):
+		# Removes the least recently used tiles on disk beyond the limit. Only
+		# one thread prunes, and the others carry on meanwhile
+		if not self.pruneLock.acquire(blocking=False):
+			return
+		try:
+			entries = list()
+			for entryPath in self.getEntryPaths():
+				try:
+					stat = os.stat(entryPath)
+				except FileNotFoundError:
+					continue
+				entries.append((stat.st_mtime, stat.st_size, entryPath))
+			entries.sort(reverse=True)
+			limit = self.diskLimit * DISK_PRUNE_FRACTION
+			totalSize = 0
+			for _, entrySize, entryPath in entries:
+				if totalSize + entrySize > limit:
+					os.remove(entryPath)
+				else:
+					totalSize += entrySize
+			with self.lock:
+				self.diskSize = totalSize
+		finally:
+			self.pruneLock.release()
+
+
+class MapTiles:
+	# The builder of one mapID, which renders each composite as it is first
+	# needed and keeps it open for the tiles cut from it
+	def __init__(self, mapID, mapDefs, basePath, workPath, iconManager):
+		self.basePath = basePath
+		squareDefs, zoneDefs = buildMapIDs.loadMapIDDefinitions(mapID, mapDefs,
+																basePath)
+		self.builder = MapBuilder(MapDefsManager(squareDefs, zoneDefs), mapID,
+								  workPath)
+		iconList = iconManager.getIconsInID(self.builder)
+		self.iconList = iconList
+		self.tilesWithIcons = {
+			zoomLevel: MapBuilder.getTilesWithIcons(iconList, zoomLevel)
+			for zoomLevel, hasIcons in CONFIG.icon.zoomLevelHasIcons.items()
+			if hasIcons}
+		# Icons are otherwise only drawn onto overlays
+		self.burnIcons = CONFIG.icon.iconOutputMode == "burned"
+		self.composites = dict()
+		self.zoomedImages = dict()
+		self.occupiedTiles = dict()
+		self.lock = threading.Lock()
+
+	def hasPlane(self, planeNum):
+		return (self.builder.lowerDisplayPlane <= planeNum
+				<= self.builder.upperDisplayPlane)
+
+	def getTileIcons(self, planeNum, zoomLevel, tileX, tileZ):
+		tilesWithIcons = self.tilesWithIcons.get(zoomLevel, dict())
+		return tilesWithIcons.get(planeNum, dict()).get((tileX, tileZ), list())
+
+	def getBurnedIcons(self, planeNum, zoomLevel, tileX, tileZ):
+		if not self.burnIcons:
+			return list()
+		return self.getTileIcons(planeNum, zoomLevel, tileX, tileZ)
+
+	@staticmethod
+	def getIconsKey(icons, zoomLevel):
+		return [(stagecache.fileDigest(icon.imageContainer.sourcePath),
+				 icon.tilePosition[zoomLevel], icon.positionInTile[zoomLevel])
+				for icon in icons]
+
+	def getTileKey(self, planeNum, zoomLevel, tileX, tileZ):
+		# A tile depends on its composite, how it is rescaled and the icons
+		# drawn on it, all of which are known before anything is rendered
+		compositeKey = self.builder.getCompositeKey(planeNum, self.basePath)
+		icons = self.getBurnedIcons(planeNum, zoomLevel, tileX, tileZ)
+		return stagecache.makeKey("tile", compositeKey, zoomLevel,
+								  CONFIG.zoom.kernels[zoomLevel],
+								  CONFIG.zoom.baselineZoomLevel,
+								  tileX, tileZ, self.getIconsKey(icons, zoomLevel))
+
+	def getOverlayKey(self, planeNum, zoomLevel, tileX, tileZ):
+		icons = self.getTileIcons(planeNum, zoomLevel, tileX, tileZ)
+		return stagecache.makeKey("overlay", zoomLevel, tileX, tileZ,
+								  self.getIconsKey(icons, zoomLevel))
+
+	def getZoomedImage(self, planeNum, zoomLevel):
+		# Rescaling only builds a pipeline, which runs for the tiles cut from it
+		with self.lock:
+			# Each composite is stacked on the planes beneath it
+			for lowerPlaneNum in range(self.builder.lowerDisplayPlane,
+									   planeNum+1):
+				if lowerPlaneNum not in self.composites:
+					self.builder.renderPlane(lowerPlaneNum, self.basePath)
+					compositePath = self.builder.compositePlane(lowerPlaneNum,
+																self.basePath)
+					self.composites[lowerPlaneNum] = pv.Image.new_from_file(
+						compositePath)
+			if (planeNum, zoomLevel) not in self.zoomedImages:
+				targetPlane = self.builder.planes[planeNum]
+				self.zoomedImages[(planeNum, zoomLevel)] = \
+					self.builder.rescaleImages(self.composites[planeNum],
+											   zoomLevel,
+											   targetPlane.bbox["lowerX"],
+											   targetPlane.bbox["lowerZ"])
+				self.occupiedTiles[(planeNum, zoomLevel)] = \
+					self.builder.getOccupiedTiles(planeNum, zoomLevel)
+			return self.zoomedImages[(planeNum, zoomLevel)]
+
+	def renderTile(self, planeNum, zoomLevel, tileX, tileZ):
+		# Returns the tile as a PNG, or NO_TILE if a build would not write it
+		zoomedImage = self.getZoomedImage(planeNum, zoomLevel)
+		tile = None
+		if (tileX, tileZ) in self.occupiedTiles[(planeNum, zoomLevel)]:
+			tile = self.builder.cropTile(zoomedImage, zoomLevel, tileX, tileZ)
+			if tile is not None and self.builder.isBlankTile(tile):
+				tile = None
+		icons = self.getBurnedIcons(planeNum, zoomLevel, tileX, tileZ)
+		if tile is None and not icons:
+			return NO_TILE
+
+		if tile is None:
+			tileImage = self.builder.createBlankTile()
+		else:
+			tileImage = pv.Image.new_from_array(np.ascontiguousarray(tile[..., :3]),
+												 interpretation="srgb")
+		if icons:
+			tileImage = self.builder.overlayIcons(tileImage, tileX, tileZ,
+												  icons, zoomLevel)
+		return tileImage.write_to_buffer(".png")
+
+	def renderOverlay(self, planeNum, zoomLevel, tileX, tileZ):
+		# Returns the icon overlay as a PNG, or NO_TILE if it has no icons
+		icons = self.getTileIcons(planeNum, zoomLevel, tileX, tileZ)
+		if not icons:
+			return NO_TILE
+		overlay = self.builder.createIconOverlay(tileX, tileZ, icons, zoomLevel)
+		return overlay.write_to_buffer(".png")
+
+	def getIconLayer(self):
+		return iconlayer.encodeJSON(iconlayer.createIconLayer(self.builder.mapID,
+															  self.iconList))
+
+	def close(self):
+		self.builder.removeTempDirectories()
+
+
+class TileServer:
+	def __init__(self, basePath):
+		self.basePath = basePath
+		self.renderPlan = buildMapIDs.loadRenderPlan(basePath)
+		self.iconManager = buildMapIDs.createIconManager(basePath)
+
+		opts = CONFIG.tileserver
+		serverPath = os.path.join(basePath, opts.tileServerPath)
+		# Composites of an earlier run are not reused, the stage cache is
+		self.workPath = os.path.join(serverPath, "work")
+		shutil.rmtree(self.workPath, ignore_errors=True)
+		self.cache = TileCache(os.path.join(serverPath, "tiles"),
+							   opts.memoryCacheMB * MEGABYTE,
+							   opts.diskCacheMB * MEGABYTE)
+		self.prefetchRadius = opts.prefetchRadius
+		self.prefetcher = ThreadPoolExecutor(opts.prefetchWorkers)
+
+		self.mapTiles = dict()
+		self.basemaps = None
+		self.spriteAtlas = None
+		self.flights = dict()
+		self.flightLock = threading.Lock()
+
+	def singleFlight(self, key, function):
+		# Concurrent calls with the same key wait for the first, and share
+		# its result
+		with self.flightLock:
+			flight = self.flights.get(key)
+			leader = flight is None
+			if leader:
+				flight = self.flights[key] = Future()
+		if not leader:
+			return flight.result()
+		try:
+			result = function()
+			flight.set_result(result)
+			return result
+		except BaseException as error:
+			flight.set_exception(error)
+			raise
+		finally:
+			with self.flightLock:
+				del self.flights[key]
+
+	def getMapTiles(self, mapID):
+		if mapID not in self.mapTiles:
+			def loadMapTiles():
+				if mapID not in self.mapTiles:
+					self.mapTiles[mapID] = MapTiles(
+						mapID, self.renderPlan[mapID], self.basePath,
+						os.path.join(self.workPath, str(mapID)),
+						self.iconManager)
+				return self.mapTiles[mapID]
+			return self.singleFlight(("mapID", mapID), loadMapTiles)
+		return self.mapTiles[mapID]
+
+	def getBasemaps(self):
+		# Entries for every mapID, as a build writes to basemaps.json, which
+		# only needs their definitions
+		if self.basemaps is None:
+			def loadBasemaps():
+				return [buildMapIDs.getBaseMapsEntry(
+							mapID, mapDefs, self.getMapTiles(mapID).builder.defsStore)
+						for mapID, mapDefs in self.renderPlan.items()]
+			self.basemaps = self.singleFlight("basemaps", loadBasemaps)
+		return self.basemaps
+
+	def getIconLayer(self, mapID):
+		# Returns the mapID's vector icon layer as JSON, or None without one
+		if (CONFIG.icon.iconOutputMode != "vector"
+				or mapID not in self.renderPlan):
+			return None
+		return self.getMapTiles(mapID).getIconLayer()
+
+	def getSpriteAtlas(self, extension):
+		# Returns the sprite atlas as a PNG, or its offsets as JSON, packed
+		# once for every mapID
+		if CONFIG.icon.iconOutputMode != "vector":
+			return None
+		if self.spriteAtlas is None:
+			def packSpriteAtlas():
+				atlas, offsets = iconlayer.createSpriteAtlas(
+					self.iconManager.iconIDtoImage)
+				return {"png": atlas.write_to_buffer(".png"),
+						"json": iconlayer.encodeJSON(offsets)}
+			self.spriteAtlas = self.singleFlight("sprites", packSpriteAtlas)
+		return self.spriteAtlas[extension]
+
+	def getTile(self, overlay, mapID, zoomLevel, planeNum, tileX, tileZ,
+				prefetch=True):
+		# Returns the tile, or its icon overlay, as a PNG, or None if a build
+		# would not write it
+		if (mapID not in self.renderPlan
+				or not CONFIG.zoom.minZoom <= zoomLevel <= CONFIG.zoom.maxZoom
+				or overlay and CONFIG.icon.iconOutputMode != "overlay"):
+			return None
+		mapTiles = self.getMapTiles(mapID)
+		if not mapTiles.hasPlane(planeNum):
+			return None
+
+		if overlay:
+			key = mapTiles.getOverlayKey(planeNum, zoomLevel, tileX, tileZ)
+			render = mapTiles.renderOverlay
+		else:
+			key = mapTiles.getTileKey(planeNum, zoomLevel, tileX, tileZ)
+			render = mapTiles.renderTile
+		def fetchTile():
+			data = self.cache.get(key)
+			if data is None:
+				data = render(planeNum, zoomLevel, tileX, tileZ)
+				self.cache.put(key, data)
+			return data
+		data = self.singleFlight(key, fetchTile)
+
+		if prefetch:
+			self.prefetchNeighbours(overlay, mapID, zoomLevel, planeNum, tileX,
+									tileZ)
+		return data or None
+
+	def prefetchNeighbours(self, overlay, mapID, zoomLevel, planeNum, tileX,
+						   tileZ):
+		radius = self.prefetchRadius
+		for dx in range(-radius, radius+1):
+			for dz in range(-radius, radius+1):
+				if dx or dz:
+					self.prefetcher.submit(self.prefetchTile, overlay, mapID,
+										   zoomLevel, planeNum, tileX+dx,
+										   tileZ+dz)
+
+	def prefetchTile(self, *tile):
+		try:
+			self.getTile(*tile, prefetch=False)
+		except Exception:
+			traceback.print_exc()
+
+	def close(self):
+		self.prefetcher.shutdown(wait=True, cancel_futures=True)
+		for mapTiles in self.mapTiles.values():
+			mapTiles.close()
+		shutil.rmtree(self.workPath, ignore_errors=True)
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		tileServer = self.server.tileServer
+		path = self.path.split("?")[0]
+		try:
+			if path == "/basemaps.json":
+				body = json.dumps(tileServer.getBasemaps()).encode()
+				self.sendBody(200, "application/json", body)
+				return
+			match = TILE_PATTERN.match(path)
+			vectorMatch = VECTOR_PATTERN.match(path)
+			data = None
+			contentType = CONTENT_TYPES["png"]
+			if match:
+				overlay, *tile = match.groups()
+				data = tileServer.getTile(bool(overlay), *map(int, tile))
+			elif vectorMatch:
+				mapID, extension = vectorMatch.groups()
+				if mapID is None:
+					data = tileServer.getSpriteAtlas(extension)
+					contentType = CONTENT_TYPES[extension]
+				else:
+					data = tileServer.getIconLayer(int(mapID))
+					contentType = CONTENT_TYPES["json"]
+		except Exception as error:
+			traceback.print_exc()
+			self.sendBody(500, "text/plain", repr(error).encode())
+			return
+		if data is None:
+			self.sendBody(404, "text/plain", b"No tile")
+		else:
+			self.sendBody(200, contentType, data)
+
+	def sendBody(self, status, contentType, body):
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		# Map viewers are usually served from another origin
+		self.send_header("Access-Control-Allow-Origin", "*")
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_request(self, code="-", size="-"):
+		# Every tile would otherwise be logged
+		if int(code) >= 500:
+			super().log_request(code, size)
+
+
+def serve(basePath, port=None):
+	tileServer = TileServer(basePath)
+	port = int(port or CONFIG.tileserver.tileServerPort)
+	server = ThreadingHTTPServer((HOST, port), TileRequestHandler)
+	server.tileServer = tileServer
+	print(f"Tile server listening on http://{HOST}:{port}, serving "
+		  f"{len(tileServer.renderPlan)} mapIDs")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		tileServer.close()
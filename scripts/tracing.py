@@ -0,0 +1,135 @@
+"""
+Records the stages of a build as spans in Chrome trace-event format
+
+Stages are wrapped in spans carrying attributes such as the mapID, plane,
+zoom level, pixel dimensions and tile counts. The finished spans of every
+process, including each scheduler worker, are collected as parts, see parts.
+Once the build ends they are gathered into a single trace.json, which
+Perfetto or chrome://tracing can open, and a table of the time each mapID
+spent in each stage.
+
+Spans cost almost nothing while tracing is disabled, as they only check the
+environment and hand back their attributes.
+"""
+from config import MapBuilderConfig
+CONFIG = MapBuilderConfig()
+
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+import parts
+import json
+import time
+import os
+
+# Set by startTrace, and inherited by worker processes
+TRACE_DIR_ENV = "MAPBUILDER_TRACE_DIR"
+# Spans which hold the whole of a mapID or scheduler job
+OUTER_SPANS = ("mapID", "job")
+# Column order of the summary table, with any other spans after them
+SUMMARY_SPANS = ("definitions", "mosaic render", "plane write", "composite",
+				 "rescale", "tile", "restructure", "icon collection",
+				 "icon insertion", "cleanup")
+
+# Finished spans of this process, written out when its outermost span ends
+EVENTS = list()
+EVENTS_LOCK = threading.Lock()
+SPAN_DEPTH = threading.local()
+
+
+def getTracePath(basePath):
+	return os.path.join(basePath, CONFIG.trace.tracePath)
+
+
+def startTrace(basePath):
+	# Begins tracing this process and the workers it starts, if enabled
+	if not CONFIG.trace.traceEnabled:
+		return
+	parts.startParts(os.path.join(getTracePath(basePath), "events"),
+					 TRACE_DIR_ENV)
+
+
+@contextmanager
+def span(name, **args):
+	# Times the enclosed block. Attributes only known at the end may be
+	# added to the yielded dict
+	eventsPath = parts.getParts(TRACE_DIR_ENV)
+	if not eventsPath:
+		yield args
+		return
+	depth = getattr(SPAN_DEPTH, "depth", 0)
+	SPAN_DEPTH.depth = depth + 1
+	# Wall clock start times line the processes up, while durations use
+	# the finer performance counter
+	startTime = time.time_ns()
+	startCounter = time.perf_counter_ns()
+	try:
+		yield args
+	finally:
+		event = {
+			"name": name,
+			"ph": "X",
+			"ts": startTime / 1000,
+			"dur": (time.perf_counter_ns() - startCounter) / 1000,
+			"pid": os.getpid(),
+			"tid": threading.get_ident(),
+			"args": args
+		}
+		SPAN_DEPTH.depth = depth
+		# Spans may end on several threads of a mapID at once
+		with EVENTS_LOCK:
+			EVENTS.append(event)
+			if depth == 0:
+				flushEvents(eventsPath)
+
+
+def flushEvents(eventsPath):
+	parts.appendRecords(eventsPath, EVENTS, default=str)
+	EVENTS.clear()
+
+
+def summarise(events):
+	# Seconds spent in each stage by each mapID, as rows of a table
+	stageTimes = defaultdict(lambda: defaultdict(float))
+	for event in events:
+		mapID = event["args"].get("mapID")
+		if mapID is None:
+			continue
+		name = "total" if event["name"] in OUTER_SPANS else event["name"]
+		stageTimes[mapID][name] += event["dur"] / 1e6
+	names = [name for name in SUMMARY_SPANS
+			 if any(name in times for times in stageTimes.values())]
+	names += sorted({name for times in stageTimes.values() for name in times}
+					- set(names) - {"total"})
+
+	lines = [f"{'mapID':>6}{'total':>10}" +
+			 "".join(f"{name:>16}" for name in names)]
+	for mapID, times in sorted(stageTimes.items(),
+							   key=lambda item: -item[1]["total"]):
+		lines.append(f"{mapID:>6}{times['total']:>10.2f}" +
+					 "".join(f"{times[name]:>16.2f}" for name in names))
+	return "\n".join(lines)
+
+
+def writeTrace(basePath):
+	# Gathers the spans of every process into trace.json and a summary
+	eventsPath = parts.stopParts(TRACE_DIR_ENV)
+	if not eventsPath:
+		return
+	events = parts.gatherRecords(eventsPath)
+
+	# Processes are labelled so the build's own is told from its workers
+	metadata = [{"name": "process_name", "ph": "M", "pid": pid,
+				 "args": {"name": "build" if pid == os.getpid()
+						  else f"worker {pid}"}}
+				for pid in sorted({event["pid"] for event in events})]
+	tracePath = getTracePath(basePath)
+	with open(os.path.join(tracePath, "trace.json"), 'w') as traceFile:
+		json.dump({"traceEvents": metadata + events,
+				   "displayTimeUnit": "ms"}, traceFile)
+	summary = summarise(events)
+	with open(os.path.join(tracePath, "summary.txt"), 'w') as summaryFile:
+		summaryFile.write(summary + "\n")
+	print(summary)
+	print(f"Trace of {len(events)} spans saved to "
+		  f"{os.path.join(tracePath, 'trace.json')}")
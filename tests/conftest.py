@@ -0,0 +1,18 @@
+"""
+The scripts import each other as top-level modules, as they do when run from
+the repository root, so the tests import them the same way. The builder's
+configuration and coordinates are loaded first, as buildWikiMaps does, since
+the modules pick up those singletons as they are imported
+"""
+import os
+import sys
+
+REPOSITORY_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__),
+											   os.pardir))
+SCRIPTS_PATH = os.path.join(REPOSITORY_PATH, "scripts")
+sys.path.insert(0, SCRIPTS_PATH)
+
+from config import MapBuilderConfig, GlobalCoordinateDefinition
+MapBuilderConfig.fromJSON(os.path.join(SCRIPTS_PATH, "mapBuilderConfig.json"))
+GlobalCoordinateDefinition.fromJSON(
+	os.path.join(REPOSITORY_PATH, "osrs-wiki-maps", "coordinateData.json"))
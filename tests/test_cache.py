@@ -0,0 +1,138 @@
+"""
+Streamed cache downloads against a local server which drops connections
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import hashlib
+import random
+import os
+
+import pytest
+
+import cache
+
+PAYLOAD = random.Random(1).randbytes(64 * 1024)
+
+
+class PayloadHandler(BaseHTTPRequestHandler):
+	# Serves PAYLOAD, honouring byte ranges when the server allows them, and
+	# cuts off the first response of each range start in server.dropStarts
+	def log_message(self, *args):
+		pass
+
+	def getRange(self):
+		requested = self.headers.get("Range")
+		if not requested or not self.server.supportsRanges:
+			return None
+		first, _, last = requested.removeprefix("bytes=").partition("-")
+		last = int(last) if last else len(PAYLOAD) - 1
+		return int(first), last
+
+	def sendHeaders(self, byteRange):
+		if byteRange:
+			self.send_response(206)
+			first, last = byteRange
+			self.send_header("Content-Range",
+							 f"bytes {first}-{last}/{len(PAYLOAD)}")
+		else:
+			self.send_response(200)
+			first, last = 0, len(PAYLOAD) - 1
+		self.send_header("Content-Length", str(last - first + 1))
+		if self.server.supportsRanges:
+			self.send_header("Accept-Ranges", "bytes")
+		self.end_headers()
+		return first, last
+
+	def do_HEAD(self):
+		self.sendHeaders(None)
+
+	def do_GET(self):
+		byteRange = self.getRange()
+		self.server.requests.append(self.headers.get("Range"))
+		first, last = self.sendHeaders(byteRange)
+		body = PAYLOAD[first:last + 1]
+		if first in self.server.dropStarts:
+			self.server.dropStarts.remove(first)
+			self.wfile.write(body[:len(body) // 2])
+			self.wfile.flush()
+			self.close_connection = True
+			return
+		self.wfile.write(body)
+
+
+@pytest.fixture
+def server(monkeypatch):
+	# Small chunks, so that a dropped response leaves part of it on disk
+	monkeypatch.setattr(cache, "CHUNK_SIZE", 1024)
+	httpServer = ThreadingHTTPServer(("127.0.0.1", 0), PayloadHandler)
+	httpServer.supportsRanges = True
+	httpServer.dropStarts = set()
+	httpServer.requests = list()
+	thread = threading.Thread(target=httpServer.serve_forever, daemon=True)
+	thread.start()
+	yield httpServer
+	httpServer.shutdown()
+	httpServer.server_close()
+
+
+def getURL(server):
+	return f"http://127.0.0.1:{server.server_address[1]}/disk.zip"
+
+
+def readFile(path):
+	with open(path, "rb") as file:
+		return file.read()
+
+
+def test_resumes_after_a_dropped_connection(server, tmp_path):
+	server.dropStarts = {0}
+	outPath = str(tmp_path / "disk.zip")
+	cache.stream_download(getURL(server), outPath)
+	assert readFile(outPath) == PAYLOAD
+	# The second request picks up from the bytes already on disk
+	assert len(server.requests) == 2
+	resumedFrom = int(server.requests[1].removeprefix("bytes=").split("-")[0])
+	assert 0 < resumedFrom < len(PAYLOAD)
+	assert not os.path.exists(outPath + ".part")
+
+
+def test_fetches_parallel_segments(server, tmp_path):
+	segments = 4
+	bounds = [len(PAYLOAD) * i // segments for i in range(segments)]
+	# One segment is dropped and resumes on its own
+	server.dropStarts = {bounds[2]}
+	outPath = str(tmp_path / "disk.zip")
+	cache.stream_download(getURL(server), outPath, segments=segments)
+	assert readFile(outPath) == PAYLOAD
+	starts = {int(byteRange.removeprefix("bytes=").split("-")[0])
+			  for byteRange in server.requests}
+	assert set(bounds) <= starts
+	assert len(server.requests) == segments + 1
+	assert not any(name.startswith("disk.zip.part")
+				   for name in os.listdir(tmp_path))
+
+
+def test_restarts_without_ranges(server, tmp_path):
+	server.supportsRanges = False
+	server.dropStarts = {0}
+	outPath = str(tmp_path / "disk.zip")
+	cache.stream_download(getURL(server), outPath, segments=4)
+	assert readFile(outPath) == PAYLOAD
+	assert server.requests == [None, None]
+
+
+def test_checks_an_expected_checksum(server, tmp_path):
+	outPath = str(tmp_path / "disk.zip")
+	digest = hashlib.sha256(PAYLOAD).hexdigest()
+	cache.stream_download(getURL(server), outPath,
+						  expected_sha256=digest.upper())
+	assert readFile(outPath) == PAYLOAD
+
+
+def test_rejects_a_checksum_mismatch(server, tmp_path):
+	outPath = str(tmp_path / "disk.zip")
+	with pytest.raises(IOError, match="Checksum mismatch"):
+		cache.stream_download(getURL(server), outPath,
+							  expected_sha256="0" * 64)
+	assert not os.path.exists(outPath)
+	assert not os.path.exists(outPath + ".part")
@@ -0,0 +1,172 @@
+"""
+Planning mapID jobs within the memory budget, and running them in a pool
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import pytest
+
+import scheduler
+from config import MapBuilderConfig, GlobalCoordinateDefinition
+from definitions import SquareDefinition
+from managers import MapDefsManager
+from memorybudget import MemoryBudgetExceeded
+from scheduler import BuildJob, MEGABYTE
+
+CONFIG = MapBuilderConfig()
+GCS = GlobalCoordinateDefinition()
+
+
+def makeDefsStore(widthSquares, heightSquares, levels):
+	squareDefs = [SquareDefinition(0, x, z, x, z, 0, levels, None, "")
+				  for x in range(50, 50 + widthSquares)
+				  for z in range(50, 50 + heightSquares)]
+	return MapDefsManager(squareDefs, list())
+
+
+@pytest.fixture
+def opts(monkeypatch):
+	# Round figures, so estimates can be worked out by hand
+	opts = CONFIG.scheduler
+	for name, value in (("workerBaseMemoryMB", 100),
+						("renderBytesPerPixel", 2), ("tileBytesPerPixel", 1),
+						("pixelsPerSecond", 1000),
+						("splitThresholdSquares", 16), ("mapIDThreads", 2)):
+		monkeypatch.setattr(opts, name, value)
+	monkeypatch.setattr(CONFIG.zoom, "minZoom", 1)
+	monkeypatch.setattr(CONFIG.zoom, "maxZoom", 3)
+	monkeypatch.setattr(CONFIG.zoom, "baselineZoomLevel", 2)
+	return opts
+
+
+def test_builds_small_mapIDs_in_one_job(opts):
+	jobs = scheduler.planMapIDJobs(4, {"fileId": 4}, makeDefsStore(2, 2, 3))
+	assert [(job.jobID, job.stage) for job in jobs] == [("4", "mapID")]
+	planePixels = 4 * GCS.squarePixelLength ** 2
+	baseMemory = 100 * MEGABYTE
+	# Zoom 3 tiles are the largest part of each plane, and two of the three
+	# planes are worked on at once
+	planeMemory = 4 * planePixels
+	assert jobs[0].estimatedMemory == baseMemory + planeMemory * 2
+	tilePixels = planePixels * (0.25 + 1 + 4)
+	assert jobs[0].estimatedRuntime == pytest.approx(
+		(3 * planePixels + 3 * tilePixels) / 1000)
+
+
+def test_splits_giant_mapIDs_into_a_graph(opts):
+	jobs = scheduler.planMapIDJobs(4, {"fileId": 4}, makeDefsStore(4, 4, 2))
+	jobsByID = {job.jobID: job for job in jobs}
+	assert len(jobsByID) == len(jobs) == 2 * 2 + 2 * 3 + 1
+	assert jobsByID["4:composite:0"].dependsOn == ("4:render:0",)
+	assert jobsByID["4:composite:1"].dependsOn == ("4:render:1",
+												   "4:composite:0")
+	assert jobsByID["4:tile:1:3"].dependsOn == ("4:composite:1",)
+	assert set(jobsByID["4:icons"].dependsOn) == {
+		f"4:tile:{planeNum}:{zoomLevel}"
+		for planeNum in range(2) for zoomLevel in range(1, 4)}
+	# Dependencies always come earlier in the plan
+	seen = set()
+	for job in jobs:
+		assert seen.issuperset(job.dependsOn)
+		seen.add(job.jobID)
+	planePixels = 16 * GCS.squarePixelLength ** 2
+	assert jobsByID["4:tile:0:3"].estimatedMemory == \
+		100 * MEGABYTE + 4 * planePixels
+
+
+class InlinePool(ThreadPoolExecutor):
+	# Runs the jobs on threads of this process, where runJob can be replaced
+	def __init__(self, workerCount, mp_context=None, initializer=None,
+				 initargs=()):
+		super().__init__(workerCount)
+
+
+def makeJob(jobID, memory, dependsOn=(), stage="tile"):
+	return BuildJob(jobID, 4, stage, memory, 1.0, dependsOn=dependsOn)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+	# Records each job as it starts, with the jobs running beside it
+	started = list()
+	running = set()
+	lock = threading.Lock()
+	gates = dict()
+
+	def runJob(job, basePath):
+		with lock:
+			started.append((job.jobID, job.lowMemory, set(running)))
+			running.add(job.jobID)
+		try:
+			gate = gates.get(job.jobID)
+			if gate is not None:
+				gate.wait(timeout=5)
+			if job.jobID.startswith("heavy") and not job.lowMemory:
+				raise MemoryBudgetExceeded(f"{job.jobID} is too large")
+			return job.jobID
+		finally:
+			with lock:
+				running.discard(job.jobID)
+
+	monkeypatch.setattr(scheduler, "ProcessPoolExecutor", InlinePool)
+	monkeypatch.setattr(scheduler, "runJob", runJob)
+	return started, gates
+
+
+def test_starts_jobs_only_within_the_budget(pool):
+	started, _ = pool
+	pending = [makeJob("a", 60), makeJob("b", 60), makeJob("c", 30)]
+	finished = dict()
+	remaining = scheduler.runPool(pending, finished, "", 3, 100)
+	assert remaining == [] and set(finished) == {"a", "b", "c"}
+	# b does not fit beside a, while c does
+	startedWith = {jobID: running for jobID, _, running in started}
+	assert "a" not in startedWith["b"] and "b" not in startedWith["a"]
+
+
+def test_runs_jobs_after_their_dependencies(pool):
+	started, _ = pool
+	pending = [makeJob("tile", 10, dependsOn=("composite",)),
+			   makeJob("composite", 10)]
+	finished = dict()
+	scheduler.runPool(pending, finished, "", 2, 100)
+	assert [jobID for jobID, _, _ in started] == ["composite", "tile"]
+
+
+def test_requeues_jobs_past_the_memory_budget_to_run_alone(pool):
+	started, gates = pool
+	# The light job is held, so it is still running when heavy fails
+	gates["light"] = threading.Event()
+	pending = [makeJob("light", 10), makeJob("heavy", 50),
+			   makeJob("after", 10)]
+	finished = dict()
+
+	def release():
+		# Heavy has failed and been requeued once a job starts after it
+		while len(started) < 3:
+			threading.Event().wait(0.01)
+		gates["light"].set()
+	threading.Thread(target=release, daemon=True).start()
+
+	remaining = scheduler.runPool(pending, finished, "", 2, 100)
+	assert remaining == []
+	assert finished == {"light": "light", "heavy": "heavy", "after": "after"}
+	requeued = [(lowMemory, running) for jobID, lowMemory, running in started
+				if jobID == "heavy"]
+	# Heavy ran once beside light, then again with the low-memory strategy
+	# and nothing beside it
+	assert requeued == [(False, {"light"}), (True, set())]
+
+
+def test_fails_jobs_which_cannot_be_run_again(pool, monkeypatch):
+	monkeypatch.setattr(scheduler, "REQUEUE_STAGES", ("render",))
+	with pytest.raises(MemoryBudgetExceeded):
+		scheduler.runPool([makeJob("heavy", 50)], dict(), "", 2, 100)
+
+
+def test_requeues_a_job_only_once():
+	job = makeJob("heavy", 500, stage="render")
+	lowMemoryJob = scheduler.requeueJob(job, 100, MemoryBudgetExceeded())
+	assert lowMemoryJob.lowMemory and lowMemoryJob.estimatedMemory == 100
+	with pytest.raises(MemoryBudgetExceeded):
+		scheduler.requeueJob(lowMemoryJob, 100, MemoryBudgetExceeded())
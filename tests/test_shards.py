@@ -0,0 +1,107 @@
+"""
+Partitioning mapIDs between shards, and merging the shards' outputs
+"""
+import json
+import os
+
+import pytest
+
+import shards
+from config import MapBuilderConfig
+
+CONFIG = MapBuilderConfig()
+
+RENDER_PLAN = {-1: None, 4: {"fileId": 4}, 7: {"fileId": 7}}
+
+
+def test_assigns_the_largest_mapIDs_first_to_the_least_loaded_shard():
+	costs = {1: 10.0, 2: 7.0, 3: 5.0, 4: 4.0, 5: 2.0}
+	assert shards.partitionMapIDs(costs, 2) == [[1, 4], [2, 3, 5]]
+	assert shards.partitionMapIDs(costs, 1) == [[1, 2, 3, 4, 5]]
+
+
+def test_partitions_are_reproducible():
+	costs = {mapID: float(mapID % 3) for mapID in range(20)}
+	partition = shards.partitionMapIDs(costs, 3)
+	shuffled = dict(sorted(costs.items(), key=lambda item: -item[0]))
+	assert shards.partitionMapIDs(shuffled, 3) == partition
+	assert sorted(sum(partition, [])) == sorted(costs)
+	# Ties go to the lowest mapID and shard
+	assert shards.partitionMapIDs({2: 1.0, 1: 1.0}, 3) == [[1], [2], []]
+
+
+def test_parses_shard_specs():
+	assert shards.parseShard("2/3") == (2, 3)
+	for shardSpec in ("0/3", "4/3", "2", "a/b"):
+		with pytest.raises(ValueError):
+			shards.parseShard(shardSpec)
+
+
+def writeTile(basePath, mapID, name):
+	tilePath = os.path.join(basePath, CONFIG.mapid.mapIDoutPath, str(mapID),
+							"2", name)
+	os.makedirs(os.path.dirname(tilePath), exist_ok=True)
+	with open(tilePath, 'w') as tileFile:
+		tileFile.write(f"{mapID}/{name}")
+	return tilePath
+
+
+def writeShard(basePath, index, count, mapIDs, renderPlan=RENDER_PLAN):
+	# Builds the shard's "tiles" and saves its outputs, as a machine would
+	basemapsList = list()
+	for mapID in mapIDs:
+		writeTile(basePath, mapID, "0_1_1.png")
+		basemapsList.append({"mapId": mapID, "name": str(mapID)})
+	shards.writeShardOutputs(basePath, renderPlan, basemapsList, index, count)
+
+
+@pytest.fixture
+def basePath(tmp_path, monkeypatch):
+	# Only the rendered tiles are archived
+	monkeypatch.setattr(CONFIG.icon, "iconOutputMode", "burned")
+	return str(tmp_path)
+
+
+def readBasemaps(basePath):
+	with open(os.path.join(basePath, CONFIG.mapid.basemapsPath)) as f:
+		return json.load(f)
+
+
+def test_merges_shards_in_render_order(basePath):
+	writeShard(basePath, 2, 2, [4])
+	writeShard(basePath, 1, 2, [7, -1])
+	renderedPath = os.path.join(basePath, CONFIG.mapid.mapIDoutPath)
+	for mapID in RENDER_PLAN:
+		os.remove(os.path.join(renderedPath, str(mapID), "2", "0_1_1.png"))
+
+	shards.merge(basePath)
+	assert [entry["mapId"] for entry in readBasemaps(basePath)] == [-1, 4, 7]
+	for mapID in RENDER_PLAN:
+		with open(os.path.join(renderedPath, str(mapID), "2", "0_1_1.png")) as f:
+			assert f.read() == f"{mapID}/0_1_1.png"
+
+
+def test_rejects_a_missing_shard(basePath):
+	writeShard(basePath, 1, 3, [-1])
+	writeShard(basePath, 3, 3, [7])
+	with pytest.raises(ValueError, match=r"shards 1 to 3, found \[1, 3\]"):
+		shards.merge(basePath)
+
+
+def test_rejects_shards_of_different_plans(basePath):
+	writeShard(basePath, 1, 2, [-1, 7])
+	writeShard(basePath, 2, 2, [4], renderPlan={-1: None, 4: {"fileId": 4}})
+	with pytest.raises(ValueError, match="different plan"):
+		shards.merge(basePath)
+
+
+def test_rejects_mapIDs_no_shard_built(basePath):
+	writeShard(basePath, 1, 2, [-1])
+	writeShard(basePath, 2, 2, [4])
+	with pytest.raises(ValueError, match=r"No shard built mapIDs \[7\]"):
+		shards.merge(basePath)
+
+
+def test_needs_shard_outputs(basePath):
+	with pytest.raises(FileNotFoundError):
+		shards.merge(basePath)
@@ -0,0 +1,140 @@
+"""
+Snapshots read back the definitions and sprites they were built from
+"""
+from dataclasses import astuple
+import json
+import os
+
+import numpy as np
+import pytest
+
+import snapshot
+from config import MapBuilderConfig
+from definitions import IconDefinition, loadMapDefinitions
+from images import IconImage
+from pyvips_import import pyvips as pv
+
+CONFIG = MapBuilderConfig()
+
+SQUARE = {"groupId": 1, "sourceSquareX": 50, "sourceSquareZ": 50,
+		  "displaySquareX": 50, "displaySquareZ": 50, "minLevel": 0,
+		  "levels": 4, "fileId": 4}
+ZONE = dict(SQUARE, sourceZoneX=1, sourceZoneZ=2, displayZoneX=3,
+			displayZoneZ=4)
+REGION = dict(ZONE, squareWidth=2, squareHeight=1, zoneWidth=16,
+			  zoneHeight=8)
+MAP_DEFS = [
+	{"fileId": 4, "name": "Cave", "position": [3200, 3200],
+	 "mapSquareDefinitions": [SQUARE, dict(SQUARE, displaySquareX=51)],
+	 "zoneDefinitions": [ZONE], "regionDefinitions": [REGION]},
+	{"fileId": 7, "name": "Empty"}
+]
+USER_MAP_DEFS = [{"fileId": 9, "name": "User",
+				  "mapSquareDefinitions": [dict(SQUARE, fileId=9)]}]
+ICON_DEFS = [{"position": {"x": 3201, "y": 3202, "z": 1}, "spriteId": 3},
+			 {"position": {"x": 3300, "y": 3100, "z": 0}, "spriteId": 5}]
+
+
+def writeJSON(data, path):
+	with open(path, 'w') as f:
+		json.dump(data, f)
+
+
+def writeSprite(path, width, height, seed):
+	# Sprites with some transparent and some partly transparent pixels
+	rng = np.random.default_rng(seed)
+	sprite = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+	sprite[0, :, 3] = 0
+	sprite[1, :, 3] = 255
+	pv.Image.new_from_array(sprite, interpretation="srgb").write_to_file(path)
+
+
+def definitionFields(mapDefs, mapID, basePath):
+	# Definitions only compare by group, so every field is compared instead
+	squareDefs, zoneDefs = loadMapDefinitions(mapID, mapDefs, basePath)
+	return [(type(definition).__name__, astuple(definition))
+			for definition in squareDefs + zoneDefs]
+
+
+@pytest.fixture
+def basePath(tmp_path, monkeypatch):
+	# A working directory of definitions and sprites, with nothing loaded
+	monkeypatch.setattr(snapshot, "SNAPSHOTS", dict())
+	userMapDefsPath = str(tmp_path / "user_world_defs.json")
+	monkeypatch.setattr(CONFIG.mapid, "userMapDefsPath", userMapDefsPath)
+	writeJSON(USER_MAP_DEFS, userMapDefsPath)
+	writeJSON(MAP_DEFS, tmp_path / CONFIG.mapid.mapDefsPath)
+	writeJSON(ICON_DEFS, tmp_path / CONFIG.icon.iconDefs)
+	iconPath = tmp_path / CONFIG.icon.iconPath
+	iconPath.mkdir()
+	writeSprite(iconPath / "3.png", 15, 15, 3)
+	writeSprite(iconPath / "5.png", 11, 7, 5)
+	return str(tmp_path)
+
+
+def test_packs_sprites_without_overlapping():
+	rng = np.random.default_rng(1)
+	sprites = {spriteID: (rng.integers(0, 256, (height, width, bands),
+									   dtype=np.uint8), "srgb")
+			   for spriteID, (width, height, bands) in enumerate(
+				   [(300, 20, 4), (300, 10, 3), (100, 30, 4), (15, 15, 4)])}
+	atlas, rects = snapshot.packSpriteArrays(sprites)
+	assert atlas.shape[1] == snapshot.ATLAS_WIDTH and atlas.shape[2] == 4
+	used = np.zeros(atlas.shape[:2], dtype=int)
+	for spriteID, (x, y, width, height, bands, interpretation) in rects.items():
+		array = sprites[spriteID][0]
+		assert (width, height, bands) == (array.shape[1], array.shape[0],
+										  array.shape[2])
+		assert interpretation == "srgb"
+		assert np.array_equal(atlas[y:y+height, x:x+width, :bands], array)
+		used[y:y+height, x:x+width] += 1
+	assert used.max() == 1
+
+
+def test_round_trips_the_definitions(basePath):
+	renderPlan = snapshot.loadRenderPlan(basePath)
+	assert list(renderPlan) == [-1, 4, 7, 9]
+	assert renderPlan[-1] is None
+	assert renderPlan[4]["name"] == "Cave"
+	assert renderPlan[4]["position"] == [3200, 3200]
+	expected = {mapDefs["fileId"]: mapDefs
+				for mapDefs in MAP_DEFS + USER_MAP_DEFS}
+	for mapID in (4, 7, 9):
+		assert (definitionFields(renderPlan[mapID], mapID, basePath)
+				== definitionFields(expected[mapID], mapID, basePath))
+
+	iconDefs = snapshot.loadIconDefinitions(basePath)
+	iconDefsPath = os.path.join(basePath, CONFIG.icon.iconDefs)
+	assert ([repr(iconDef) for iconDef in iconDefs]
+			== [repr(iconDef) for iconDef
+				in IconDefinition.iconDefsFromJSON(iconDefsPath)])
+
+
+def test_round_trips_the_sprites(basePath):
+	iconImages = snapshot.loadIconImages(basePath)
+	assert sorted(iconImages) == [3, 5]
+	for spriteID, iconImage in iconImages.items():
+		sprite = pv.Image.new_from_file(iconImage.sourcePath).numpy()
+		image = iconImage.image.numpy()
+		assert np.array_equal(image[..., :3], sprite[..., :3])
+		# Only the fully opaque pixels are covered
+		assert np.array_equal(image[..., 3], np.where(sprite[..., 3] == 255,
+													  255, 0))
+		assert np.array_equal(IconImage(iconImage.sourcePath).image.numpy(),
+							  image)
+
+
+def test_rebuilds_when_an_input_changes(basePath):
+	snapshotPath = os.path.join(basePath, CONFIG.mapid.snapshotPath)
+	snapshot.loadSnapshot(basePath)
+	firstKeys = os.listdir(snapshotPath)
+	# An unchanged input reuses the snapshot
+	writeJSON(ICON_DEFS, os.path.join(basePath, CONFIG.icon.iconDefs))
+	snapshot.loadSnapshot(basePath)
+	assert os.listdir(snapshotPath) == firstKeys
+
+	writeJSON(ICON_DEFS[:1], os.path.join(basePath, CONFIG.icon.iconDefs))
+	assert len(snapshot.loadIconDefinitions(basePath)) == 1
+	# Snapshots of the earlier inputs are removed
+	assert len(os.listdir(snapshotPath)) == 1
+	assert os.listdir(snapshotPath) != firstKeys
@@ -0,0 +1,82 @@
+"""
+Stage cache keys, and pruning of the least recently used entries
+"""
+import os
+
+import pytest
+
+import stagecache
+from config import MapBuilderConfig
+
+CONFIG = MapBuilderConfig()
+
+
+@pytest.fixture
+def basePath(tmp_path, monkeypatch):
+	# Limits are counted in bytes rather than megabytes
+	monkeypatch.setattr(stagecache, "MEGABYTE", 1)
+	monkeypatch.setattr(CONFIG.mapid, "stageCacheMB", 100)
+	return str(tmp_path)
+
+
+def writeStage(basePath, name, size, mtime):
+	# A stage output, stored and then dated as if used at mtime
+	stagePath = os.path.join(basePath, f"{name}.png")
+	with open(stagePath, 'wb') as stageFile:
+		stageFile.write(bytes(size))
+	key = stagecache.makeKey("plane", name)
+	stagecache.store(basePath, key, stagePath)
+	os.utime(stagecache.getEntryPath(basePath, key, stagePath), (mtime, mtime))
+	return key
+
+
+def listEntries(basePath):
+	return sorted(os.listdir(stagecache.getCachePath(basePath)))
+
+
+def test_keys_depend_on_every_part():
+	key = stagecache.makeKey("plane", ((0, 0), (1, 1)), [("a.png", "1f")])
+	assert key == stagecache.makeKey("plane", ((0, 0), (1, 1)),
+									 [("a.png", "1f")])
+	assert key != stagecache.makeKey("plane", ((0, 0), (1, 1)),
+									 [("a.png", "2f")])
+	assert key != stagecache.makeKey("composite", ((0, 0), (1, 1)),
+									 [("a.png", "1f")])
+	assert len(key) == 32
+
+
+def test_keys_change_with_the_cache_version(monkeypatch):
+	key = stagecache.makeKey("plane", 1)
+	monkeypatch.setattr(stagecache, "STAGE_CACHE_VERSION",
+						stagecache.STAGE_CACHE_VERSION + 1)
+	assert stagecache.makeKey("plane", 1) != key
+
+
+def test_prunes_the_least_recently_used_entries(basePath):
+	keys = [writeStage(basePath, f"plane_{i}", 30, 1000 + i) for i in range(3)]
+	# A fourth entry only fits once the oldest is removed
+	keys.append(writeStage(basePath, "plane_3", 30, 2000))
+	assert listEntries(basePath) == sorted(f"{key}.png" for key in keys[1:])
+
+
+def test_fetching_an_entry_keeps_it(basePath, tmp_path):
+	keys = [writeStage(basePath, f"plane_{i}", 30, 1000 + i) for i in range(3)]
+	fetchedPath = str(tmp_path / "fetched.png")
+	assert stagecache.fetch(basePath, keys[0], fetchedPath)
+	assert os.path.getsize(fetchedPath) == 30
+	writeStage(basePath, "plane_3", 30, 2000 + 1)
+	assert f"{keys[0]}.png" in listEntries(basePath)
+	assert f"{keys[1]}.png" not in listEntries(basePath)
+
+
+def test_prunes_to_a_lowered_limit(basePath, monkeypatch):
+	keys = [writeStage(basePath, f"plane_{i}", 30, 1000 + i) for i in range(3)]
+	monkeypatch.setattr(CONFIG.mapid, "stageCacheMB", 40)
+	stagecache.prune(basePath)
+	assert listEntries(basePath) == [f"{keys[2]}.png"]
+
+
+def test_missing_entries_are_not_fetched(basePath, tmp_path):
+	targetPath = str(tmp_path / "plane_0.png")
+	assert not stagecache.fetch(basePath, "0" * 32, targetPath)
+	assert not os.path.exists(targetPath)
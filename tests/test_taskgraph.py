@@ -0,0 +1,69 @@
+"""
+Dependent tasks run on threads, or in order on the calling thread
+"""
+import threading
+import time
+
+import pytest
+
+from taskgraph import Task, runTasks
+
+
+def recordingTask(key, log, delay=0.0, dependsOn=()):
+	def run():
+		time.sleep(delay)
+		log.append(key)
+		return key
+	return Task(run, dependsOn)
+
+
+@pytest.mark.parametrize("threadCount", [1, 4])
+def test_runs_tasks_after_their_dependencies(threadCount):
+	log = list()
+	tasks = {
+		"render0": recordingTask("render0", log, 0.02),
+		"render1": recordingTask("render1", log),
+		"composite0": recordingTask("composite0", log, dependsOn=("render0",)),
+		"composite1": recordingTask("composite1", log,
+									dependsOn=("render1", "composite0")),
+		"tile1": recordingTask("tile1", log, dependsOn=("composite1",))
+	}
+	results = runTasks(tasks, threadCount)
+	assert results == {key: key for key in tasks}
+	for key, task in tasks.items():
+		assert all(log.index(dep) < log.index(key) for dep in task.dependsOn)
+
+
+def test_runs_a_single_thread_in_the_calling_thread():
+	tasks = {key: Task(threading.get_ident) for key in range(3)}
+	assert set(runTasks(tasks, 1).values()) == {threading.get_ident()}
+
+
+def test_runs_independent_tasks_at_once():
+	barrier = threading.Barrier(3, timeout=5)
+	tasks = {key: Task(barrier.wait) for key in range(3)}
+	# Each task waits for the others, so they can only finish together
+	assert sorted(runTasks(tasks, 3).values()) == [0, 1, 2]
+
+
+def test_stops_starting_tasks_after_an_error():
+	log = list()
+	def fail():
+		raise ValueError("render failed")
+	tasks = {
+		"render": Task(fail),
+		"composite": recordingTask("composite", log, dependsOn=("render",))
+	}
+	for threadCount in (1, 2):
+		with pytest.raises(ValueError, match="render failed"):
+			runTasks(tasks, threadCount)
+	assert log == []
+
+
+def test_rejects_unknown_and_circular_dependencies():
+	with pytest.raises(ValueError, match="unknown"):
+		runTasks({"tile": Task(int, ("composite",))}, 2)
+	circular = {"a": Task(int, ("b",)), "b": Task(int, ("a",))}
+	for threadCount in (1, 2):
+		with pytest.raises(RuntimeError, match="never be started"):
+			runTasks(circular, threadCount)
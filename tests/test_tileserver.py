@@ -0,0 +1,75 @@
+"""
+The tile server's cache of tiles in memory and on disk
+"""
+import os
+
+import pytest
+
+import tileserver
+from tileserver import TileCache
+
+
+@pytest.fixture(autouse=True)
+def noOverhead(monkeypatch):
+	# Entries are counted by their data alone
+	monkeypatch.setattr(tileserver, "ENTRY_OVERHEAD", 0)
+
+
+def makeKey(index):
+	return f"{index:02x}" * 16
+
+
+def makeCache(tmp_path, memoryLimit=1000, diskLimit=1000):
+	return TileCache(str(tmp_path / "tiles"), memoryLimit, diskLimit)
+
+
+def setUsed(cache, key, mtime):
+	tilePath = cache.getTilePath(key)
+	os.utime(tilePath, (mtime, mtime))
+
+
+def test_evicts_the_least_recently_used_tiles_from_memory(tmp_path):
+	cache = makeCache(tmp_path, memoryLimit=30)
+	for index in range(3):
+		cache.putMemory(makeKey(index), bytes([index]) * 10)
+	# Reading a tile makes it the most recently used
+	assert cache.get(makeKey(0)) == bytes(10)
+	cache.putMemory(makeKey(3), bytes([3]) * 10)
+	assert list(cache.memoryTiles) == [makeKey(2), makeKey(0), makeKey(3)]
+	assert cache.memorySize == 30
+
+
+def test_reads_evicted_tiles_back_from_disk(tmp_path):
+	cache = makeCache(tmp_path, memoryLimit=10)
+	cache.put(makeKey(0), b"a" * 10)
+	cache.put(makeKey(1), b"b" * 10)
+	assert makeKey(0) not in cache.memoryTiles
+	assert cache.get(makeKey(0)) == b"a" * 10
+	assert list(cache.memoryTiles) == [makeKey(0)]
+	assert cache.get(makeKey(2)) is None
+
+
+def test_prunes_the_disk_below_its_limit(tmp_path):
+	cache = makeCache(tmp_path, memoryLimit=0, diskLimit=40)
+	for index in range(4):
+		cache.put(makeKey(index), bytes(10))
+		setUsed(cache, makeKey(index), 1000 + index)
+	# Reading a tile from disk makes it the most recently used
+	assert cache.get(makeKey(0)) == bytes(10)
+	cache.put(makeKey(4), bytes(10))
+	setUsed(cache, makeKey(4), 2000)
+	# Pruning leaves the most recent tiles within three quarters of the limit
+	remaining = sorted(os.path.basename(entryPath)
+					   for entryPath in cache.getEntryPaths())
+	assert remaining == sorted(f"{makeKey(index)}.png"
+							   for index in (0, 3, 4))
+	assert cache.diskSize == 30
+
+
+def test_counts_tiles_kept_by_an_earlier_run(tmp_path):
+	cache = makeCache(tmp_path)
+	cache.put(makeKey(0), bytes(10))
+	cache.put(makeKey(1), bytes(20))
+	reopened = makeCache(tmp_path)
+	assert reopened.diskSize == 30
+	assert reopened.get(makeKey(1)) == bytes(20)